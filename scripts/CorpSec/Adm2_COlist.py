@@ -7,10 +7,25 @@ It extract hazard levels related to ADM2 units from CO_listADM2.xlsx and adds th
 """
 
 # -*- coding: utf-8 -*-
-from sys import argv
+import argparse
+import os
+import sys
 import pandas as pd
 
-script, csv_file = argv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Extract_TH_api'))
+from th_fetch import BASE_URL, HAZARDS, hazard_url, read_hazards
+from th_lookup import load_lookup
+from th_tables import write_wide_tables
+
+parser = argparse.ArgumentParser(description='Pull ADM2 hazard levels from ThinkHazard! and join them to the ADM codes')
+parser.add_argument('csv_file', help='Output name, prefixed with the hazard type for each CSV')
+parser.add_argument('--wide', action='store_true',
+                    help='Write one Parquet table per ADM level (ADMIN2/1/0_<csv_file name>.parquet), '
+                         'with a column per hazard type, instead of CSVs per hazard')
+parser.add_argument('--base-url', default=BASE_URL,
+                    help='Url of the admindiv_hazardsets folder (e.g. a local test server)')
+args = parser.parse_args()
+csv_file = args.csv_file
 
 # %% Function definitions for Pandas & admin 1 level hazard level evaluation
 
@@ -27,22 +42,7 @@ def haz_adm(row):
 
 #%% Set up JSON import
 input_text = []
-input_links = []
-input_options = ['ALL', 'CF', 'CY', 'DG', 'EH',
-                 'EQ', 'FL', 'LS', 'TS', 'UF', 'VA', 'WF']
-baseURL = 'http://www.thinkhazard.org/en/admindiv_hazardsets'
-options = {'CF': (baseURL + '/CF.json'),
-           'CY': (baseURL + '/CY.json'),
-           'DG': (baseURL + '/DG.json'),
-           'EH': (baseURL + '/EH.json'),
-           'EQ': (baseURL + '/EQ.json'),
-           'FL': (baseURL + '/FL.json'),
-           'LS': (baseURL + '/LS.json'),
-           'TS': (baseURL + '/TS.json'),
-           'UF': (baseURL + '/UF.json'),
-           'VA': (baseURL + '/VA.json'),
-           'WF': (baseURL + '/WF.json')
-           }
+input_options = ['ALL'] + HAZARDS
 
 print('''The following section will ask what hazards to pull information for. Selections should be separated as an entry for each.
       Options include: ALL, CF, CY, DG, EH, EQ, FL, LS, TS, UF, VA, WF''')
@@ -51,8 +51,7 @@ while 1:
     if input_file == '':
         break
     elif input_file.upper() == 'ALL':
-        input_text.extend(['CF', 'CY', 'DG', 'EH', 'EQ',
-                           'FL', 'LS', 'TS', 'UF', 'VA', 'WF'])
+        input_text.extend(HAZARDS)
         print('Current selection: ', input_text)
     elif input_file.upper() in input_options:
         input_text.append(input_file.upper())
@@ -60,23 +59,32 @@ while 1:
     else:
         print('Selection not valid. Please choose from possible options: ALL, CF, CY, DG, EH, EQ, FL, LS, TS, UF, VA, WF')
 
-for i in input_text:
-    if i in options[i]:
-        input_links.append(options[i])
+# Drop repeated selections, keeping the order
+input_text = list(dict.fromkeys(input_text))
+input_links = [hazard_url(i, args.base_url) for i in input_text]
 
 print("Parsing the following links:",  input_links, "\n")
 
+# Download all selected hazards at once (unchanged files are read from the cache)
+hazard_data = read_hazards(input_text, base_url=args.base_url)
+
 # %% ADDED JUNE 2018 SF: Load WB ADM2 boundary data, for lookup of ADMcodes (CO)
 lookup_csv = 'THgaul_ADM2_attrib.csv'
-lookup = pd.read_csv(lookup_csv, encoding='utf-8', delimiter=';')
+# Parsed once and cached, until the CSV changes
+adm_lookup = load_lookup(lookup_csv)
+lookup = adm_lookup.table()
+
+if args.wide:
+    # All hazards in one table per ADM level, joined to the lookup at once
+    for fn in write_wide_tables(adm_lookup, hazard_data, csv_file):
+        print("Table {} complete.".format(fn))
+    sys.exit()
 
 # %% Create CSV(s) to write to, write row headers, write JSONS
-for i in input_links:
-    csv_num = i.split("/")[-1]
-    csv_num = csv_num.split(".")[0]
+for csv_num in input_text:
     csv_name = csv_num + "_" + csv_file
     print("Parsing ", csv_name)
-    df1 = pd.read_json(i)
+    df1 = hazard_data[csv_num]
 
     # ADDED JUNE 2018 -
     # rename column headers in exported file, to those of WB ADM files.
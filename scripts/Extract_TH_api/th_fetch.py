@@ -0,0 +1,247 @@
+"""
+Concurrent download of the ThinkHazard! ADM2 hazard level files.
+
+The `admindiv_hazardsets/<HZ>.json` files list the hazard level of every
+ADM2 unit for one hazard type. They are fetched in parallel threads sharing
+one pool of keep-alive connections, and kept in a local cache directory
+together with their ETag and Last-Modified headers. Later runs send these
+back as a conditional request, so files unchanged upstream are answered with
+a 304 (Not Modified) and read from the cache instead of downloaded again.
+
+Failed requests (connection errors, 429 and 5xx responses) are retried with
+exponential backoff. A 304 is only accepted for a file with a cached copy.
+
+The cache is kept in the user's cache directory (see `th_lookup.user_cache_dir()`).
+
+Example
+=======
+    from th_fetch import read_hazards
+
+    hazard_data = read_hazards(['FL', 'EQ'])
+    hazard_data['FL']  # DataFrame, as returned by pd.read_json(url)
+
+The base url can be changed to test against a local server, e.g. one
+started with `python -m http.server` in a folder holding the json files
+(the scripts using `read_hazards()` take it as `--base-url`).
+"""
+
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from th_lookup import user_cache_dir
+
+
+BASE_URL = 'http://www.thinkhazard.org/en/admindiv_hazardsets'
+HAZARDS = ['CF', 'CY', 'DG', 'EH', 'EQ',
+           'FL', 'LS', 'TS', 'UF', 'VA', 'WF']
+
+# Size of the chunks written to the cache while downloading, in bytes
+CHUNK_SIZE = 1024 ** 2
+
+
+def hazard_url(code, base_url=BASE_URL):
+    """Url of the ADM2 hazard level file of a hazard type.
+
+    Parameters
+    ==========
+    * code : str, hazard type mnemonic (e.g. 'FL')
+    * base_url : str, url of the `admindiv_hazardsets` folder
+
+    Returns
+    =======
+    * str
+    """
+    return '{}/{}.json'.format(base_url.rstrip('/'), code)
+# End hazard_url()
+
+
+def make_session(pool_size=4, retries=5, backoff=0.5):
+    """HTTP session with a pool of keep-alive connections and retries.
+
+    Parameters
+    ==========
+    * pool_size : int, connections kept open per host
+    * retries : int, times a failed request is retried
+    * backoff : float, base of the exponential delay between retries, in seconds
+
+    Returns
+    =======
+    * requests.Session
+    """
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=['GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+# End make_session()
+
+
+class HazardFetcher(object):
+    """Download hazard level files, revalidating cached copies.
+
+    Parameters
+    ==========
+    * base_url : str, url of the `admindiv_hazardsets` folder
+    * cache_dir : str, directory to keep the downloaded files in
+                  (defaults to `admindiv_hazardsets` in `user_cache_dir()`)
+    * max_workers : int, number of files downloaded at the same time
+    * retries : int, times a failed request is retried
+    * backoff : float, base of the exponential delay between retries, in seconds
+    * timeout : float, seconds to wait for the server to respond
+    """
+
+    def __init__(self, base_url=BASE_URL, cache_dir=None, max_workers=4,
+                 retries=5, backoff=0.5, timeout=60):
+        if cache_dir is None:
+            cache_dir = os.path.join(user_cache_dir(), 'admindiv_hazardsets')
+
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = make_session(max_workers, retries, backoff)
+        os.makedirs(cache_dir, exist_ok=True)
+    # End __init__()
+
+    def _paths(self, code):
+        fn = os.path.join(self.cache_dir, '{}.json'.format(code))
+        return fn, fn + '.meta'
+    # End _paths()
+
+    def fetch(self, code):
+        """Bring the cached copy of a hazard level file up to date.
+
+        Parameters
+        ==========
+        * code : str, hazard type mnemonic (e.g. 'FL')
+
+        Returns
+        =======
+        * Tuple[str, str], path to the cached file and how it was obtained:
+          'downloaded', 'not modified' or 'cached' (the server could not be
+          reached, the previous copy is used)
+        """
+        url = hazard_url(code, self.base_url)
+        fn, meta_fn = self._paths(code)
+
+        meta = {}
+        if os.path.exists(fn) and os.path.exists(meta_fn):
+            with open(meta_fn) as f:
+                meta = json.load(f)
+        # End if
+
+        # The cached copy (and its validators) only stand for the url it came from
+        cached = meta.get('url') == url
+        headers = {}
+        if cached:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        # End if
+
+        try:
+            with self.session.get(url, headers=headers, timeout=self.timeout,
+                                  stream=True) as resp:
+                if resp.status_code == 304:
+                    if not headers:
+                        raise requests.HTTPError("304 Not Modified for an unconditional request: {}".format(url),
+                                                 response=resp)
+                    return fn, 'not modified'
+                # End if
+
+                # Any other status without a body to cache is an error too
+                if resp.status_code != 200:
+                    resp.raise_for_status()
+                    raise requests.HTTPError("Unexpected {} response: {}".format(resp.status_code, url),
+                                             response=resp)
+                # End if
+
+                # Write next to the cached copy and swap, so an interrupted
+                # download never leaves a truncated file behind
+                fd, tmp = tempfile.mkstemp(suffix='.json', dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in resp.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                    os.replace(tmp, fn)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                # End try
+
+                meta = {'url': url,
+                        'etag': resp.headers.get('ETag'),
+                        'last_modified': resp.headers.get('Last-Modified')}
+            # End with
+        except requests.RequestException as e:
+            if not cached:
+                raise
+
+            print("Warning! Request for {} failed ({}), using cached copy".format(url, e))
+            return fn, 'cached'
+        # End try
+
+        with open(meta_fn, 'w') as f:
+            json.dump(meta, f)
+
+        return fn, 'downloaded'
+    # End fetch()
+
+    def fetch_all(self, codes):
+        """Bring the cached copies of several hazard level files up to date.
+
+        Parameters
+        ==========
+        * codes : List[str], hazard type mnemonics
+
+        Returns
+        =======
+        * dict[str, Tuple[str, str]] : path and status (see `fetch()`) by hazard type
+        """
+        codes = list(dict.fromkeys(codes))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(self.fetch, codes))
+
+        return dict(zip(codes, results))
+    # End fetch_all()
+# End HazardFetcher
+
+
+def read_hazards(codes, base_url=BASE_URL, cache_dir=None, max_workers=4):
+    """Hazard level tables of several hazard types.
+
+    Parameters
+    ==========
+    * codes : List[str], hazard type mnemonics (e.g. ['FL', 'EQ'])
+    * base_url : str, url of the `admindiv_hazardsets` folder
+    * cache_dir : str, directory to keep the downloaded files in
+    * max_workers : int, number of files downloaded at the same time
+
+    Returns
+    =======
+    * dict[str, DataFrame] : by hazard type, in the order requested
+    """
+    fetcher = HazardFetcher(base_url, cache_dir, max_workers)
+    results = fetcher.fetch_all(codes)
+
+    hazard_data = {}
+    for code, (fn, status) in results.items():
+        print("{}: {}".format(hazard_url(code, base_url), status))
+        hazard_data[code] = pd.read_json(fn)
+    # End for
+
+    return hazard_data
+# End read_hazards()
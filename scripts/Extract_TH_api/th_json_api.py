@@ -1,30 +1,51 @@
-import grequests
+import argparse
+import asyncio
+import json
+import os
+from urllib.parse import urlsplit
+
+import aiohttp
 from tqdm import tqdm
 import pandas as pd
-from collections import defaultdict
 
 """
 Instructions:
 
-You will need to install requests, grequests, and pandas if you have not already done so.
+You will need to install aiohttp, tqdm, and pandas if you have not already done so.
+
+conda install -c conda-forge aiohttp tqdm pandas
+
+OR
 
-conda install -c conda-forge requests grequests pandas
+pip install aiohttp tqdm pandas
 
-OR 
+Country reports are requested concurrently (`--concurrency` at a time, and at
+most `--rate` requests per second to the same host). Each parsed report is
+appended to a progress file (JSON lines) as soon as it arrives. The first line
+of the progress file holds the report url and the ADM0 codes of the run.
 
-pip install requests grequests pandas
+Every run requests all countries again, unless `--resume` is given: then the
+countries already in the progress file of an interrupted run are skipped.
+Resuming is refused if the url or the ADM0 codes differ from that run.
 """
 
 
-def parse_response(url, resp, df):
-    """Parse JSON response and insert into dataframe."""
+HAZARDS = ['FL', 'UF', 'CF', 'EQ', 'LS', 'TS', 'VA', 'CY', 'DG', 'EH', 'WF']
+
+
+def parse_response(country_code, resp):
+    """Hazard level of each hazard type in a country report.
 
-    # Because we send the requests asynchronously, results may not
-    # be returned in the order we sent it, so we get
-    # the country code from the URL
-    country_code = int(url.rsplit("/",1)[1].split(".")[0])
+    Parameters
+    ==========
+    * country_code : int, ADM0 code of the country
+    * resp : list, parsed JSON of the country report
 
-    row = {}
+    Returns
+    =======
+    * dict, country_code and the level mnemonic of each hazard type in the report
+    """
+    row = {'country_code': country_code}
     for hazard in resp:
         # Hazard type
         haztype = hazard['hazardtype']['mnemonic']
@@ -34,43 +55,216 @@ def parse_response(url, resp, df):
         row[haztype] = hazlevel
     # End for
 
-    # Have to loop over columns to ensure values are put in the correct position
-    for col in df.columns:
-        df.loc[df.index == country_code, col] = row[col]
+    return row
 # End parse_response()
 
 
-def failure_handler(r, exception):
-    print("Warning! Request for {} failed!".format(r.url))
+def failure_handler(url, exception):
+    print("Warning! Request for {} failed! ({})".format(url, exception))
+
+
+class HostRateLimiter(object):
+    """Spaces out the start of requests to the same host.
+
+    Parameters
+    ==========
+    * rate : float, maximum requests per second per host (None for no limit)
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = {}
+        self._lock = asyncio.Lock()
+    # End __init__()
 
+    async def wait(self, url):
+        if not self.interval:
+            return
 
-def collect_requests(responses, result_df):
-    for idx, r in enumerate(tqdm(responses)):
-        if (r is None) or (r.status_code != 200):
-            continue
+        host = urlsplit(url).netloc
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        # End with
 
-        parse_response(r.url, r.json(), result_df)
+        await asyncio.sleep(start - now)
+    # End wait()
+# End HostRateLimiter
+
+
+async def fetch_report(session, url, semaphore, limiter, retries=3, backoff=0.5):
+    """Parsed JSON of a country report, None if the request failed.
+
+    Connection errors, 429 and 5xx responses are retried with exponential backoff.
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                await limiter.wait(url)
+                async with session.get(url) as r:
+                    if (r.status == 429) or (r.status >= 500):
+                        raise aiohttp.ClientResponseError(r.request_info, r.history,
+                                                          status=r.status, message=r.reason)
+                    if r.status != 200:
+                        return None
+
+                    return await r.json(content_type=None)
+            # End with
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                failure_handler(url, e)
+                return None
+        # End try
+
+        await asyncio.sleep(backoff * 2 ** attempt)
     # End for
+# End fetch_report()
+
+
+def progress_header(target_url, adm0_codes):
+    """First line of a progress file, identifying the run it belongs to."""
+    return {'url': target_url, 'adm0_codes': list(adm0_codes)}
+# End progress_header()
+
+
+def load_progress(progress_fn, target_url, adm0_codes):
+    """Records of the countries collected by a previous (interrupted) run.
+
+    Parameters
+    ==========
+    * progress_fn : str, JSON lines progress file
+    * target_url : str, url of a country report, with `{}` for the ADM0 code
+    * adm0_codes : List[int], ADM0 codes of the countries
+
+    Returns
+    =======
+    * List[dict], one record per country collected
+
+    Raises
+    ======
+    * ValueError, if the progress file is from a run with another url or
+      other ADM0 codes
+    """
+    records = []
+    with open(progress_fn) as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+
+        if header != progress_header(target_url, adm0_codes):
+            raise ValueError("{} is from a run with another url or other ADM0 codes, "
+                             "run without --resume to start again".format(progress_fn))
+        # End if
+
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Line cut short by an interruption
+                continue
+        # End for
+    # End with
+
+    return records
+# End load_progress()
+
+
+async def collect_requests(adm0_codes, target_url, progress_fn, concurrency=4, rate=None,
+                           timeout=60, resume=False):
+    """Collect the country reports, or those not yet in the progress file.
+
+    Parameters
+    ==========
+    * adm0_codes : List[int], ADM0 codes of the countries
+    * target_url : str, url of a country report, with `{}` for the ADM0 code
+    * progress_fn : str, JSON lines file each parsed report is appended to
+    * concurrency : int, maximum number of requests open at the same time
+    * rate : float, maximum requests per second per host (None for no limit)
+    * timeout : float, seconds to wait for each request to complete
+    * resume : bool, skip the countries in the progress file of an interrupted
+               run (with the same url and ADM0 codes). Otherwise the progress
+               file is replaced.
+
+    Returns
+    =======
+    * List[dict], one record per country collected, including previous runs
+    """
+    records = []
+    if resume and os.path.exists(progress_fn):
+        records = load_progress(progress_fn, target_url, adm0_codes)
+    else:
+        with open(progress_fn, 'w') as progress:
+            progress.write(json.dumps(progress_header(target_url, adm0_codes)) + '\n')
+    # End if
+
+    done = set(rec['country_code'] for rec in records)
+    todo = [code for code in adm0_codes if code not in done]
+    if done:
+        print("Resuming: {} countries already collected, {} to go".format(len(done), len(todo)))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = HostRateLimiter(rate)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def collect(code):
+        resp = await fetch_report(session, target_url.format(code), semaphore, limiter)
+        return code, resp
+    # End collect()
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        with open(progress_fn, 'a') as progress:
+            tasks = [asyncio.ensure_future(collect(code)) for code in todo]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                code, resp = await task
+                if resp is None:
+                    continue
+
+                row = parse_response(code, resp)
+                records.append(row)
+                progress.write(json.dumps(row) + '\n')
+                progress.flush()
+            # End for
+        # End with
+    # End with
+
+    return records
 # End collect_requests()
 
 
-target_url = "http://thinkhazard.org/en/report/{}.json"
-file_loc = "../../ADM0_TH.csv"
-code_data = pd.read_csv(file_loc, sep=';')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect the hazard levels of each country from ThinkHazard!')
+    parser.add_argument('--adm0', default='../../ADM0_TH.csv', help='ADM0 code list (; separated)')
+    parser.add_argument('--output', default='collated_result.csv', help='Output CSV')
+    parser.add_argument('--progress', default='collated_progress.jsonl',
+                        help='File the reports collected so far are kept in, to resume an interrupted run')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the countries already in the progress file of an interrupted run '
+                             '(default: request all countries and replace the progress file)')
+    parser.add_argument('--concurrency', default=4, type=int, help='Requests open at the same time')
+    parser.add_argument('--rate', default=None, type=float, help='Maximum requests per second per host')
+    parser.add_argument('--url', default="http://thinkhazard.org/en/report/{}.json",
+                        help='Country report url, with {} for the ADM0 code')
+    args = parser.parse_args()
 
-adm0_codes = code_data['ADM0_CODE'].tolist()
-adm0_urls = [target_url.format(adm_code) for adm_code in adm0_codes]
+    target_url = args.url
+    file_loc = args.adm0
+    code_data = pd.read_csv(file_loc, sep=';')
 
-# List of things to do asynchronously
-url_responses = [grequests.get(url) for url in adm0_urls]
+    adm0_codes = code_data['ADM0_CODE'].tolist()
 
-result_df = pd.DataFrame(columns=['FL', 'UF', 'CF', 'EQ', 'LS', 'TS', 'VA', 'CY', 'DG', 'EH', 'WF'],
-                         index=adm0_codes)
-result_df.index.name = 'country_code'
+    records = asyncio.run(collect_requests(adm0_codes, target_url, args.progress,
+                                           args.concurrency, args.rate, resume=args.resume))
 
-# Send out asynchronous requests
-responses = grequests.imap(url_responses, exception_handler=failure_handler, size=4)
-collect_requests(responses, result_df)
+    # Built once from all records, countries without a report are left empty
+    result_df = pd.DataFrame.from_records(records, columns=['country_code'] + HAZARDS)
+    result_df = result_df.drop_duplicates('country_code', keep='last').set_index('country_code')
+    result_df = result_df.reindex(adm0_codes)
+    result_df.index.name = 'country_code'
 
-print(result_df)
-result_df.to_csv('collated_result.csv', sep=';')
+    print(result_df)
+    result_df.to_csv(args.output, sep=';')
+# End if
@@ -0,0 +1,254 @@
+"""
+ADM2 lookup of the ThinkHazard! units (THgaul_ADM2_attrib.csv), parsed once.
+
+The lookup CSV gives the ADM1 and ADM0 codes and names of every ADM2 unit.
+It is parsed into typed columns (integer codes, categorical text) and kept
+in a cache directory, which later runs load in milliseconds: the tables as
+Parquet files (categorical columns dictionary encoded) and the hierarchy
+arrays as .npy files. Nothing in the cache is unpickled. Each version of the
+CSV (by size and modification time) gets its own cache folder, so a changed
+CSV is parsed again and older folders are removed.
+
+The cache is kept in the user's cache directory (`~/.cache/thinkhazard`,
+or `%LOCALAPPDATA%\\thinkhazard` on Windows), not in the shared temp directory.
+
+The lookup is indexed by ADM2_CODE and holds the ADM hierarchy as arrays:
+for each ADM2 unit, the row of its ADM1 unit in `adm1` and of its ADM0 unit
+in `adm0`, so that ADM2 values can be rolled up without a groupby.
+
+Example
+=======
+    from th_lookup import load_lookup
+
+    lookup = load_lookup('THgaul_ADM2_attrib.csv')
+    lookup.adm2.loc[12345, 'ADM1_NAME']
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+LOOKUP_CSV = 'THgaul_ADM2_attrib.csv'
+
+# Bump when the layout of AdmLookup changes, to discard older caches
+CACHE_VERSION = 3
+
+TABLES = ['adm2', 'adm1', 'adm0']
+ARRAYS = ['adm1_idx', 'adm0_idx']
+
+CODE_COLS = ['ADM2_CODE', 'ADM1_CODE', 'ADM0_CODE']
+CODE_DTYPE = 'int32'
+
+# Text columns that are not dictionary encoded (nearly every value is unique)
+UNIQUE_COLS = ['ADM2_NAME']
+
+
+class AdmLookup(object):
+    """ADM2 units with their ADM1 and ADM0 units.
+
+    Parameters
+    ==========
+    * table : DataFrame, lookup CSV content, with at least the ADM2_CODE,
+              ADM2_NAME, ADM1_CODE, ADM1_NAME, ADM0_CODE and ADM0_NAME columns.
+              Repeated ADM2 codes are dropped.
+
+    Attributes
+    ==========
+    * adm2 : DataFrame, all lookup columns indexed by ADM2_CODE (in CSV order)
+    * adm1 : DataFrame, ADM1_NAME, ADM0_CODE and ADM0_NAME indexed by ADM1_CODE
+    * adm0 : DataFrame, ADM0_NAME indexed by ADM0_CODE
+    * adm1_idx : ndarray, row in `adm1` of the ADM1 unit of each row of `adm2`
+    * adm0_idx : ndarray, row in `adm0` of the ADM0 unit of each row of `adm2`
+    """
+
+    def __init__(self, table):
+        self.columns = list(table.columns)
+        check_codes(table)
+
+        text_cols = [col for col in table.columns if (col not in CODE_COLS + UNIQUE_COLS)
+                     and not pd.api.types.is_numeric_dtype(table[col])]
+        table = table.astype({col: CODE_DTYPE for col in CODE_COLS})
+        table = table.astype({col: 'category' for col in text_cols})
+        table = table.drop_duplicates('ADM2_CODE')
+
+        self.adm2 = table.set_index('ADM2_CODE')
+        self.adm1 = table.drop_duplicates('ADM1_CODE').sort_values('ADM1_CODE') \
+                         .set_index('ADM1_CODE')[['ADM1_NAME', 'ADM0_CODE', 'ADM0_NAME']]
+        self.adm0 = table.drop_duplicates('ADM0_CODE').sort_values('ADM0_CODE') \
+                         .set_index('ADM0_CODE')[['ADM0_NAME']]
+
+        # set_index() widens the codes to int64
+        for adm in (self.adm2, self.adm1, self.adm0):
+            adm.index = adm.index.astype(CODE_DTYPE)
+
+        self.adm1_idx = self.adm1.index.get_indexer(table['ADM1_CODE'])
+        self.adm0_idx = self.adm0.index.get_indexer(table['ADM0_CODE'])
+    # End __init__()
+
+    def positions(self, adm2_codes):
+        """Rows of `adm2` of ADM2 units.
+
+        Parameters
+        ==========
+        * adm2_codes : array-like, ADM2 codes
+
+        Returns
+        =======
+        * ndarray, row of each code in `adm2`, -1 for codes not in the lookup
+        """
+        return self.adm2.index.get_indexer(adm2_codes)
+    # End positions()
+
+    def table(self):
+        """Lookup as a plain table, with the columns of the CSV.
+
+        Returns
+        =======
+        * DataFrame
+        """
+        return self.adm2.reset_index()[self.columns]
+    # End table()
+
+    def save(self, out_dir):
+        """Write the lookup to a directory (Parquet tables and .npy arrays).
+
+        Parameters
+        ==========
+        * out_dir : str, existing directory
+        """
+        for name in TABLES:
+            getattr(self, name).to_parquet(os.path.join(out_dir, name + '.parquet'))
+        for name in ARRAYS:
+            np.save(os.path.join(out_dir, name + '.npy'), getattr(self, name))
+
+        with open(os.path.join(out_dir, 'columns.json'), 'w') as fp:
+            json.dump(self.columns, fp)
+    # End save()
+
+    @classmethod
+    def load(cls, in_dir):
+        """Read a lookup written by `save()`.
+
+        Parameters
+        ==========
+        * in_dir : str, directory the lookup was saved to
+
+        Returns
+        =======
+        * AdmLookup
+        """
+        lookup = cls.__new__(cls)
+        for name in TABLES:
+            setattr(lookup, name, pd.read_parquet(os.path.join(in_dir, name + '.parquet')))
+        for name in ARRAYS:
+            setattr(lookup, name, np.load(os.path.join(in_dir, name + '.npy'), allow_pickle=False))
+
+        with open(os.path.join(in_dir, 'columns.json')) as fp:
+            lookup.columns = json.load(fp)
+
+        return lookup
+    # End load()
+# End AdmLookup
+
+
+def check_codes(table):
+    """Check that all ADM codes of the lookup are present and whole numbers.
+
+    Parameters
+    ==========
+    * table : DataFrame, lookup CSV content
+
+    Raises
+    ======
+    * ValueError, naming the column and CSV lines with a blank or invalid code
+    """
+    for col in CODE_COLS:
+        if col not in table.columns:
+            raise ValueError("ADM lookup has no {} column".format(col))
+
+        codes = pd.to_numeric(table[col], errors='coerce')
+        bad = codes.isna() | (codes != codes.round())
+        if bad.any():
+            # Line numbers in the CSV file, after the header
+            lines = (np.flatnonzero(bad.to_numpy()) + 2).tolist()
+            raise ValueError("ADM lookup has blank or invalid {} values on line(s) {}{}".format(
+                col, ", ".join(map(str, lines[:10])), " ..." if len(lines) > 10 else ""))
+        # End if
+    # End for
+# End check_codes()
+
+
+def user_cache_dir():
+    """Cache directory of the current user for the ThinkHazard! scripts."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(base, 'thinkhazard')
+# End user_cache_dir()
+
+
+def load_lookup(csv_fn=LOOKUP_CSV, cache_dir=None):
+    """ADM2 lookup, from the cache if the CSV is unchanged.
+
+    Parameters
+    ==========
+    * csv_fn : str, path to the lookup CSV (';' separated)
+    * cache_dir : str, directory to keep the parsed lookup in
+                  (defaults to `user_cache_dir()`)
+
+    Returns
+    =======
+    * AdmLookup
+    """
+    if cache_dir is None:
+        cache_dir = user_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    csv_fn = os.path.abspath(csv_fn)
+    st = os.stat(csv_fn)
+    key = json.dumps([CACHE_VERSION, csv_fn, st.st_size, st.st_mtime_ns])
+
+    # One folder per version of the CSV
+    prefix = '{}_{}_'.format(os.path.splitext(os.path.basename(csv_fn))[0],
+                             hashlib.sha1(csv_fn.encode('utf-8')).hexdigest()[:16])
+    lookup_dir = os.path.join(cache_dir, prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+    if os.path.isdir(lookup_dir):
+        try:
+            return AdmLookup.load(lookup_dir)
+        except (OSError, ValueError):
+            # Incomplete or damaged, parsed again below
+            shutil.rmtree(lookup_dir, ignore_errors=True)
+    # End if
+
+    lookup = AdmLookup(pd.read_csv(csv_fn, encoding='utf-8', delimiter=';'))
+
+    # Written to a temporary folder and renamed, so readers never see a partial cache
+    tmp_dir = tempfile.mkdtemp(prefix=prefix, suffix='.tmp', dir=cache_dir)
+    try:
+        lookup.save(tmp_dir)
+        os.rename(tmp_dir, lookup_dir)
+    except OSError:
+        # Another process stored the same version first, or the cache is not writable
+        pass
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    # End try
+
+    # Drop the folders of older versions of the CSV
+    for old_dir in glob.glob(os.path.join(glob.escape(cache_dir), glob.escape(prefix) + '*')):
+        if (old_dir != lookup_dir) and not old_dir.endswith('.tmp'):
+            shutil.rmtree(old_dir, ignore_errors=True)
+    # End for
+
+    return lookup
+# End load_lookup()
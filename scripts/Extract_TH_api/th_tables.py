@@ -0,0 +1,186 @@
+"""
+Hazard level tables of ThinkHazard! administrative units.
+
+Hazard levels are stored as an ordered categorical (VLO < LOW < MED < HIG),
+so the highest level of a group of units is a plain (vectorised) `max()`.
+Values that are not a known level become missing.
+
+The wide tables hold all hazard types side by side, one column per hazard
+type, for ADM2 units and their ADM1 and ADM0 roll-ups (through the ADM
+hierarchy of `th_lookup.AdmLookup`). They are written as Parquet files
+(with categorical columns dictionary encoded), so a join to the ADM
+shapefiles reads one file per ADM level.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+HAZARD_LEVELS = ['VLO', 'LOW', 'MED', 'HIG']
+LEVEL_DTYPE = pd.CategoricalDtype(HAZARD_LEVELS, ordered=True)
+
+ADM1_COLS = ['ADM1_CODE', 'ADM1_NAME', 'ADM0_CODE', 'ADM0_NAME']
+ADM0_COLS = ['ADM0_CODE', 'ADM0_NAME']
+ADM2_COLS = ['ADM2_CODE', 'ADM2_NAME'] + ADM1_COLS
+
+# Keys of the ADM2 hazard level files (admindiv_hazardsets/<HZ>.json)
+TH_CODE = 'code'
+TH_LEVEL = 'hazard_level'
+
+
+def hazard_levels(values):
+    """Hazard level mnemonics as an ordered categorical.
+
+    Parameters
+    ==========
+    * values : array-like, hazard level mnemonics ('VLO', 'LOW', 'MED', 'HIG')
+
+    Returns
+    =======
+    * Categorical or Series, of dtype `LEVEL_DTYPE`
+    """
+    if isinstance(values, pd.Series):
+        return values.astype(LEVEL_DTYPE)
+
+    return pd.Categorical(values, dtype=LEVEL_DTYPE)
+# End hazard_levels()
+
+
+def max_levels(df, keys, level_col='hazard_level'):
+    """Highest hazard level of each group of units.
+
+    Parameters
+    ==========
+    * df : DataFrame, one row per unit with ordered hazard level column(s)
+    * keys : List[str], columns to group by (e.g. ['hazard'] + ADM1_COLS)
+    * level_col : str or List[str], name(s) of the hazard level column(s)
+
+    Returns
+    =======
+    * DataFrame, with the `keys` columns and the highest level of each
+      `level_col`, sorted by `keys`
+    """
+    return df.groupby(keys, sort=True, observed=True)[level_col].max().reset_index()
+# End max_levels()
+
+
+def code_levels(df, code_dtype='int32'):
+    """Hazard level of each ADM2 code of a hazard level file.
+
+    Parameters
+    ==========
+    * df : DataFrame, ADM2 hazard level file (see `th_fetch.read_hazards()`)
+    * code_dtype : dtype, of the ADM2 codes of the lookup
+
+    Returns
+    =======
+    * Series, of dtype `LEVEL_DTYPE`, indexed by unique ADM2 code. The highest
+      level is kept for codes listed more than once.
+    """
+    levels = hazard_levels(df.set_index(TH_CODE)[TH_LEVEL])
+    levels.index = levels.index.astype(code_dtype)
+    if not levels.index.is_unique:
+        levels = levels.groupby(level=0, sort=False).max()
+
+    return levels
+# End code_levels()
+
+
+def wide_table(lookup, hazard_data):
+    """ADM2 units with the hazard level of each hazard type as a column.
+
+    All hazard types are aligned on ADM2_CODE and joined to the lookup at once.
+    Codes listed more than once in a hazard level file get their highest level.
+
+    Parameters
+    ==========
+    * lookup : AdmLookup, ADM2 lookup (see `th_lookup.load_lookup()`)
+    * hazard_data : dict[str, DataFrame], ADM2 hazard level files by hazard
+                    type (see `th_fetch.read_hazards()`)
+
+    Returns
+    =======
+    * DataFrame, indexed by ADM2_CODE, with the lookup ADM names and codes
+      and one column per hazard type. Units without a hazard level for any of
+      the hazard types are left out.
+    """
+    code_dtype = lookup.adm2.index.dtype
+    levels = pd.concat({code: code_levels(df, code_dtype)
+                        for code, df in hazard_data.items()}, axis=1)
+
+    return lookup.adm2[ADM2_COLS[1:]].join(levels, how='inner')
+# End wide_table()
+
+
+def rollup_levels(lookup, wide, adm_level):
+    """Highest level of every hazard column of a wide table, per ADM1 or ADM0 unit.
+
+    Units are grouped through the hierarchy arrays of the lookup, all hazard
+    columns at once.
+
+    Parameters
+    ==========
+    * lookup : AdmLookup, ADM2 lookup the wide table was built from
+    * wide : DataFrame, wide ADM2 table (see `wide_table()`)
+    * adm_level : int, 1 or 0
+
+    Returns
+    =======
+    * DataFrame, with the `ADM1_COLS` (or `ADM0_COLS`) columns and one column
+      per hazard type, for the units with ADM2 units in `wide`, sorted by code
+    """
+    rows = lookup.positions(wide.index)
+    if adm_level == 1:
+        groups, units = lookup.adm1_idx[rows], lookup.adm1
+    else:
+        groups, units = lookup.adm0_idx[rows], lookup.adm0
+    # End if
+
+    hazards = [col for col in wide.columns if col not in ADM2_COLS]
+    has_units = np.bincount(groups, minlength=len(units)) > 0
+
+    # Level codes are ordered (-1 is missing), so the max code is the max level
+    level_codes = wide[hazards].apply(lambda col: col.cat.codes).to_numpy()
+    max_codes = np.full((len(units), len(hazards)), -1, dtype=level_codes.dtype)
+    np.maximum.at(max_codes, groups, level_codes)
+
+    rollup = units[has_units].reset_index()
+    for i, col in enumerate(hazards):
+        rollup[col] = pd.Categorical.from_codes(max_codes[has_units, i], dtype=LEVEL_DTYPE)
+
+    return rollup
+# End rollup_levels()
+
+
+def write_wide_tables(lookup, hazard_data, out_fn):
+    """Write the wide ADM2 table and its ADM1 and ADM0 roll-ups.
+
+    Parameters
+    ==========
+    * lookup : AdmLookup, ADM2 lookup (see `th_lookup.load_lookup()`)
+    * hazard_data : dict[str, DataFrame], ADM2 hazard level files by hazard type
+    * out_fn : str, output file name, written as `ADMIN<level>_<name>.parquet`
+               for ADM levels 2, 1 and 0 (the extension of `out_fn` is dropped)
+
+    Returns
+    =======
+    * List[str], paths of the files written
+    """
+    out_dir, name = os.path.split(os.path.splitext(out_fn)[0])
+
+    wide = wide_table(lookup, hazard_data)
+    tables = [(2, wide.reset_index()),
+              (1, rollup_levels(lookup, wide, 1)),
+              (0, rollup_levels(lookup, wide, 0))]
+
+    written = []
+    for adm_level, table in tables:
+        fn = os.path.join(out_dir, 'ADMIN{}_{}.parquet'.format(adm_level, name))
+        table.to_parquet(fn, index=False)
+        written.append(fn)
+    # End for
+
+    return written
+# End write_wide_tables()
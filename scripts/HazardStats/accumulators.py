@@ -0,0 +1,307 @@
+"""
+Mergeable per-zone statistic accumulators.
+
+Accumulators are updated one block of pixels at a time and partial results
+(from separate tiles, processes or nodes) can be combined with `merge()`:
+
+- `ZoneMoments` : count, sum, sum of squared deviations, min and max.
+                  Merging is exact.
+- `QuantileSketch` : approximate quantiles with a bounded relative error.
+                     Merging is exact (the merged sketch is identical to one
+                     built from all the values), the error bound is that of
+                     the sketch itself.
+
+All accumulators track `n_zones` zones, indexed 0 to n_zones - 1.
+"""
+
+import math
+
+import numpy as np
+
+
+def segments(labels):
+    """Start positions and zone labels of contiguous runs in sorted labels.
+
+    Parameters
+    ==========
+    * labels : ndarray, sorted zone labels
+
+    Returns
+    =======
+    * Tuple[ndarray, ndarray] : start position of each run, and its label
+    """
+    if labels.size == 0:
+        return np.empty(0, dtype=np.int64), labels
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+
+    return starts, labels[starts]
+# End segments()
+
+
+class ZoneMoments(object):
+    """Running count, sum, sum of squared deviations, min and max per zone.
+
+    The squared deviations from the mean are combined with the pairwise
+    update of Chan et al. (1979), which avoids the cancellation error of
+    a plain sum of squares.
+    """
+
+    def __init__(self, n_zones):
+        self.n_zones = n_zones
+        self.count = np.zeros(n_zones, dtype=np.int64)
+        self.sum = np.zeros(n_zones, dtype=np.float64)
+        self.m2 = np.zeros(n_zones, dtype=np.float64)
+        self.min = np.full(n_zones, np.inf)
+        self.max = np.full(n_zones, -np.inf)
+
+    def update(self, values, labels):
+        """Add a block of valid pixel values.
+
+        Parameters
+        ==========
+        * values : ndarray, valid pixel values (1D)
+        * labels : ndarray, zone index (0 to n_zones - 1) of each value
+        """
+        if values.size == 0:
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.int64)
+
+        order = np.argsort(labels, kind='stable')
+        values = values[order]
+        starts, zone_idx = segments(labels[order])
+        counts = np.diff(np.r_[starts, values.size])
+
+        sums = np.add.reduceat(values, starts)
+        sq_dev = (values - np.repeat(sums / counts, counts)) ** 2
+
+        self._combine(zone_idx, counts, sums,
+                      np.add.reduceat(sq_dev, starts),
+                      np.minimum.reduceat(values, starts),
+                      np.maximum.reduceat(values, starts))
+    # End update()
+
+    def merge(self, other):
+        """Combine with the accumulated results of another `ZoneMoments`.
+
+        Parameters
+        ==========
+        * other : ZoneMoments, tracking the same zones
+        """
+        idx = np.flatnonzero(other.count > 0)
+        self._combine(idx, other.count[idx], other.sum[idx], other.m2[idx],
+                      other.min[idx], other.max[idx])
+    # End merge()
+
+    def grouped(self, groups, n_groups):
+        """Merge zones into groups, e.g. ADM2 units into their ADM1 unit.
+
+        Exact, the result is identical to accumulating the pixels of all
+        zones of a group together.
+
+        Parameters
+        ==========
+        * groups : ndarray, group index (0 to n_groups - 1) of each zone
+        * n_groups : int, number of groups
+
+        Returns
+        =======
+        * ZoneMoments, tracking `n_groups` zones
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        merged = ZoneMoments(n_groups)
+
+        merged.count = np.bincount(groups, self.count, n_groups).astype(np.int64)
+        merged.sum = np.bincount(groups, self.sum, n_groups)
+        np.minimum.at(merged.min, groups, self.min)
+        np.maximum.at(merged.max, groups, self.max)
+
+        # Squared deviations within each zone, plus those of each zone
+        # mean from the group mean
+        has_data = self.count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(has_data, self.sum / self.count
+                             - (merged.sum / merged.count)[groups], 0.0)
+        merged.m2 = np.bincount(groups, self.m2 + self.count * delta ** 2, n_groups)
+
+        return merged
+    # End grouped()
+
+    def _combine(self, idx, count, total, m2, vmin, vmax):
+        n_a = self.count[idx]
+        n = n_a + count
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(n_a > 0, (total / count) - (self.sum[idx] / n_a), 0.0)
+
+        self.m2[idx] += m2 + (delta ** 2) * n_a * count / n
+        self.sum[idx] += total
+        self.count[idx] = n
+        self.min[idx] = np.minimum(self.min[idx], vmin)
+        self.max[idx] = np.maximum(self.max[idx], vmax)
+    # End _combine()
+
+    def result(self):
+        """Per-zone statistics.
+
+        Zones without data are NaN (count is 0).
+
+        Returns
+        =======
+        * dict[str, ndarray] : with keys count, sum, mean, min, max, var,
+                               std and range
+        """
+        has_data = self.count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / self.count
+            var = self.m2 / self.count
+        vmin = np.where(has_data, self.min, np.nan)
+        vmax = np.where(has_data, self.max, np.nan)
+
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': mean,
+            'min': vmin,
+            'max': vmax,
+            'var': var,
+            'std': np.sqrt(var),
+            'range': vmax - vmin,
+        }
+    # End result()
+# End ZoneMoments
+
+
+class QuantileSketch(object):
+    """Per-zone quantile sketch with a bounded relative error.
+
+    Values are counted in logarithmically sized buckets (DDSketch, Masson
+    et al. 2019). A quantile query returns a value within a relative error of
+    `alpha` of the exact value of that rank, i.e. `|estimate - x| <= alpha * |x|`.
+    Values closer to zero than `min_value` are counted as zero.
+
+    Buckets of all zones are kept in a single sorted array of
+    (zone, bucket) keys, so updates and merges are vectorised and the size
+    of the sketch depends on the spread of the data, not on the number of
+    pixels.
+    """
+
+    # Bits of the combined key used for the signed bucket index
+    BUCKET_BITS = 22
+    BUCKET_LIMIT = 2 ** 20
+
+    def __init__(self, n_zones, alpha=0.005, min_value=1e-9):
+        if not 0 < alpha < 1:
+            raise ValueError("alpha has to be between 0 and 1, got {}".format(alpha))
+
+        self.n_zones = n_zones
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _bucket(self, values):
+        """Order preserving signed bucket index of each value (0 is zero)."""
+        mag = np.abs(values)
+        nonzero = mag > self.min_value
+
+        idx = np.ceil(np.log(mag[nonzero]) / self._log_gamma).astype(np.int64)
+        idx = np.clip(idx, 1 - self.BUCKET_LIMIT, self.BUCKET_LIMIT - 1)
+
+        buckets = np.zeros(values.shape, dtype=np.int64)
+        buckets[nonzero] = (idx + self.BUCKET_LIMIT) * np.sign(values[nonzero]).astype(np.int64)
+
+        return buckets
+    # End _bucket()
+
+    def _value(self, buckets):
+        """Representative value of each signed bucket index."""
+        sign = np.sign(buckets)
+        idx = np.abs(buckets) - self.BUCKET_LIMIT
+
+        return np.where(sign == 0, 0.0,
+                        sign * 2.0 * np.power(self.gamma, idx) / (self.gamma + 1))
+    # End _value()
+
+    def _add(self, keys, counts):
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), counts).astype(np.int64)
+    # End _add()
+
+    def update(self, values, labels):
+        """Add a block of valid pixel values.
+
+        Parameters
+        ==========
+        * values : ndarray, valid pixel values (1D)
+        * labels : ndarray, zone index (0 to n_zones - 1) of each value
+        """
+        if values.size == 0:
+            return
+
+        buckets = self._bucket(np.asarray(values, dtype=np.float64))
+        keys = (np.asarray(labels, dtype=np.int64) << self.BUCKET_BITS) \
+            + (buckets + 2 ** (self.BUCKET_BITS - 1))
+
+        keys, counts = np.unique(keys, return_counts=True)
+        self._add(keys, counts.astype(np.int64))
+    # End update()
+
+    def merge(self, other):
+        """Combine with the accumulated buckets of another `QuantileSketch`.
+
+        Parameters
+        ==========
+        * other : QuantileSketch, tracking the same zones with the same alpha
+        """
+        if (other.alpha != self.alpha) or (other.min_value != self.min_value):
+            raise ValueError("Can only merge sketches with identical alpha and min_value")
+
+        self._add(other.keys, other.counts)
+    # End merge()
+
+    def quantile(self, q):
+        """Approximate percentile of each zone.
+
+        Returns the value of rank `floor(q / 100 * (count - 1))` within the
+        stated relative error, i.e. the lower of the two values that
+        `np.percentile` would interpolate between.
+
+        Parameters
+        ==========
+        * q : float, percentile between 0 and 100
+
+        Returns
+        =======
+        * ndarray : per-zone values, NaN for zones without data
+        """
+        res = np.full(self.n_zones, np.nan)
+        if self.keys.size == 0:
+            return res
+
+        zones = self.keys >> self.BUCKET_BITS
+        zone_counts = np.bincount(zones, self.counts, self.n_zones).astype(np.int64)
+        has_data = zone_counts > 0
+
+        # Keys are sorted by zone first, so the cumulative count of all
+        # preceding zones gives the global position of each zone's first value
+        cum = np.cumsum(self.counts)
+        zone_start = np.r_[0, np.cumsum(zone_counts)[:-1]]
+        rank = np.floor((q / 100.0) * (zone_counts - 1)).astype(np.int64)
+
+        pos = np.searchsorted(cum, (zone_start + rank)[has_data], side='right')
+        buckets = (self.keys[pos] & ((1 << self.BUCKET_BITS) - 1)) \
+            - 2 ** (self.BUCKET_BITS - 1)
+        res[has_data] = self._value(buckets)
+
+        return res
+    # End quantile()
+# End QuantileSketch
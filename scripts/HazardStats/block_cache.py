@@ -0,0 +1,112 @@
+"""
+Windowed raster reads through an LRU cache of raster blocks.
+
+Reading the full band of a global raster (and masking it) holds several
+full-size arrays in memory. Instead, the window covering each zone is
+assembled from the blocks of the raster that it overlaps. Blocks are read
+once and kept in a least recently used cache of bounded size, so
+neighbouring zones sharing blocks do not read them again.
+
+Peak memory is the cache budget plus the window of the largest zone.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from rasterio.windows import Window
+
+
+# Blocks of striped (or small-tiled) rasters are grouped into cache blocks
+# of at least this many rows and columns
+MIN_BLOCK_SIZE = 256
+
+
+class BlockCache(object):
+    """Raster band read window by window, caching the blocks read.
+
+    Parameters
+    ==========
+    * ds : rasterio raster object, raster data (kept open by the caller)
+    * max_mem : float, memory budget of the cache in MB
+    * band : int, band to read
+    """
+
+    def __init__(self, ds, max_mem=512, band=1):
+        self.ds = ds
+        self.band = band
+
+        block_h, block_w = ds.block_shapes[band - 1]
+        self.block_h = block_h * max(MIN_BLOCK_SIZE // block_h, 1)
+        self.block_w = block_w * max(MIN_BLOCK_SIZE // block_w, 1)
+
+        self.dtype = np.dtype(ds.dtypes[band - 1])
+        block_bytes = self.block_h * self.block_w * self.dtype.itemsize
+        self.max_blocks = max(int(max_mem * 1024 ** 2) // block_bytes, 1)
+
+        self._blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    # End __init__()
+
+    def _block(self, block_row, block_col):
+        key = (block_row, block_col)
+        if key in self._blocks:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        # End if
+
+        self.misses += 1
+        row = block_row * self.block_h
+        col = block_col * self.block_w
+        window = Window(col, row, min(self.block_w, self.ds.width - col),
+                        min(self.block_h, self.ds.height - row))
+        data = self.ds.read(self.band, window=window)
+
+        self._blocks[key] = data
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+        return data
+    # End _block()
+
+    def read(self, window):
+        """Read a window of the band.
+
+        Parameters
+        ==========
+        * window : rasterio Window, with integer offsets and lengths,
+                   within the raster
+
+        Returns
+        =======
+        * ndarray, 2D
+        """
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        row_end = row_off + int(window.height)
+        col_end = col_off + int(window.width)
+
+        out = np.empty((row_end - row_off, col_end - col_off), dtype=self.dtype)
+        for block_row in range(row_off // self.block_h, (row_end - 1) // self.block_h + 1):
+            top = block_row * self.block_h
+            for block_col in range(col_off // self.block_w, (col_end - 1) // self.block_w + 1):
+                left = block_col * self.block_w
+                data = self._block(block_row, block_col)
+
+                # Overlap of the block and the window, in raster pixels
+                r0, r1 = max(top, row_off), min(top + data.shape[0], row_end)
+                c0, c1 = max(left, col_off), min(left + data.shape[1], col_end)
+                out[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = \
+                    data[r0 - top:r1 - top, c0 - left:c1 - left]
+            # End for
+        # End for
+
+        return out
+    # End read()
+
+    def clear(self):
+        """Drop all cached blocks."""
+        self._blocks.clear()
+    # End clear()
+# End BlockCache
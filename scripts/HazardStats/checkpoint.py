@@ -0,0 +1,179 @@
+"""
+Per-pair checkpoints of HazardStats results.
+
+The records of every (shapefile, raster) pair are stored as soon as they are
+computed, so an interrupted batch can be resumed and re-running a folder only
+computes pairs that are new or whose inputs changed.
+
+A checkpoint is keyed on the content hash of both files and on the
+extraction settings (field, stats, ignore, preprocess and engine). Content
+hashes are remembered together with each file's size and modification time,
+so unchanged files are not hashed again on later runs.
+
+Each checkpoint is stored as two files, so nothing in the checkpoint
+directory is unpickled:
+
+- <key>.parquet : the records of the pair
+- <key>.json : sheet name and comment, written last (a checkpoint without it
+  is incomplete and computed again)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from pixel_cache import SHAPEFILE_PARTS, file_digest
+
+
+SIGNATURES_FN = 'signatures.json'
+
+
+def file_stat(fn):
+    """Total size and latest modification time of a file.
+
+    For shapefiles, all sidecar files (.shx, .dbf, ...) are included.
+
+    Returns
+    =======
+    * List[int], size in bytes and modification time in ns
+    """
+    base, ext = os.path.splitext(fn)
+    if ext.lower() == '.shp':
+        parts = [base + part for part in SHAPEFILE_PARTS if os.path.exists(base + part)]
+    else:
+        parts = [fn]
+
+    stats = [os.stat(part) for part in parts]
+
+    return [sum(st.st_size for st in stats), max(st.st_mtime_ns for st in stats)]
+# End file_stat()
+
+
+def _atomic_write(fn, data):
+    """Write bytes to a file so that readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+
+        os.replace(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    # End try
+# End _atomic_write()
+
+
+class CheckpointStore(object):
+    """Directory of stored (shapefile, raster) results.
+
+    Parameters
+    ==========
+    * ckpt_dir : str, directory to store checkpoints in
+    """
+
+    def __init__(self, ckpt_dir):
+        self.ckpt_dir = ckpt_dir
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+        try:
+            with open(os.path.join(ckpt_dir, SIGNATURES_FN)) as fp:
+                self.signatures = json.load(fp)
+        except (OSError, ValueError):
+            self.signatures = {}
+    # End __init__()
+
+    def digest(self, fn):
+        """Content hash of a file, only recomputed if its size or mtime changed.
+
+        Parameters
+        ==========
+        * fn : str, file path
+
+        Returns
+        =======
+        * str
+        """
+        path = os.path.abspath(fn)
+        stat = file_stat(path)
+
+        known = self.signatures.get(path)
+        if (known is not None) and (known['stat'] == stat):
+            return known['digest']
+
+        digest = file_digest(path)
+        self.signatures[path] = {'stat': stat, 'digest': digest}
+        self._save_signatures()
+
+        return digest
+    # End digest()
+
+    def _save_signatures(self):
+        data = json.dumps(self.signatures, sort_keys=True).encode()
+        _atomic_write(os.path.join(self.ckpt_dir, SIGNATURES_FN), data)
+    # End _save_signatures()
+
+    def key(self, shp_fn, rst_fn, field, stats, ignore, preprocess, engine, options=None):
+        """Checkpoint key of a (shapefile, raster) pair and extraction settings.
+
+        `options` holds any further JSON serializable settings affecting results.
+
+        Returns
+        =======
+        * str
+        """
+        # File names are part of the sheet names and comments stored
+        settings = {
+            'names': [os.path.basename(shp_fn), os.path.basename(rst_fn)],
+            'shp': self.digest(shp_fn),
+            'rst': self.digest(rst_fn),
+            'field': field,
+            'stats': list(stats),
+            'ignore': sorted(map(float, ignore)) if ignore is not None else None,
+            'preprocess': list(preprocess) if preprocess is not None else None,
+            'engine': engine,
+            'options': options,
+        }
+
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+    # End key()
+
+    def load(self, key):
+        """Stored result of a pair.
+
+        Returns
+        =======
+        * Tuple[record array, str, str] : records, sheet name and comment,
+                                          or None if not stored
+        """
+        base = os.path.join(self.ckpt_dir, key)
+        try:
+            with open(base + '.json') as fp:
+                info = json.load(fp)
+            records = pd.read_parquet(base + '.parquet').to_records(index=False)
+        except (OSError, ValueError):
+            return None
+        # End try
+
+        return records, info['sheet_name'], info['comment']
+    # End load()
+
+    def save(self, key, result):
+        """Store the result of a pair.
+
+        Parameters
+        ==========
+        * key : str, checkpoint key (see `key()`)
+        * result : Tuple[record array, str, str], records, sheet name and comment
+        """
+        records, sheet_name, comment = result
+        base = os.path.join(self.ckpt_dir, key)
+
+        _atomic_write(base + '.parquet', pd.DataFrame.from_records(records).to_parquet())
+        info = {'sheet_name': sheet_name, 'comment': comment}
+        _atomic_write(base + '.json', json.dumps(info).encode())
+    # End save()
+# End CheckpointStore
@@ -8,7 +8,8 @@ Script to run zonal statistics on batch rasters.
 
 USAGE
 - Have 1 shapefile to use for zonal extraction and 1 or more raster in a data folder.
-- THE SHAPEFILE AND THE RASTERS MUST ALL BE THE SAME PROJECTED (meters) CRS.
+- THE SHAPEFILE AND THE RASTERS SHOULD BE IN A PROJECTED (meters) CRS.
+  Zones are reprojected on the fly into the CRS of rasters that differ.
 - Run qa_runstats.py and answer the prompt questions. 
   The tool will select autmatically the one shp and all rasters found in the folder. 
   The ouput xlsx is generated in the data folder.
@@ -25,7 +26,17 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 
-from openpyxl import load_workbook
+
+import profiling
+from checkpoint import CheckpointStore
+from masking import valid_mask
+from overviews import OverviewCache, sampling_error
+from pixel_cache import ZonePixelCache
+from reproject import ZoneReprojector, same_crs
+from simplify import ZoneSimplifier, simplification_report
+from spatial_index import RasterFootprints, ZoneIndex
+from zonal import (chunk_zones, cube_result_sets, label_calc_stats,
+                   stack_calc_stats, stream_calc_stats)
 
 try:
     from tqdm import tqdm
@@ -35,26 +46,32 @@ except ImportError:
 import itertools as itools
 from glob import glob
 import os
+import time
 
 
-def filter_geometries(shp, rst):
+def filter_geometries(shp, rst, index=None, predicate='intersects'):
     """Filter geometries to just those that overlay the given raster.
 
+    Zones only partially covered by the raster are kept, statistics are then
+    calculated from the covered part.
+
     Parameters
     ==========
     * shp : GeoPandas DataFrame, shapefile data
     * rst : rasterio raster object, raster data
+    * index : ZoneIndex, spatial index of `shp` to reuse across rasters.
+              Built on the fly if not given.
+    * predicate : str, 'intersects' to keep all overlapping zones, or
+                  'within' to keep only zones entirely inside the raster bounds
 
     Returns
     =======
-    * GeoPandas DataFrame of geometries inside raster bounds
+    * GeoPandas DataFrame of geometries overlaying raster bounds
     """
-    # Filter shapefile to geometries inside raster bounds
-    minx, miny, maxx, maxy = rst.bounds
-    bound_box = shapely.geometry.Polygon([(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny)])
-    relevant_geoms = shp[shp.geometry.within(bound_box)]
+    if index is None:
+        index = ZoneIndex(shp)
 
-    return relevant_geoms
+    return index.query(rst.bounds, predicate)
 # End filter_geometries()
 
 
@@ -72,18 +89,18 @@ def mp_calc_stats(in_data, preprocess=None):
     """
     (row, field, ds, stats, ignore, result_set) = in_data
 
-    clip, out_transform = mask(ds, [row.geometry], crop=True)
-    clip = np.extract(clip != ds.nodata, clip)
-
-    if clip.size == 0:
-        # No data to process...
+    try:
+        with profiling.stage('mask'):
+            clip, out_transform = mask(ds, [row.geometry], crop=True)
+    except ValueError:
+        # Geometry only touches the raster edge
         return
 
-    if ignore is not None:
-        for ig in ignore:
-            clip = np.extract(~np.isclose(clip, ig), clip)
-        # End for
-    # End if
+    profiling.add('mask', clip.nbytes, clip.size)
+
+    # Single combined mask of nodata, NaN and ignored values,
+    # valid values are then selected once
+    clip = clip[valid_mask(clip, ds.nodata, ignore)]
 
     if clip.size == 0:
         # No data to process...
@@ -93,19 +110,15 @@ def mp_calc_stats(in_data, preprocess=None):
     if run_range:
         stats = [i for i in stats[:] if i != 'range']
 
-    # Early exit if everything is NaN
-    if np.isnan(clip).all():
-        return
-
     # Apply preprocess if necessary
     if preprocess:
         kind, value = preprocess
         if kind == 'SD':
             sd = clip.std()
             avg = clip.mean()
-            min_thres = (clip >= (avg - (sd * value)))
-            max_thres = (clip <= (avg + (sd * value)))
-            clip = clip[min_thres & max_thres]
+            keep = (clip >= (avg - (sd * value)))
+            keep &= (clip <= (avg + (sd * value)))
+            clip = clip[keep]
         elif kind == 'PC':
             p_threshold = np.percentile(clip, value)
             clip = clip[clip <= p_threshold]
@@ -113,7 +126,9 @@ def mp_calc_stats(in_data, preprocess=None):
     # End if
     
     del ds
-    res = {func: float(getattr(np, func)(clip)) for func in stats}
+    with profiling.stage('stats'):
+        res = {func: float(getattr(np, func)(clip)) for func in stats}
+    profiling.add('stats', pixels=clip.size)
     res['count'] = clip.size
 
     if run_range:
@@ -139,21 +154,23 @@ def matching_crs(rst, shp_data):
     * Tuple[bool, str] : (True/False indicating CRS match, 
                           and str for failure)
     """
-    # Both vector and raster files have to have matching CRS
-    shp_str = shp_data.crs['init']
+    if (rst.crs is None) or (shp_data.crs is None):
+        issue = "Issues:"
+        issue += " Shapefile or raster has no CRS."
+        issue += " shpfile: {}, raster: {}".format(shp_data.crs, rst.crs)
 
-    rst_crs = rst.crs
-    rst_str = rst_crs.to_string()
-    
-    pyCRS = pyproj.crs.CRS
-    rst_epsg = pyCRS.from_user_input(rst_str).to_epsg()
-    shp_epsg = pyCRS.from_user_input(shp_str).to_epsg()
-    crs_no_match = rst_epsg != shp_epsg
+        return (False, issue)
+    # End if
 
-    if crs_no_match:
+    # Both vector and raster files have to have matching CRS
+    if not same_crs(rst.crs, shp_data.crs):
         # CRS does not match
+        pyCRS = pyproj.crs.CRS
+        rst_epsg = pyCRS.from_user_input(rst.crs.to_wkt()).to_epsg()
+        shp_epsg = shp_data.crs.to_epsg()
+
         issue = "Issues:"
-        issue += " Shapefile and raster have differing EPSG."
+        issue += " Shapefile and raster have differing CRS."
         issue += " shpfile: {}, raster: {}".format(shp_epsg, rst_epsg)
         
         return (False, issue)
@@ -172,27 +189,22 @@ def write_to_excel(output_fn, results):
     * results : dict[tuple], of statistic in 
                 (geopandas df, sheet_name (str), comment (str))
     """
-    try:
-        book = load_workbook(output_fn)
-        mode = 'a'
-    except FileNotFoundError:
-        book = None
-        mode = 'w'
+    if os.path.exists(output_fn):
+        # Replace sheets of the same name, keep all others
+        kwargs = {'mode': 'a', 'if_sheet_exists': 'replace'}
+    else:
+        kwargs = {'mode': 'w'}
 
     # Write out data to excel file
-    with pd.ExcelWriter(output_fn, engine='openpyxl', mode=mode) as writer:
-        if book is not None:
-            writer.book = book
-            writer.sheets = {ws.title: ws for ws in book.worksheets}
-
+    with pd.ExcelWriter(output_fn, engine='openpyxl', **kwargs) as writer:
         # data, sheet_name, comment, msg=''
         for data, sheet, comment in results.values():
             # write out data first
             if data is not None:
-                data.to_excel(writer, sheet, startrow=2, index=False)
+                data.to_excel(writer, sheet_name=sheet, startrow=2, index=False)
             else:
                 df = pd.DataFrame()
-                df.to_excel(writer, sheet, startrow=2)
+                df.to_excel(writer, sheet_name=sheet, startrow=2)
 
             if comment != '':
                 # then add comment (sheet has to exist first, hence the write out above)
@@ -203,7 +215,469 @@ def write_to_excel(output_fn, results):
 # End write_to_excel()
 
 
-def extract_stats(shp_files, rasters, field, stats, ignore=None, preprocess=None):
+def calc_zone_stats(zones, field, ds, stats, ignore=None, preprocess=None,
+                    engine='mask', max_mem=512, cache=None):
+    """Calculate statistics for the given zones with the selected engine.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster data
+    * stats : List[str], of statistics to calculate.
+    * ignore : List[float], of values to ignore.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+    * engine : str, one of 'mask', 'label' or 'stream' (see `extract_stats`)
+    * max_mem : float, memory budget in MB for each window read by the 'stream' engine
+    * cache : ZonePixelCache, zone pixel cache used by the 'label' engine
+
+    Returns
+    =======
+    * dict[Any, dict] : zone id to dict of statistic results
+    """
+    if engine == 'label':
+        return label_calc_stats(zones, field, ds, stats, ignore, preprocess,
+                                cache)
+    elif engine == 'stream':
+        return stream_calc_stats(zones, field, ds, stats, ignore, preprocess,
+                                 max_mem)
+    # End if
+
+    try:
+        # Set msg for progress bar if available
+        _loop = tqdm(zones.itertuples())
+    except NameError:
+        _loop = zones.itertuples()
+
+    result_set = {}
+    time_zones = profiling.zone_timing()
+    for row in _loop:
+        start = time.perf_counter()
+        mp_calc_stats((row, field, ds, stats, ignore, result_set), preprocess)
+
+        if time_zones:
+            profiling.record_zone(time.perf_counter() - start, getattr(row, field))
+    # End for
+
+    return result_set
+# End calc_zone_stats()
+
+
+def calc_group_stats(zones, field, datasets, stats, ignore=None, preprocess=None,
+                     engine='mask', max_mem=512, cache=None):
+    """Calculate statistics for the given zones on one or more rasters.
+
+    Several rasters are only processed together when they share the same
+    grid and the 'label' engine is used: zones are then labelled once and
+    the same window is read from every raster (see `zonal.stack_calc_stats`).
+
+    Parameters
+    ==========
+    * datasets : List[rasterio raster object], rasters to process
+    * others : see `calc_zone_stats`
+
+    Returns
+    =======
+    * List[dict[Any, dict]] : zone id to dict of statistic results, per raster
+    """
+    if (engine == 'label') and (len(datasets) > 1):
+        ids, cube, calc = stack_calc_stats(zones, field, datasets, stats, ignore,
+                                           preprocess, cache)
+        return cube_result_sets(ids, cube, calc, stats)
+    # End if
+
+    return [calc_zone_stats(zones, field, ds, stats, ignore, preprocess,
+                            engine, max_mem, cache)
+            for ds in datasets]
+# End calc_group_stats()
+
+
+def calc_chunk_stats(rst_fns, zones, field, stats, ignore=None, preprocess=None,
+                     engine='mask', max_mem=512, cache=None, profile=None):
+    """Calculate statistics for a chunk of zones in a worker process.
+
+    Each worker opens the rasters itself and only reads the windows
+    covering its own zones.
+
+    Parameters
+    ==========
+    * profile : tuple, (profile directory, number of slowest zones to track,
+                shapefile path) to record stages of this worker, or None
+
+    Returns
+    =======
+    * List[dict[Any, dict]] : zone id to dict of statistic results, per raster
+    """
+    activated = False
+    if profile is not None:
+        profile_dir, profile_zones, shp_fn = profile
+        activated = profiling.enable(profile_dir, profile_zones)
+        profiling.set_context(shp_fn, rst_fns[0])
+    # End if
+
+    datasets = [rasterio.open(rst_fn) for rst_fn in rst_fns]
+    try:
+        return calc_group_stats(zones, field, datasets, stats, ignore, preprocess,
+                                engine, max_mem, cache)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+        profiling.flush()
+        if activated:
+            profiling.disable()
+# End calc_chunk_stats()
+
+
+def parallel_calc_stats(pool, ncores, zones, field, rst_fns, stats, ignore=None,
+                        preprocess=None, engine='mask', max_mem=512, cache=None,
+                        profile=None):
+    """Calculate statistics for spatially coherent chunks of zones in parallel.
+
+    Parameters
+    ==========
+    * pool : multiprocess Pool, to run the chunks in
+    * ncores : int, number of processes in the pool
+    * zones : GeoPandas DataFrame, zones overlaying the rasters
+    * rst_fns : List[str], paths to the raster files (see `calc_group_stats`)
+    * profile : tuple, see `calc_chunk_stats`
+    * others : see `calc_zone_stats`
+
+    Returns
+    =======
+    * List[dict[Any, dict]] : zone id to dict of statistic results, per raster
+    """
+    # Use more chunks than cores so that uneven chunks even out
+    chunks = chunk_zones(zones, field, ncores * 4)
+    args = [(rst_fns, chunk, field, stats, ignore, preprocess, engine, max_mem, cache,
+             profile)
+            for chunk in chunks]
+
+    result_sets = [{} for _ in rst_fns]
+    for chunk_sets in pool.starmap(calc_chunk_stats, args):
+        for result_set, res in zip(result_sets, chunk_sets):
+            result_set.update(res)
+    # End for
+
+    return result_sets
+# End parallel_calc_stats()
+
+
+def add_sampling_error(result_set, zone_areas, pixel_area, keep_std=True):
+    """Add error estimates of statistics computed at an overview level.
+
+    Adds 'approx_frac' and 'approx_se' to the results of every zone
+    (see `overviews.sampling_error`).
+
+    Parameters
+    ==========
+    * result_set : dict[Any, dict], zone id to dict of statistic results
+    * zone_areas : Pandas Series, area of each zone (raster CRS) by zone id
+    * pixel_area : float, area of a full resolution pixel (raster CRS)
+    * keep_std : bool, keep the standard deviation in the results
+    """
+    for zone_id, res in result_set.items():
+        std = res['std'] if keep_std else res.pop('std')
+        frac, se = sampling_error(res['count'], std, zone_areas.get(zone_id, 0.0),
+                                  pixel_area)
+        res['approx_frac'] = float(frac)
+        res['approx_se'] = float(se)
+    # End for
+# End add_sampling_error()
+
+
+def stat_records(result_set, field):
+    """Convert a result set into a compact record array keyed by zone id.
+
+    Parameters
+    ==========
+    * result_set : dict[Any, dict], zone id to dict of statistic results
+    * field : str, name of column to use as primary id.
+
+    Returns
+    =======
+    * numpy record array, with `field` as first column followed by the statistics
+    """
+    stat_results = pd.DataFrame.from_dict(result_set, orient='index')
+    stat_results.index.name = field
+
+    return stat_results.reset_index().to_records(index=False)
+# End stat_records()
+
+
+def extract_stat_records(shp_files, rasters, field, stats, ignore=None, preprocess=None,
+                         engine='mask', max_mem=512, ncores=1, cache_dir=None,
+                         stacked=False, checkpoint_dir=None, densify=None,
+                         simplify=None, simplify_report=False, profile_dir=None,
+                         profile_zones=0, approx=None, approx_dir=None):
+    """Extract statistics from rasters as compact per-zone record arrays.
+
+    Same parameters as `extract_stats`, but geometries are not merged back in,
+    keeping results small enough to return cheaply from worker processes.
+
+    Returns
+    =======
+    * dict[tuple], of (record array or None, sheet_name (str), comment (str))
+                   keyed by (shapefile, raster)
+    """
+    if engine not in ('mask', 'label', 'stream'):
+        raise ValueError("Unknown engine: {}".format(engine))
+
+    # Disabled again at the end, unless the caller enabled it already
+    activated = (profile_dir is not None) and profiling.enable(profile_dir, profile_zones)
+
+    # Started with the first pair that is not checkpointed
+    pool = None
+    datasets = []
+    try:
+        # Raster bounds are indexed once, zones are indexed once per shapefile
+        footprints = RasterFootprints(rasters)
+
+        if stacked and (engine == 'label'):
+            raster_groups = footprints.grid_groups()
+        else:
+            raster_groups = [[rst_fn] for rst_fn in rasters]
+
+        all_combinations = itools.product(*[shp_files, raster_groups])
+
+        checkpoints = CheckpointStore(checkpoint_dir) if checkpoint_dir is not None else None
+
+        # Settings changing the zone geometries used
+        zone_opts = {'densify': densify, 'simplify': simplify}
+        ckpt_opts = dict(zone_opts, approx=approx)
+
+        overviews = None
+        calc_stats = stats
+        if approx is not None:
+            overviews = OverviewCache(approx, approx_dir)
+
+            # The standard error of the mean needs the standard deviation
+            if 'std' not in stats:
+                calc_stats = list(stats) + ['std']
+        # End if
+
+        results = {}
+        shp_cache = {}
+        for shp_fn, rst_group in all_combinations:
+            ckpt_keys = {}
+            if checkpoints is not None:
+                # Reuse stored results of unchanged pairs
+                pending = []
+                for rst_fn in rst_group:
+                    key = checkpoints.key(shp_fn, rst_fn, field, stats, ignore,
+                                          preprocess, engine, ckpt_opts)
+                    stored = checkpoints.load(key)
+                    if stored is not None:
+                        results[(shp_fn, rst_fn)] = stored
+                    else:
+                        ckpt_keys[rst_fn] = key
+                        pending.append(rst_fn)
+                # End for
+
+                rst_group = pending
+                if len(rst_group) == 0:
+                    continue
+            # End if
+
+            if shp_fn in shp_cache:
+                shp, reprojector, dispatch_cache, pixel_cache = shp_cache[shp_fn]
+            else:
+                shp_cache = {}  # clear cache
+                with profiling.stage('read_shapefile'):
+                    shp = gpd.read_file(shp_fn)
+                reprojector = ZoneReprojector(shp, densify)
+                dispatch_cache = {}
+
+                pixel_cache = None
+                if (cache_dir is not None) and (engine == 'label'):
+                    pixel_cache = ZonePixelCache(cache_dir, shp_fn, variant=zone_opts)
+
+                shp_cache[shp_fn] = shp, reprojector, dispatch_cache, pixel_cache
+            # End if
+
+            shp_name = os.path.basename(shp_fn)
+
+            rst_fns = []
+            rst_paths = []
+            pixel_areas = []
+            datasets = []
+            for rst_fn in rst_group:
+                rst_path = rst_fn
+                if overviews is not None:
+                    # Statistics are computed from the reduced copy
+                    with profiling.stage('overviews'):
+                        rst_path = overviews.path(rst_fn)
+                    with rasterio.open(rst_fn) as src:
+                        pixel_areas.append(abs(src.res[0] * src.res[1]))
+                # End if
+
+                ds = rasterio.open(rst_path)
+                datasets.append(ds)
+                sheet_name = os.path.basename(rst_fn)
+
+                # Zones are reprojected into the raster CRS when they differ,
+                # which is only impossible if either CRS is undefined
+                if (ds.crs is None) or (shp.crs is None):
+                    _, issue = matching_crs(ds, shp)
+                    cmt = "Could not process {} with {}.\n{}"\
+                            .format(sheet_name, shp_name, issue)
+                    results[(shp_fn, rst_fn)] = None, sheet_name, cmt
+                    datasets.pop().close()
+                    continue
+                # End if
+
+                rst_fns.append(rst_fn)
+                rst_paths.append(rst_path)
+            # End for
+
+            if len(datasets) == 0:
+                continue
+
+            # Rasters in a group share the same CRS
+            rst_crs = datasets[0].crs
+            crs_key = rst_crs.to_wkt()
+            if crs_key not in dispatch_cache:
+                with profiling.stage('dispatch_zones'):
+                    zones = reprojector.to(rst_crs)
+                    simplifier = ZoneSimplifier(zones, simplify) if simplify is not None else None
+                    dispatch_cache[crs_key] = (zones, footprints.dispatch(ZoneIndex(zones)),
+                                               simplifier)
+            # End if
+            zones, dispatched, simplifier = dispatch_cache[crs_key]
+            reprojected = zones is not shp
+
+            # Only the zones overlaying the raster footprint
+            # (identical for all rasters in a group)
+            positions = dispatched.get(rst_fns[0], [])
+            relevant_geoms = zones.iloc[positions]
+
+            simplify_cmt = ''
+            if simplifier is not None:
+                with profiling.stage('simplify'):
+                    simplified = simplifier.for_raster(datasets[0]).iloc[positions]
+                simplify_cmt = "\n# Zones simplified to {} pixel".format(simplify)
+                if simplify_report:
+                    n_diff, n_px = simplification_report(relevant_geoms, simplified,
+                                                         field, datasets[0])
+                    simplify_cmt += ", {} of {} pixels ({:.3f}%) changed zone"\
+                                    .format(n_diff, n_px, 100.0 * n_diff / max(n_px, 1))
+                # End if
+
+                relevant_geoms = simplified
+            # End if
+
+            profiling.set_context(shp_fn, rst_fns[0])
+            if ncores > 1:
+                if pool is None:
+                    import multiprocess as mp
+                    pool = mp.Pool(processes=ncores)
+
+                profile = None
+                if profile_dir is not None:
+                    profile = (profile_dir, profile_zones, shp_fn)
+
+                result_sets = parallel_calc_stats(pool, ncores, relevant_geoms, field,
+                                                  rst_paths, calc_stats, ignore, preprocess,
+                                                  engine, max_mem, pixel_cache, profile)
+            else:
+                result_sets = calc_group_stats(relevant_geoms, field, datasets, calc_stats,
+                                               ignore, preprocess, engine, max_mem,
+                                               pixel_cache)
+            # End if
+
+            if overviews is not None:
+                zone_areas = relevant_geoms.geometry.area.groupby(relevant_geoms[field]).sum()
+                for pixel_area, result_set in zip(pixel_areas, result_sets):
+                    add_sampling_error(result_set, zone_areas, pixel_area, 'std' in stats)
+            # End if
+
+            for rst_fn, result_set in zip(rst_fns, result_sets):
+                sheet_name = os.path.basename(rst_fn)
+                comment = "# Extracted from {} using {}".format(sheet_name,
+                                                                shp_name)
+                if preprocess is not None:
+                    comment += "\n# Preprocessed using {} : {}".format(*preprocess)
+                if reprojected:
+                    comment += "\n# Zones reprojected to {}".format(rst_crs.to_string())
+                comment += simplify_cmt
+                if overviews is not None:
+                    comment += "\n# Approximate: overview level {} (about 1/{} of pixels)"\
+                               .format(approx, 4 ** approx)
+
+                results[(shp_fn, rst_fn)] = stat_records(result_set, field), sheet_name, comment
+
+                if rst_fn in ckpt_keys:
+                    checkpoints.save(ckpt_keys[rst_fn], results[(shp_fn, rst_fn)])
+            # End for
+
+            for ds in datasets:
+                ds.close()
+            datasets = []
+        # End for
+
+        profiling.flush()
+    finally:
+        # Also on errors, so that no raster stays open and no worker process
+        # is left behind
+        for ds in datasets:
+            ds.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if activated:
+            profiling.disable()
+    # End try
+
+    # Keep results in input order, one sheet per raster
+    return {key: results[key]
+            for key in itools.product(*[shp_files, rasters])
+            if key in results}
+# End extract_stat_records()
+
+
+def merge_stat_records(record_results, field):
+    """Join per-zone statistic records back onto the shapefile geometries.
+
+    Each shapefile is read once, however many rasters it was used with.
+
+    Parameters
+    ==========
+    * record_results : dict[tuple], as returned by `extract_stat_records`
+    * field : str, name of column to use as primary id.
+
+    Returns
+    =======
+    * dict[tuple], of (geopandas df or None, sheet_name (str), comment (str))
+    """
+    results = {}
+    shp_cache = {}
+    for (shp_fn, rst_fn), (records, sheet_name, comment) in record_results.items():
+        if records is None:
+            results[(shp_fn, rst_fn)] = None, sheet_name, comment
+            continue
+
+        if shp_fn not in shp_cache:
+            shp_cache = {}  # clear cache
+            with profiling.stage('read_shapefile'):
+                shp_cache[shp_fn] = gpd.read_file(shp_fn)
+
+        with profiling.stage('merge'):
+            stat_results = pd.DataFrame.from_records(records)
+            if stat_results.empty:
+                stat_results = pd.DataFrame(columns=[field])
+
+            res_shp = shp_cache[shp_fn].merge(stat_results, on=field)
+        results[(shp_fn, rst_fn)] = res_shp, sheet_name, comment
+    # End for
+
+    return results
+# End merge_stat_records()
+
+
+def extract_stats(shp_files, rasters, field, stats, ignore=None, preprocess=None,
+                  engine='mask', max_mem=512, ncores=1, cache_dir=None,
+                  stacked=False, checkpoint_dir=None, densify=None,
+                  simplify=None, simplify_report=False, approx=None, approx_dir=None):
     """Extract statistics from a raster using a shapefile.
 
     Writes results to the specified output file.
@@ -216,64 +690,100 @@ def extract_stats(shp_files, rasters, field, stats, ignore=None, preprocess=None
     * stats : List[str], of statistics to calculate. 
               Numpy compatible method names only.
     * ignore : List[float], of values to ignore.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+    * engine : str, method used to calculate zonal statistics.
+               'mask' : mask the raster once per zone (see `mp_calc_stats`)
+               'label' : burn all zones into a single label grid and calculate
+                         statistics for all zones in one pass (see `zonal.py`)
+               'stream' : as 'label', but walk the raster in block-aligned windows
+                          so rasters larger than memory can be processed
+    * max_mem : float, memory budget in MB for each window read by the 'stream' engine
+    * ncores : int, number of processes to use. Zones are split into spatially
+               coherent chunks which are processed in parallel for each raster.
+    * cache_dir : str, directory to cache the pixels of each zone in, so that
+                  rasters sharing a grid skip rasterization ('label' engine only)
+    * stacked : bool, process rasters sharing the same grid together, labelling
+                zones and computing windows once for all of them ('label' engine only).
+                Results are still given per raster.
+    * checkpoint_dir : str, directory to store the result of each shapefile/raster
+                       pair in as soon as it is computed. Pairs whose files and
+                       settings are unchanged are loaded instead of recomputed.
+    * densify : float, maximum segment length (in shapefile CRS units) zones are
+                densified to before being reprojected into the CRS of a raster.
+                Zones are only reprojected for rasters in a different CRS.
+    * simplify : float, simplify zones to this fraction of the raster pixel size
+                 before rasterizing them (see `simplify.py`). None to disable.
+    * simplify_report : bool, count the pixels changing zone due to simplification
+                        and report them in the comment (rasterizes zones twice)
+    * approx : int, compute approximate statistics from the rasters reduced to
+               this overview level (see `overviews.py`), adding the error
+               estimates 'approx_frac' and 'approx_se' for every zone.
+               None for full resolution.
+    * approx_dir : str, directory to cache reduced rasters in
     """
-    all_combinations = itools.product(*[shp_files, rasters])
+    record_results = extract_stat_records(shp_files, rasters, field, stats, ignore,
+                                          preprocess, engine, max_mem, ncores,
+                                          cache_dir, stacked, checkpoint_dir, densify,
+                                          simplify, simplify_report,
+                                          approx=approx, approx_dir=approx_dir)
 
-    results = {}
-    shp_cache = {}
-    for shp_fn, rst_fn in all_combinations:
-        if shp_fn in shp_cache:
-            shp = shp_cache[shp_fn].copy()
-        else:
-            shp_cache = {}  # clear cache
-            shp = gpd.read_file(shp_fn)
-            shp_cache[shp_fn] = shp.copy()
-        # End if
-        
-        ds = rasterio.open(rst_fn)
+    return merge_stat_records(record_results, field)
+# End extract_stats()
 
-        sheet_name = os.path.basename(rst_fn)
-        shp_name = os.path.basename(shp_fn)
 
-        crs_matches, issue = matching_crs(ds, shp)
-        if not crs_matches:
-            cmt = "Could not process {} with {}.\n{}"\
-                    .format(sheet_name, shp_name, issue)
-            results[(shp_fn, rst_fn)] = None, sheet_name, cmt
-            continue
-        # End if
+def profile_slowest_zones(slow_zones, field, stats, ignore=None, preprocess=None,
+                          dump_fn='slowest_zones.prof'):
+    """Run the slowest zones of a profiled run again under cProfile.
 
-        # Filter shapefile to geometries inside raster bounds
-        relevant_geoms = filter_geometries(shp, ds)
+    Zones are processed one by one with the 'mask' engine, as when they
+    were timed.
 
-        try:
-            # Set msg for progress bar if available
-            _loop = tqdm(relevant_geoms.itertuples())
-        except NameError:
-            _loop = relevant_geoms.itertuples()
+    Parameters
+    ==========
+    * slow_zones : List[dict], with shapefile, raster and zone id (as str),
+                   as returned by `profiling.collect`
+    * field : str, name of column used as primary id.
+    * stats, ignore, preprocess : see `extract_stats`
+    * dump_fn : str, file to write the cProfile statistics to
+                (open with `pstats` or snakeviz)
+    """
+    import cProfile
 
-        result_set = {}
-        for row in _loop:
-            mp_calc_stats((row, field, ds, stats, ignore, result_set), preprocess)
-        # End for
+    prof = cProfile.Profile()
+    slow_zones = sorted(slow_zones, key=lambda z: (z['shapefile'], z['raster']))
+    for (shp_fn, rst_fn), group in itools.groupby(slow_zones,
+                                                  key=lambda z: (z['shapefile'], z['raster'])):
+        zone_ids = [z['zone'] for z in group]
 
-        stat_results = pd.DataFrame.from_dict(result_set, orient='index')
-        stat_results[field] = stat_results.index
+        shp = gpd.read_file(shp_fn)
+        shp = shp[shp[field].astype(str).isin(zone_ids)]
 
-        res_shp = shp.merge(stat_results, on=field)
-        comment = "# Extracted from {} using {}".format(sheet_name,
-                                                        shp_name)
-        if preprocess is not None:
-            comment += "\n# Preprocessed using {} : {}".format(*preprocess)
+        with rasterio.open(rst_fn) as ds:
+            zones = ZoneReprojector(shp).to(ds.crs)
 
-        results[(shp_fn, rst_fn)] = res_shp, sheet_name, comment
+            prof.enable()
+            calc_zone_stats(zones, field, ds, stats, ignore, preprocess)
+            prof.disable()
+        # End with
     # End for
 
-    return results
-# End extract_stats()
+    prof.dump_stats(dump_fn)
+# End profile_slowest_zones()
 
 
-def apply_extract(d, shp, rst, field, stats, ignore=None, preprocess=None):
-    from hazardstat import extract_stats
-    d.update(extract_stats([shp], [rst], field, stats, ignore, preprocess))
-    
\ No newline at end of file
+def apply_extract(shp, rst, field, stats, ignore=None, preprocess=None,
+                  engine='mask', max_mem=512, cache_dir=None, checkpoint_dir=None,
+                  densify=None, simplify=None, simplify_report=False, profile_dir=None,
+                  profile_zones=0, approx=None, approx_dir=None):
+    """Extract statistic records for a single shapefile and raster.
+
+    Used by worker processes. Returns compact per-zone records rather than
+    GeoDataFrames so that only the statistics are sent back to the parent.
+    """
+    return extract_stat_records([shp], [rst], field, stats, ignore, preprocess,
+                                engine, max_mem, cache_dir=cache_dir,
+                                checkpoint_dir=checkpoint_dir, densify=densify,
+                                simplify=simplify, simplify_report=simplify_report,
+                                profile_dir=profile_dir, profile_zones=profile_zones,
+                                approx=approx, approx_dir=approx_dir)
+# End apply_extract()
@@ -0,0 +1,86 @@
+"""
+Single-pass masking of unusable raster values.
+
+Builds one boolean mask excluding nodata, NaN and any number of ignored
+values (compared with a tolerance, as `np.isclose`). The mask is built in
+place with boolean scratch buffers reused for every ignored value, instead of a
+fresh filtered copy of the data per condition. Callers then select the valid
+values once (or pass the mask on), and all statistics reuse that selection.
+
+Shared by HazardStats, SanityCheck and zonalstats-netcdf.
+"""
+
+import numpy as np
+
+
+# Default tolerances of `np.isclose`
+RTOL = 1e-05
+ATOL = 1e-08
+
+
+def valid_mask(data, nodata=None, ignore=None, within=None, rtol=RTOL, atol=ATOL):
+    """Boolean mask of usable values.
+
+    A value is usable if it is not the nodata value, not NaN and not close to
+    any of the ignored values: `|value - ignored| <= atol + rtol * |ignored|`.
+
+    Parameters
+    ==========
+    * data : ndarray, raster values
+    * nodata : float, nodata value (None if not set)
+    * ignore : List[float], of values to ignore.
+    * within : ndarray of bool, values to consider at all (e.g. pixels inside
+               a zone), same shape as `data`. Updated in place and returned.
+    * rtol, atol : float, relative and absolute tolerance for ignored values
+
+    Returns
+    =======
+    * ndarray of bool
+    """
+    if within is None:
+        valid = np.ones(data.shape, dtype=bool)
+    else:
+        valid = within
+
+    scratch = np.empty(data.shape, dtype=bool)
+
+    if (nodata is not None) and (not np.isnan(nodata)):
+        np.not_equal(data, nodata, out=scratch)
+        valid &= scratch
+
+    is_float = np.issubdtype(data.dtype, np.floating)
+    if is_float:
+        np.isnan(data, out=scratch)
+        np.logical_not(scratch, out=scratch)
+        valid &= scratch
+    # End if
+
+    if ignore is not None and len(ignore) > 0:
+        outside = np.empty(data.shape, dtype=bool)
+        for ig in ignore:
+            # |data - ig| > tolerance, as two comparisons without temporaries
+            tol = atol + rtol * abs(ig)
+            np.greater(data, ig + tol, out=scratch)
+            np.less(data, ig - tol, out=outside)
+            scratch |= outside
+            valid &= scratch
+        # End for
+    # End if
+
+    return valid
+# End valid_mask()
+
+
+def valid_values(data, nodata=None, ignore=None, rtol=RTOL, atol=ATOL):
+    """Usable values of an array as a flat array (a single copy).
+
+    Parameters
+    ==========
+    * see `valid_mask`
+
+    Returns
+    =======
+    * ndarray, 1D
+    """
+    return data[valid_mask(data, nodata, ignore, rtol=rtol, atol=atol)]
+# End valid_values()
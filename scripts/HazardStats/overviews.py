@@ -0,0 +1,194 @@
+"""
+Reduced resolution copies of rasters for quick, approximate statistics.
+
+At overview level L every 2^L x 2^L block of pixels is represented by a
+single pixel (nearest neighbour sampling), so statistics are computed from
+roughly 1 / 4^L of the pixels. This is meant for previewing a run and
+catching bad rasters before spending time on the full resolution data.
+
+Rasters are decimated through GDAL, which reads from the internal or external
+(.ovr) overviews of a raster when it has them and samples the full resolution
+data otherwise. The reduced copy is written once to a cache directory as a
+tiled GeoTIFF and reused as long as the source raster is unchanged (same
+size and modification time). Source rasters are never modified. By default
+the cache is kept in the user's cache directory (`~/.cache/hazardstats`, or
+`%LOCALAPPDATA%\\hazardstats` on Windows), which other users cannot write to.
+
+Each zone gets two error estimates:
+
+- approx_frac : fraction of the full resolution pixels covered by the zone
+                that were sampled (with valid data). Small zones may be
+                sampled by very few or no pixels at all.
+- approx_se : standard error of the mean of the sampled values
+"""
+
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from checkpoint import file_stat
+
+
+# Rows of the reduced raster written at a time
+BLOCK_ROWS = 256
+
+
+def overview_shape(width, height, level):
+    """Size of a raster at an overview level.
+
+    Parameters
+    ==========
+    * width, height : int, size of the full resolution raster
+    * level : int, overview level (pixels are reduced by 2^level on each axis)
+
+    Returns
+    =======
+    * Tuple[int, int], width and height
+    """
+    factor = 2 ** level
+
+    return max(int(math.ceil(width / factor)), 1), max(int(math.ceil(height / factor)), 1)
+# End overview_shape()
+
+
+def user_cache_dir():
+    """Cache directory of the current user for HazardStats."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(base, 'hazardstats')
+# End user_cache_dir()
+
+
+def build_overview(rst_fn, out_fn, level):
+    """Write a reduced resolution copy of a raster, covering the same extent.
+
+    Parameters
+    ==========
+    * rst_fn : str, path to the full resolution raster
+    * out_fn : str, path of the GeoTIFF to write
+    * level : int, overview level
+    """
+    with rasterio.open(rst_fn) as src:
+        width, height = overview_shape(src.width, src.height, level)
+        scale_x = src.width / width
+        scale_y = src.height / height
+
+        # Small rasters cannot be tiled in 256 x 256 blocks
+        tiled = (width >= 256) and (height >= 256)
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', width=width, height=height,
+                       transform=src.transform * Affine.scale(scale_x, scale_y),
+                       tiled=tiled, compress='deflate')
+        if tiled:
+            profile.update(blockxsize=256, blockysize=256)
+        else:
+            profile.pop('blockxsize', None)
+            profile.pop('blockysize', None)
+        # End if
+
+        with rasterio.open(out_fn, 'w', **profile) as dst:
+            for row in range(0, height, BLOCK_ROWS):
+                rows = min(BLOCK_ROWS, height - row)
+                window = Window(0, row * scale_y, src.width, rows * scale_y)
+                data = src.read(window=window, out_shape=(src.count, rows, width),
+                                resampling=Resampling.nearest)
+                dst.write(data, window=Window(0, row, width, rows))
+            # End for
+        # End with
+    # End with
+# End build_overview()
+
+
+class OverviewCache(object):
+    """Reduced resolution copies of rasters, built on demand and kept on disk.
+
+    Parameters
+    ==========
+    * level : int, overview level (1 samples 1/4 of the pixels, 2 1/16, ...)
+    * cache_dir : str, directory to keep the reduced rasters in
+                  (defaults to `overviews` in `user_cache_dir()`)
+    """
+
+    def __init__(self, level, cache_dir=None):
+        if level < 1:
+            raise ValueError("Overview level has to be 1 or more, got {}".format(level))
+
+        if cache_dir is None:
+            cache_dir = os.path.join(user_cache_dir(), 'overviews')
+
+        self.level = level
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+    # End __init__()
+
+    def path(self, rst_fn):
+        """Path to the reduced copy of a raster, building it if needed.
+
+        Parameters
+        ==========
+        * rst_fn : str, path to the full resolution raster
+
+        Returns
+        =======
+        * str
+        """
+        rst_fn = os.path.abspath(rst_fn)
+        key = json.dumps([rst_fn, file_stat(rst_fn), self.level])
+        name = os.path.splitext(os.path.basename(rst_fn))[0]
+        out_fn = os.path.join(self.cache_dir, '{}_L{}_{}.tif'.format(
+            name, self.level, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+        if not os.path.exists(out_fn):
+            # Build next to the final file, so that concurrent workers
+            # never read a partially written raster
+            fd, tmp = tempfile.mkstemp(suffix='.tif', dir=self.cache_dir)
+            os.close(fd)
+            try:
+                build_overview(rst_fn, tmp, self.level)
+                os.replace(tmp, out_fn)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            # End try
+        # End if
+
+        return out_fn
+    # End path()
+# End OverviewCache
+
+
+def sampling_error(count, std, zone_area, pixel_area):
+    """Error estimates of zonal statistics computed at an overview level.
+
+    Parameters
+    ==========
+    * count : int or ndarray, number of (valid) pixels sampled per zone
+    * std : float or ndarray, standard deviation of the sampled values
+    * zone_area : float or ndarray, area of the zones, in raster CRS units
+    * pixel_area : float, area of a full resolution pixel, in raster CRS units
+
+    Returns
+    =======
+    * Tuple, fraction of full resolution pixels sampled and standard error
+      of the mean (NaN where nothing was sampled)
+    """
+    count = np.asarray(count, dtype='float64')
+    full_pixels = np.maximum(np.asarray(zone_area, dtype='float64') / pixel_area, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.minimum(count / full_pixels, 1.0)
+        se = np.where(count > 0, np.asarray(std, dtype='float64') / np.sqrt(count), np.nan)
+
+    return frac, se
+# End sampling_error()
@@ -0,0 +1,176 @@
+"""
+Persistent cache of the pixels belonging to each zone.
+
+Hazard rasters for different return periods or scenarios usually share an
+identical grid. Once the zones of a shapefile have been rasterized on a grid,
+the pixel indices of every zone are stored on disk and reused for every later
+raster on that grid, skipping rasterization entirely.
+
+Entries are keyed on the shapefile content hash, the id field, the zones
+used and the raster grid (transform, shape, CRS and window read). Each entry
+is a directory of memory-mappable `.npy` files in compressed sparse row
+layout:
+
+- pixels.npy : flat pixel indices into the window, sorted by zone
+- offsets.npy : start of each zone's pixels in `pixels` (length zones + 1)
+- ids.npy : zone ids
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def file_digest(fn, chunk_size=2 ** 20):
+    """SHA-1 hex digest of a file's content.
+
+    For shapefiles, the content of all sidecar files (.shx, .dbf, ...) is included.
+
+    Parameters
+    ==========
+    * fn : str, file path
+    * chunk_size : int, number of bytes read at a time
+
+    Returns
+    =======
+    * str
+    """
+    base, ext = os.path.splitext(fn)
+    if ext.lower() == '.shp':
+        parts = [base + part for part in SHAPEFILE_PARTS if os.path.exists(base + part)]
+    else:
+        parts = [fn]
+
+    digest = hashlib.sha1()
+    for part in parts:
+        with open(part, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                digest.update(chunk)
+        # End with
+    # End for
+
+    return digest.hexdigest()
+# End file_digest()
+
+
+class ZonePixelCache(object):
+    """On-disk cache of zone pixel indices for one shapefile.
+
+    Parameters
+    ==========
+    * cache_dir : str, directory to store cache entries in
+    * shp_fn : str, path to the shapefile the zones were read from
+    * variant : dict, JSON serializable settings the zone geometries were
+                derived with (e.g. reprojection options), if any
+    """
+
+    def __init__(self, cache_dir, shp_fn, variant=None):
+        self.cache_dir = cache_dir
+        self.shp_digest = file_digest(shp_fn)
+        self.variant = json.dumps(variant, sort_keys=True)
+
+    def key(self, zone_ids, field, ds, window):
+        """Cache key for a set of zones on a raster grid.
+
+        Parameters
+        ==========
+        * zone_ids : array-like, id of each zone used (in order)
+        * field : str, name of column used as primary id
+        * ds : rasterio raster object, raster defining the grid
+        * window : rasterio Window, area of the grid read
+
+        Returns
+        =======
+        * str
+        """
+        digest = hashlib.sha1()
+        digest.update(self.shp_digest.encode())
+        digest.update(self.variant.encode())
+        digest.update(field.encode())
+        digest.update(pd.util.hash_array(np.asarray(zone_ids)).tobytes())
+
+        grid = {
+            'transform': list(ds.transform)[:6],
+            'shape': [ds.height, ds.width],
+            'crs': ds.crs.to_wkt() if ds.crs else None,
+            'window': [int(window.col_off), int(window.row_off),
+                       int(window.width), int(window.height)],
+        }
+        digest.update(json.dumps(grid, sort_keys=True).encode())
+
+        return digest.hexdigest()
+    # End key()
+
+    def load(self, key):
+        """Load a cache entry.
+
+        Returns
+        =======
+        * Tuple[pandas Index, ndarray, ndarray] : zone ids, pixel indices and
+                                                  offsets (memory-mapped),
+                                                  or None if not cached
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+
+        ids = pd.Index(np.load(os.path.join(entry, 'ids.npy')).tolist())
+        pixels = np.load(os.path.join(entry, 'pixels.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(entry, 'offsets.npy'))
+
+        return ids, pixels, offsets
+    # End load()
+
+    def save(self, key, labels, ids):
+        """Store the pixels of each zone from a label grid.
+
+        Parameters
+        ==========
+        * key : str, cache key (see `key()`)
+        * labels : ndarray, label grid (0 = no zone, i + 1 = zone `ids[i]`)
+        * ids : pandas Index, zone ids
+
+        Returns
+        =======
+        * Tuple[pandas Index, ndarray, ndarray] : as returned by `load()`
+        """
+        flat = labels.ravel()
+        order = np.argsort(flat, kind='stable')
+        counts = np.bincount(flat, minlength=len(ids) + 1)
+
+        # Drop pixels outside of any zone (label 0, sorted first)
+        pixels = order[counts[0]:]
+        if flat.size < 2 ** 32:
+            pixels = pixels.astype(np.uint32)
+        offsets = np.r_[0, np.cumsum(counts[1:])].astype(np.int64)
+
+        ids_arr = np.asarray(ids)
+        if ids_arr.dtype == object:
+            ids_arr = ids_arr.astype(str)
+
+        # Write to a temporary directory first so that concurrent
+        # processes never see a partially written entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.cache_dir)
+        np.save(os.path.join(tmp, 'pixels.npy'), pixels)
+        np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp, 'ids.npy'), ids_arr)
+
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Entry already written by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        return self.load(key)
+    # End save()
+# End ZonePixelCache
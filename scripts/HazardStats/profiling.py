@@ -0,0 +1,272 @@
+"""
+Per-stage timing and memory instrumentation for HazardStats.
+
+Stages of a run (reading shapefiles, dispatching zones, raster reads,
+rasterization, statistics, merging and writing) are wrapped in `stage()`.
+When profiling is enabled in a process, each stage records its number of
+calls, wall time, bytes read, pixels processed and the peak resident memory
+of the process at the end of the stage. When disabled, `stage()` does nothing.
+
+Each process (the main process and every pool worker) keeps its own records
+and writes them to `<out_dir>/<pid>.json` on `flush()`. `collect()` gathers
+all of them into one report, with a row per worker and stage.
+
+With the 'mask' engine every zone is timed too, so the slowest zones can be
+profiled again in detail with cProfile.
+"""
+
+import contextlib
+import csv
+import glob
+import heapq
+import json
+import os
+import sys
+import time
+
+
+STAGE_FIELDS = ['worker', 'stage', 'calls', 'seconds', 'bytes', 'pixels', 'peak_rss_mb']
+ZONE_FIELDS = ['seconds', 'shapefile', 'raster', 'zone']
+
+_active = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process in MB, None if unknown."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    except (ImportError, AttributeError):
+        return None
+# End peak_rss_mb()
+
+
+class StageProfiler(object):
+    """Records of the stages run in a single process.
+
+    Parameters
+    ==========
+    * out_dir : str, directory records are flushed to
+    * top_zones : int, number of slowest zones to keep track of
+    """
+
+    def __init__(self, out_dir, top_zones=0):
+        self.out_dir = out_dir
+        self.top_zones = top_zones
+        self.pid = os.getpid()
+        self.stages = {}
+        self.zones = []
+        self.context = ('', '')
+
+        # Continue from the records this process flushed before being disabled
+        # (pool workers are enabled and disabled once per task)
+        try:
+            with open(self._fn()) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+
+        self.stages = data['stages']
+        self.zones = [tuple(zone) for zone in data['zones']]
+        heapq.heapify(self.zones)
+    # End __init__()
+
+    def _fn(self):
+        return os.path.join(self.out_dir, '{}.json'.format(self.pid))
+    # End _fn()
+
+    def _entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0,
+                                 'pixels': 0, 'peak_rss_mb': None}
+
+        return self.stages[name]
+    # End _entry()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self._entry(name)
+            entry['calls'] += 1
+            entry['seconds'] += time.perf_counter() - start
+            entry['peak_rss_mb'] = peak_rss_mb()
+    # End stage()
+
+    def add(self, name, nbytes=0, pixels=0):
+        entry = self._entry(name)
+        entry['bytes'] += int(nbytes)
+        entry['pixels'] += int(pixels)
+    # End add()
+
+    def record_zone(self, seconds, zone_id):
+        if self.top_zones <= 0:
+            return
+
+        item = (seconds, self.context[0], self.context[1], str(zone_id))
+        if len(self.zones) < self.top_zones:
+            heapq.heappush(self.zones, item)
+        else:
+            heapq.heappushpop(self.zones, item)
+    # End record_zone()
+
+    def flush(self):
+        """Write the records of this process to `<out_dir>/<pid>.json`."""
+        data = {'stages': self.stages, 'zones': self.zones}
+        with open(self._fn(), 'w') as fp:
+            json.dump(data, fp)
+    # End flush()
+# End StageProfiler
+
+
+def enable(out_dir, top_zones=0):
+    """Enable profiling in this process (once, workers may run many tasks).
+
+    Records inherited from a forked parent process are discarded.
+
+    Parameters
+    ==========
+    * out_dir : str, directory to flush records to
+    * top_zones : int, number of slowest zones to keep track of
+
+    Returns
+    =======
+    * bool, True if profiling was enabled by this call (the caller then
+      has to `disable()` it), False if it already was
+    """
+    global _active
+    if (_active is None) or (_active.out_dir != out_dir) or (_active.pid != os.getpid()):
+        os.makedirs(out_dir, exist_ok=True)
+        _active = StageProfiler(out_dir, top_zones)
+        return True
+
+    return False
+# End enable()
+
+
+def disable():
+    """Disable profiling in this process, records not flushed are dropped."""
+    global _active
+    _active = None
+# End disable()
+
+
+def stage(name):
+    """Context manager timing a stage, does nothing if profiling is disabled."""
+    if _active is None:
+        return contextlib.nullcontext()
+
+    return _active.stage(name)
+# End stage()
+
+
+def add(name, nbytes=0, pixels=0):
+    """Count bytes read and pixels processed by a stage."""
+    if _active is not None:
+        _active.add(name, nbytes, pixels)
+# End add()
+
+
+def set_context(shp_fn, rst_fn):
+    """Set the shapefile and raster zones are being processed for."""
+    if _active is not None:
+        _active.context = (shp_fn, rst_fn)
+# End set_context()
+
+
+def record_zone(seconds, zone_id):
+    """Record the time taken by a single zone."""
+    if _active is not None:
+        _active.record_zone(seconds, zone_id)
+# End record_zone()
+
+
+def zone_timing():
+    """Whether individual zones should be timed."""
+    return (_active is not None) and (_active.top_zones > 0)
+# End zone_timing()
+
+
+def flush():
+    """Write the records of this process, if profiling is enabled."""
+    if _active is not None:
+        _active.flush()
+# End flush()
+
+
+def collect(out_dir, top_zones=0):
+    """Gather the records flushed by all processes.
+
+    Parameters
+    ==========
+    * out_dir : str, directory records were flushed to
+    * top_zones : int, number of slowest zones to return
+
+    Returns
+    =======
+    * Tuple[List[dict], List[dict]] : a row per worker and stage (plus totals
+                                      per stage with worker 'all'), and the
+                                      slowest zones
+    """
+    rows = []
+    totals = {}
+    zones = []
+    for fn in sorted(glob.glob(os.path.join(out_dir, '*.json'))):
+        worker = os.path.splitext(os.path.basename(fn))[0]
+        with open(fn) as fp:
+            data = json.load(fp)
+
+        for name, entry in data['stages'].items():
+            rows.append(dict(entry, worker=worker, stage=name))
+
+            total = totals.setdefault(name, {'worker': 'all', 'stage': name, 'calls': 0,
+                                             'seconds': 0.0, 'bytes': 0, 'pixels': 0,
+                                             'peak_rss_mb': None})
+            for key in ('calls', 'seconds', 'bytes', 'pixels'):
+                total[key] += entry[key]
+            if entry['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, entry['peak_rss_mb'])
+        # End for
+
+        zones.extend(data['zones'])
+    # End for
+
+    zones = [dict(zip(ZONE_FIELDS, z)) for z in heapq.nlargest(top_zones, map(tuple, zones))]
+
+    return rows + list(totals.values()), zones
+# End collect()
+
+
+def write_report(output_fn, rows, zones):
+    """Write a profile report as CSV (by file extension) or JSON.
+
+    CSV reports only hold the stage rows, the slowest zones are written
+    next to it (`<name>.zones.csv`).
+    """
+    if output_fn.lower().endswith('.csv'):
+        with open(output_fn, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=STAGE_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        if len(zones) > 0:
+            with open(os.path.splitext(output_fn)[0] + '.zones.csv', 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=ZONE_FIELDS)
+                writer.writeheader()
+                writer.writerows(zones)
+        # End if
+    else:
+        with open(output_fn, 'w') as fp:
+            json.dump({'stages': rows, 'slowest_zones': zones}, fp, indent=2)
+    # End if
+# End write_report()
@@ -0,0 +1,89 @@
+"""
+On-the-fly reprojection of zones into the CRS of each raster.
+
+Rasters in a CRS other than that of the shapefile are processed by
+transforming the zone geometries instead of warping the raster. Transformed
+zones are cached per target CRS, so a folder of rasters in a handful of
+different CRS costs one vector transform per CRS.
+
+Geometries can optionally be densified before transforming, so that long
+straight edges follow the curvature introduced by the projection change.
+"""
+
+import pyproj
+import shapely
+
+
+def to_pyproj(crs):
+    """Convert a rasterio/pyproj CRS or CRS string to a pyproj CRS."""
+    if hasattr(crs, 'to_wkt'):
+        crs = crs.to_wkt()
+
+    return pyproj.CRS.from_user_input(crs)
+# End to_pyproj()
+
+
+def same_crs(crs_a, crs_b):
+    """Check whether two coordinate reference systems are equivalent.
+
+    Parameters
+    ==========
+    * crs_a, crs_b : rasterio CRS, pyproj CRS or str
+
+    Returns
+    =======
+    * bool
+    """
+    return to_pyproj(crs_a).equals(to_pyproj(crs_b), ignore_axis_order=True)
+# End same_crs()
+
+
+class ZoneReprojector(object):
+    """Zones of a shapefile transformed into other CRS, cached per target CRS.
+
+    Parameters
+    ==========
+    * shp : GeoPandas DataFrame, zones in their original CRS
+    * densify : float, maximum segment length (in units of the shapefile CRS)
+                to densify geometries to before transforming. None to disable.
+    """
+
+    def __init__(self, shp, densify=None):
+        self.shp = shp
+        self.densify = densify
+        self._cache = {}
+
+    def to(self, crs):
+        """Zones in the given CRS.
+
+        Returns the original zones if the CRS already matches.
+
+        Parameters
+        ==========
+        * crs : rasterio CRS, pyproj CRS or str, target CRS
+
+        Returns
+        =======
+        * GeoPandas DataFrame
+        """
+        target = to_pyproj(crs)
+        key = target.to_wkt()
+        if key in self._cache:
+            return self._cache[key]
+
+        if same_crs(self.shp.crs, target):
+            zones = self.shp
+        else:
+            zones = self.shp
+            if self.densify is not None:
+                zones = zones.set_geometry(shapely.segmentize(zones.geometry.values,
+                                                              self.densify),
+                                           crs=zones.crs)
+            zones = zones.to_crs(target)
+        # End if
+
+        self._cache[key] = zones
+
+        return zones
+    # End to()
+# End ZoneReprojector
@@ -1,16 +1,31 @@
 import argparse
+import os
 import pathlib
+import shutil
+import tempfile
 from datetime import datetime
 from glob import glob
 import itertools as itools
 import sys
 
-from hazardstat import (extract_stats, write_to_excel)
+import profiling
+from hazardstat import (extract_stat_records, merge_stat_records, write_to_excel)
+from writers import WRITERS
 
 example_text = '''usage example:
 
  python runstats.py --show C:/temp/shpfile.shp
  python runstats.py --field OBJECTID --stats min max --pre SD 2 --ignore -9999 9999 0 --ncores 3 --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max median --engine label --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --engine stream --max-mem 2048 --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --engine label --cache C:\temp\cache --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --engine label --stacked --ncores 4 --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --format parquet --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --checkpoint C:\temp\checkpoints --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --densify 1000 --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --simplify 0.5 --simplify-report --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --profile C:\temp\profile.json --profile-zones 10 --indir C:\temp
+ python runstats.py --field OBJECTID --stats min max mean --approx 3 --format csv --indir C:\temp
 '''
 
 
@@ -49,6 +64,53 @@ parser.add_argument('--ignore', type=float_opt, nargs='+',
 parser.add_argument('--ncores', type=int,
                     default=1,
                     help='Number of cores to use')
+parser.add_argument('--engine', type=str,
+                    default='mask', choices=['mask', 'label', 'stream'],
+                    help='Zonal statistics engine: mask each zone separately, label all zones in one pass, '
+                         'or stream over raster blocks for rasters larger than memory (default: mask)')
+parser.add_argument('--max-mem', type=float,
+                    default=512,
+                    help='Memory budget in MB for each raster window read by the stream engine (default: 512)')
+parser.add_argument('--cache', type=str,
+                    default=None,
+                    help='Directory to cache zone pixels in, reused by rasters on the same grid (label engine only)')
+parser.add_argument('--stacked', action='store_true',
+                    help='Process rasters sharing the same grid together, reading each zone window once (label engine only)')
+parser.add_argument('--format', type=str,
+                    default='xlsx', choices=['xlsx'] + sorted(WRITERS),
+                    help='Output format: Excel workbook with geometries (xlsx), streamed Excel without geometries '
+                         '(xlsx-stream), long-format table (parquet, feather, csv) or GeoPackage layers (gpkg) '
+                         '(default: xlsx)')
+parser.add_argument('--checkpoint', type=str,
+                    default=None,
+                    help='Directory to store each shapefile/raster result in as soon as it completes. '
+                         'Re-runs only compute new or modified pairs')
+parser.add_argument('--densify', type=float,
+                    default=None,
+                    help='Maximum segment length (shapefile CRS units) to densify zones to before reprojecting them '
+                         'into the CRS of rasters that differ (default: no densification)')
+parser.add_argument('--simplify', type=float,
+                    default=None,
+                    help='Simplify zones to this fraction of the raster pixel size before rasterizing, '
+                         'e.g. 0.5 (default: no simplification)')
+parser.add_argument('--simplify-report', action='store_true',
+                    help='Report the number of pixels changing zone due to --simplify in each sheet comment')
+parser.add_argument('--profile', type=str,
+                    default=None,
+                    help='Write wall time, bytes read, pixels processed and peak memory per stage '
+                         '(and per worker) to this .json or .csv file')
+parser.add_argument('--profile-zones', type=int,
+                    default=0,
+                    help='With --profile and the mask engine, list the N slowest zones and write a '
+                         'cProfile dump of them next to the profile report (default: 0)')
+parser.add_argument('--approx', type=int,
+                    default=None, metavar='LEVEL',
+                    help='Quick approximate run on rasters reduced by 2^LEVEL on each axis (raster overviews), '
+                         'reporting the fraction of pixels sampled and the standard error of the mean per zone '
+                         '(default: full resolution)')
+parser.add_argument('--approx-cache', type=str,
+                    default=None,
+                    help='Directory to keep the reduced rasters of --approx in (default: overviews in the user cache directory, e.g. ~/.cache/hazardstats)')
 
 
 def main(output_fn, **opts):
@@ -65,28 +127,83 @@ def main(output_fn, **opts):
     stats = opts['stats']
     ignore = opts['ignore']
     preprocess = opts['preprocess']
+    engine = opts.get('engine', 'mask')
+    max_mem = opts.get('max_mem', 512)
+    cache_dir = opts.get('cache_dir')
+    stacked = opts.get('stacked', False)
+    output_format = opts.get('output_format', 'xlsx')
+    checkpoint_dir = opts.get('checkpoint_dir')
+    densify = opts.get('densify')
+    simplify = opts.get('simplify')
+    simplify_report = opts.get('simplify_report', False)
+    profile_fn = opts.get('profile_fn')
+    profile_zones = opts.get('profile_zones', 0)
+    approx = opts.get('approx')
+    approx_dir = opts.get('approx_dir')
+
+    profile_dir = None
+    if profile_fn is not None:
+        # Every process writes its own records here, gathered at the end
+        profile_dir = tempfile.mkdtemp(prefix='hazardstat_profile_')
+        profiling.enable(profile_dir, profile_zones)
+    # End if
+
+    try:
+        num_pairs = len(shp_fns) * len(rst_fns)
+        if (ncores > 1) and (num_pairs >= ncores) and (not stacked):
+            import multiprocess as mp
+            from hazardstat import apply_extract
+
+            # Map each shapefile to a single raster
+            # Then call apply_extract for each shp->raster combination.
+            # Workers return compact per-zone records, geometries are merged once below.
+            file_combs = itools.product(*[shp_fns, rst_fns, [field], [stats], [ignore], [preprocess], [engine], [max_mem],
+                                          [cache_dir], [checkpoint_dir], [densify], [simplify], [simplify_report],
+                                          [profile_dir], [profile_zones], [approx], [approx_dir]])
+            record_results = {}
+            with mp.Pool(processes=ncores) as pool:
+                for res in pool.starmap(apply_extract, file_combs):
+                    record_results.update(res)
+        else:
+            # Split the zones of each raster into chunks processed in parallel
+            # when more cores are available than shp->raster combinations,
+            # or when co-registered rasters are stacked
+            record_results = extract_stat_records(shp_fns, rst_fns, field, stats, ignore,
+                                                  preprocess, engine, max_mem, ncores,
+                                                  cache_dir, stacked, checkpoint_dir, densify,
+                                                  simplify, simplify_report, profile_dir,
+                                                  profile_zones, approx, approx_dir)
+
+        print("Writing results...")
+        if output_format == 'xlsx':
+            results = merge_stat_records(record_results, field)
+            with profiling.stage('write'):
+                write_to_excel(abs_output, results)
+        else:
+            writer, _ = WRITERS[output_format]
+            with profiling.stage('write'):
+                writer(abs_output, record_results, field)
+        # End if
+
+        if profile_fn is not None:
+            profiling.flush()
+            rows, slow_zones = profiling.collect(profile_dir, profile_zones)
+            profiling.write_report(profile_fn, rows, slow_zones)
+            print("Profile written to", profile_fn)
+
+            if len(slow_zones) > 0:
+                from hazardstat import profile_slowest_zones
 
-    if ncores > 1:
-        import multiprocess as mp
-        from hazardstat import apply_extract
-
-        with mp.Manager() as manager:
-            # `d` is a DictProxy object shared between all processes
-            # can be converted to dict for final write out
-            d = manager.dict()
-            with manager.Pool(processes=ncores) as pool:
-                # Map each shapefile to a single raster
-                # Then call apply_extract for each shp->raster combination
-                file_combs = itools.product(*[[d], shp_fns, rst_fns, [field], [stats], [ignore], [preprocess]])
-                procs = pool.starmap_async(apply_extract, file_combs)
-                procs.get()
-
-            results = dict(d)
-    else:
-        results = extract_stats(shp_fns, rst_fns, field, stats, ignore, preprocess)
-
-    print("Writing results...")
-    write_to_excel(abs_output, results)
+                dump_fn = os.path.splitext(profile_fn)[0] + '.prof'
+                profile_slowest_zones(slow_zones, field, stats, ignore, preprocess, dump_fn)
+                print("cProfile of slowest zones written to", dump_fn)
+            # End if
+        # End if
+    finally:
+        if profile_dir is not None:
+            profiling.disable()
+            shutil.rmtree(profile_dir, ignore_errors=True)
+    # End try
     print("Finished")
 # End main()
 
@@ -133,10 +250,13 @@ if __name__ == '__main__':
     stat_pp = "_".join(stats_to_calc)
     if filtering:
         stat_pp += "_" + "_".join(map(str, filtering))
+    if args.approx is not None:
+        stat_pp += "_approx{}".format(args.approx)
 
-    output_fn = "{}/{}.{}.xlsx".format(indir, 
-                                       shp_fns[0].replace(indir, "").replace(".shp", ""),
-                                       stat_pp)
+    ext = '.xlsx' if args.format == 'xlsx' else WRITERS[args.format][1]
+    output_fn = "{}/{}.{}{}".format(indir, 
+                                    shp_fns[0].replace(indir, "").replace(".shp", ""),
+                                    stat_pp, ext)
 
     ncores = args.ncores
     opts = {
@@ -147,6 +267,19 @@ if __name__ == '__main__':
         'preprocess': filtering,
         'ignore': ignore,
         'ncores': ncores,
+        'engine': args.engine,
+        'max_mem': args.max_mem,
+        'cache_dir': args.cache,
+        'stacked': args.stacked,
+        'output_format': args.format,
+        'checkpoint_dir': args.checkpoint,
+        'densify': args.densify,
+        'simplify': args.simplify,
+        'simplify_report': args.simplify_report,
+        'profile_fn': args.profile,
+        'profile_zones': args.profile_zones,
+        'approx': args.approx,
+        'approx_dir': args.approx_cache,
     }
 
     main(output_fn, **opts)
@@ -0,0 +1,124 @@
+"""
+Pixel-snapped simplification of zone geometries.
+
+Administrative boundaries (e.g. GAUL ADM1/ADM2 coastlines) often carry far
+more vertices than can be resolved at the resolution of a hazard raster,
+which makes rasterizing them slow. Zones are simplified to a tolerance
+derived from the raster pixel size before being rasterized. Detail removed
+at that tolerance only moves boundaries by a fraction of a pixel, so the
+pixel centers covered by each zone change very little.
+
+Each zone is simplified on its own (Douglas-Peucker), preserving its
+topology. Boundaries shared by neighbouring zones may be simplified slightly
+differently, leaving slivers narrower than the tolerance; these only affect
+pixels whose center lies within a fraction of a pixel of the boundary. Use
+`simplification_report` to count the pixels that change zone.
+
+Simplified zones are cached per raster resolution.
+"""
+
+import numpy as np
+import shapely
+
+from zonal import label_zones, zone_window
+
+
+def pixel_tolerance(ds, factor=0.5):
+    """Simplification tolerance for a raster: a fraction of its pixel size.
+
+    Parameters
+    ==========
+    * ds : rasterio raster object
+    * factor : float, fraction of the (smallest) pixel size
+
+    Returns
+    =======
+    * float, in units of the raster CRS
+    """
+    return factor * min(abs(ds.res[0]), abs(ds.res[1]))
+# End pixel_tolerance()
+
+
+def simplify_zones(zones, tolerance):
+    """Simplify zone geometries, preserving topology.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones to simplify
+    * tolerance : float, in units of the zones CRS
+
+    Returns
+    =======
+    * GeoPandas DataFrame, copy of `zones` with simplified geometries
+    """
+    simplified = shapely.simplify(zones.geometry.values, tolerance, preserve_topology=True)
+
+    return zones.set_geometry(simplified, crs=zones.crs)
+# End simplify_zones()
+
+
+def simplification_report(zones, simplified, field, ds):
+    """Compare the pixels covered by original and simplified zones.
+
+    Both layers are rasterized over the window they cover, so this is as
+    slow as rasterizing the original zones and is meant for checking a
+    tolerance, not for every run.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, original zones
+    * simplified : GeoPandas DataFrame, simplified zones (same rows)
+    * field : str, name of column to use as primary id
+    * ds : rasterio raster object, raster defining the grid
+
+    Returns
+    =======
+    * Tuple[int, int] : number of pixels assigned to a different zone (or
+                        none), and number of pixels covered by the original zones
+    """
+    window = zone_window(zones, ds)
+    if window is None:
+        return 0, 0
+
+    shape = (int(window.height), int(window.width))
+    transform = ds.window_transform(window)
+
+    original, ids = label_zones(zones, field, transform, shape)
+    reduced, _ = label_zones(simplified, field, transform, shape, ids)
+
+    return int(np.count_nonzero(original != reduced)), int(np.count_nonzero(original))
+# End simplification_report()
+
+
+class ZoneSimplifier(object):
+    """Zones simplified to the pixel size of a raster, cached per resolution.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones in the CRS of the rasters
+    * factor : float, tolerance as a fraction of the pixel size
+    """
+
+    def __init__(self, zones, factor=0.5):
+        self.zones = zones
+        self.factor = factor
+        self._cache = {}
+
+    def for_raster(self, ds):
+        """Zones simplified for the resolution of the given raster.
+
+        Parameters
+        ==========
+        * ds : rasterio raster object
+
+        Returns
+        =======
+        * GeoPandas DataFrame
+        """
+        res = (abs(ds.res[0]), abs(ds.res[1]))
+        if res not in self._cache:
+            self._cache[res] = simplify_zones(self.zones, pixel_tolerance(ds, self.factor))
+
+        return self._cache[res]
+    # End for_raster()
+# End ZoneSimplifier
@@ -0,0 +1,163 @@
+"""
+Spatial indices used to match zones to rasters.
+
+- `ZoneIndex` : STR-tree over the zones of a shapefile, built once and
+                reused for every raster.
+- `RasterFootprints` : STR-tree over the bounds of a set of rasters (read from
+                       the file headers only), so each zone is dispatched only
+                       to the rasters it intersects. Useful when an input folder
+                       holds hundreds of tiled GeoTIFFs. Also groups rasters
+                       sharing an identical grid.
+"""
+
+import numpy as np
+
+import rasterio
+import shapely
+from shapely.geometry import box
+
+
+def raster_grid(ds):
+    """Hashable description of a raster grid: transform, shape and CRS.
+
+    Parameters
+    ==========
+    * ds : rasterio raster object
+
+    Returns
+    =======
+    * tuple
+    """
+    crs = ds.crs.to_wkt() if ds.crs else None
+
+    return (tuple(ds.transform)[:6], ds.width, ds.height, crs)
+# End raster_grid()
+
+
+class ZoneIndex(object):
+    """STR-tree index of zone geometries.
+
+    Parameters
+    ==========
+    * shp : GeoPandas DataFrame, zones to index
+    """
+
+    def __init__(self, shp):
+        self.shp = shp
+        self.tree = shapely.STRtree(shp.geometry.values)
+
+    def positions(self, geom, predicate='intersects'):
+        """Sorted integer positions of zones matching the given geometry.
+
+        Parameters
+        ==========
+        * geom : shapely geometry, area to query
+        * predicate : str, spatial predicate zones have to satisfy,
+                      either 'intersects' or 'within'
+        """
+        if predicate == 'within':
+            # STRtree predicates are evaluated as geom.<predicate>(zone)
+            predicate = 'contains'
+
+        return np.sort(self.tree.query(geom, predicate=predicate))
+    # End positions()
+
+    def query(self, bounds, predicate='intersects'):
+        """Zones matching a bounding box.
+
+        Parameters
+        ==========
+        * bounds : tuple[float], (minx, miny, maxx, maxy)
+        * predicate : str, see `positions()`
+
+        Returns
+        =======
+        * GeoPandas DataFrame, subset of the indexed zones
+        """
+        return self.shp.iloc[self.positions(box(*bounds), predicate)]
+    # End query()
+# End ZoneIndex
+
+
+class RasterFootprints(object):
+    """STR-tree index of raster footprints.
+
+    Only the raster headers are read to build the index.
+
+    Parameters
+    ==========
+    * rasters : List[str], of file paths to rasters.
+    """
+
+    def __init__(self, rasters):
+        self.rasters = list(rasters)
+
+        bounds = []
+        self.grids = []
+        for rst_fn in self.rasters:
+            with rasterio.open(rst_fn) as ds:
+                bounds.append(tuple(ds.bounds))
+                self.grids.append(raster_grid(ds))
+        # End for
+
+        self.boxes = np.array([box(*b) for b in bounds], dtype=object)
+        self.tree = shapely.STRtree(self.boxes)
+
+    def rasters_for(self, geom):
+        """Rasters whose footprint intersects the given geometry.
+
+        Parameters
+        ==========
+        * geom : shapely geometry
+
+        Returns
+        =======
+        * List[str], of file paths to rasters
+        """
+        idx = np.sort(self.tree.query(geom, predicate='intersects'))
+
+        return [self.rasters[i] for i in idx]
+    # End rasters_for()
+
+    def grid_groups(self):
+        """Group rasters sharing an identical grid, in order of first appearance.
+
+        Returns
+        =======
+        * List[List[str]], of file paths to rasters
+        """
+        groups = {}
+        for rst_fn, grid in zip(self.rasters, self.grids):
+            groups.setdefault(grid, []).append(rst_fn)
+
+        return list(groups.values())
+    # End grid_groups()
+
+    def dispatch(self, zone_index):
+        """Positions of the zones intersecting each raster.
+
+        Uses a single bulk query of all footprints against the zone index.
+
+        Parameters
+        ==========
+        * zone_index : ZoneIndex, of the zones to dispatch
+
+        Returns
+        =======
+        * dict[str, ndarray] : raster file path to sorted zone positions.
+                               Rasters without any zones are left out.
+        """
+        rst_idx, zone_idx = zone_index.tree.query(self.boxes, predicate='intersects')
+
+        order = np.lexsort((zone_idx, rst_idx))
+        rst_idx = rst_idx[order]
+        zone_idx = zone_idx[order]
+
+        dispatched = {}
+        hit, starts = np.unique(rst_idx, return_index=True)
+        for i, positions in zip(hit, np.split(zone_idx, starts[1:])):
+            dispatched[self.rasters[i]] = positions
+
+        return dispatched
+    # End dispatch()
+# End RasterFootprints
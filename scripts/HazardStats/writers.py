@@ -0,0 +1,160 @@
+"""
+Output backends for HazardStats results.
+
+All writers take the per-zone records returned by
+`hazardstat.extract_stat_records` (keyed by (shapefile, raster)) and write
+each result exactly once:
+
+- xlsx : Excel workbook with one sheet per raster (pandas/openpyxl, appends
+         to an existing workbook). Geometries are included, as before.
+- xlsx-stream : Excel workbook written with the openpyxl write-only mode,
+                one sheet per raster streamed row by row. Shapefile
+                attributes are included, geometries are not. Always
+                creates a new workbook.
+- parquet, feather, csv : single long-format table with one row per
+                          zone and raster (columns `shapefile`, `raster`,
+                          the id field and the statistics).
+- gpkg : GeoPackage with one joined layer (zones and statistics) per raster.
+"""
+
+import os
+
+import pandas as pd
+import geopandas as gpd
+
+
+def long_table(record_results, field):
+    """Stack per-zone records of all rasters into a single long table.
+
+    Parameters
+    ==========
+    * record_results : dict[tuple], as returned by `extract_stat_records`
+    * field : str, name of column used as primary id
+
+    Returns
+    =======
+    * pandas DataFrame, with columns shapefile, raster, `field` and the statistics
+    """
+    frames = []
+    for (shp_fn, rst_fn), (records, _, _) in record_results.items():
+        if records is None:
+            continue
+
+        df = pd.DataFrame.from_records(records)
+        df.insert(0, 'raster', os.path.basename(rst_fn))
+        df.insert(0, 'shapefile', os.path.basename(shp_fn))
+        frames.append(df)
+    # End for
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['shapefile', 'raster', field])
+
+    table = pd.concat(frames, ignore_index=True)
+    table['shapefile'] = table['shapefile'].astype('category')
+    table['raster'] = table['raster'].astype('category')
+
+    return table
+# End long_table()
+
+
+def write_parquet(output_fn, record_results, field):
+    """Write results as a long-format Parquet table (requires pyarrow)."""
+    long_table(record_results, field).to_parquet(output_fn, index=False)
+# End write_parquet()
+
+
+def write_feather(output_fn, record_results, field):
+    """Write results as a long-format Feather table (requires pyarrow)."""
+    long_table(record_results, field).to_feather(output_fn)
+# End write_feather()
+
+
+def write_csv(output_fn, record_results, field):
+    """Write results as a long-format CSV table."""
+    long_table(record_results, field).to_csv(output_fn, index=False)
+# End write_csv()
+
+
+def _unique_name(name, used):
+    """Name not in `used` yet, made unique with a numeric suffix."""
+    base, i = name, 1
+    while name in used:
+        name = "{}_{}".format(base, i)
+        i += 1
+    # End while
+    used.add(name)
+
+    return name
+# End _unique_name()
+
+
+def write_geopackage(output_fn, record_results, field):
+    """Write one layer of zones joined with their statistics per raster.
+
+    Each shapefile is read once. Existing layers of the same name are replaced.
+    """
+    used = set()
+    shp_cache = {}
+    for (shp_fn, rst_fn), (records, sheet_name, _) in record_results.items():
+        if records is None:
+            continue
+
+        if shp_fn not in shp_cache:
+            shp_cache = {}  # clear cache
+            shp_cache[shp_fn] = gpd.read_file(shp_fn)
+
+        stat_results = pd.DataFrame.from_records(records)
+        joined = shp_cache[shp_fn].merge(stat_results, on=field)
+
+        layer = _unique_name(os.path.splitext(sheet_name)[0], used)
+        joined.to_file(output_fn, layer=layer, driver='GPKG')
+    # End for
+# End write_geopackage()
+
+
+def write_excel_stream(output_fn, record_results, field):
+    """Write results to a new workbook using the openpyxl write-only mode.
+
+    Sheets are laid out as by `hazardstat.write_to_excel`: the comment in the
+    first row and the table from the third row, but without geometries.
+    Rows are streamed out so the workbook is never held in memory.
+    """
+    from openpyxl import Workbook
+
+    book = Workbook(write_only=True)
+    used = set()
+    shp_cache = {}
+    for (shp_fn, rst_fn), (records, sheet_name, comment) in record_results.items():
+        ws = book.create_sheet(_unique_name(sheet_name[:31], used))
+        ws.append([comment])
+        ws.append([])
+
+        if records is None:
+            continue
+
+        if shp_fn not in shp_cache:
+            shp_cache = {}  # clear cache
+            attrs = gpd.read_file(shp_fn, ignore_geometry=True)
+            shp_cache[shp_fn] = pd.DataFrame(attrs)
+
+        data = shp_cache[shp_fn].merge(pd.DataFrame.from_records(records), on=field)
+
+        ws.append(list(map(str, data.columns)))
+        for row in data.itertuples(index=False, name=None):
+            # NaN cells are left empty
+            ws.append([None if pd.isna(v) else v for v in row])
+        # End for
+    # End for
+
+    book.save(output_fn)
+# End write_excel_stream()
+
+
+# Output format name to (writer, file extension)
+WRITERS = {
+    'xlsx-stream': (write_excel_stream, '.xlsx'),
+    'parquet': (write_parquet, '.parquet'),
+    'feather': (write_feather, '.feather'),
+    'csv': (write_csv, '.csv'),
+    'gpkg': (write_geopackage, '.gpkg'),
+}
@@ -0,0 +1,760 @@
+"""
+Label-raster zonal statistics for HazardStats.
+
+Instead of masking the raster once per polygon (see `hazardstat.mp_calc_stats`),
+all zones are burnt into a single integer label grid aligned to the raster.
+Every requested statistic is then computed for every zone in one vectorised
+pass over the pixels using grouped reductions (bincount, sorted segments and
+grouped min/max).
+
+Pixels are assigned to a zone using the same rule as `rasterio.mask.mask`
+(pixel centre inside the geometry). Features sharing the same `field` value
+are counted together as a single zone. Co-registered rasters can be
+processed together (`stack_calc_stats`), labelling the zones only once.
+
+For rasters larger than memory, `stream_calc_stats` walks the raster in
+block-aligned windows and updates per-zone accumulators (see
+`accumulators.py`), so peak memory is bounded by a configurable budget
+instead of the raster size. Medians and the 'PC' preprocess use a quantile
+sketch when streaming and are therefore approximate.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+from rasterio import features
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box
+
+import profiling
+from masking import valid_mask
+from accumulators import QuantileSketch, ZoneMoments, segments
+
+
+# Statistics computed with grouped reductions.
+# Any other numpy function name falls back to a per-segment call.
+GROUPED_STATS = ('count', 'sum', 'mean', 'min', 'max', 'amin', 'amax',
+                 'std', 'var', 'median', 'range', 'ptp')
+
+# NaN values are excluded before any statistic is calculated, so the
+# nan-aware numpy variants are equivalent to their plain counterparts.
+NAN_ALIASES = {
+    'nansum': 'sum',
+    'nanmean': 'mean',
+    'nanmin': 'min',
+    'nanmax': 'max',
+    'nanstd': 'std',
+    'nanvar': 'var',
+    'nanmedian': 'median',
+}
+
+# Statistics that can be calculated by streaming over raster blocks.
+# The median is estimated with a quantile sketch.
+STREAM_STATS = ('count', 'sum', 'mean', 'min', 'max', 'amin', 'amax',
+                'std', 'var', 'range', 'ptp', 'median')
+
+# Numpy names of statistics provided by `ZoneMoments.result()`
+MOMENT_ALIASES = {
+    'amin': 'min',
+    'amax': 'max',
+    'ptp': 'range',
+}
+
+# Approximate working memory needed per pixel when streaming (bytes),
+# on top of the raster data itself: labels, masks and float64 copies.
+STREAM_BYTES_PER_PIXEL = 32
+
+
+def zone_window(zones, ds):
+    """Raster window covering all given zones, snapped to whole pixels.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones to cover
+    * ds : rasterio raster object, raster data
+
+    Returns
+    =======
+    * rasterio Window, or None if the zones do not overlap the raster
+    """
+    return bounds_window(zones.total_bounds, ds)
+# End zone_window()
+
+
+def bounds_window(bounds, ds):
+    """Raster window covering the given bounds, snapped to whole pixels.
+
+    Parameters
+    ==========
+    * bounds : tuple[float], (minx, miny, maxx, maxy) in the raster CRS
+    * ds : rasterio raster object, raster data
+
+    Returns
+    =======
+    * rasterio Window, or None if the bounds do not overlap the raster
+    """
+    minx, miny, maxx, maxy = bounds
+    win = from_bounds(minx, miny, maxx, maxy, transform=ds.transform)
+
+    col_off = max(int(math.floor(win.col_off)), 0)
+    row_off = max(int(math.floor(win.row_off)), 0)
+    col_end = min(int(math.ceil(win.col_off + win.width)), ds.width)
+    row_end = min(int(math.ceil(win.row_off + win.height)), ds.height)
+
+    if (col_end <= col_off) or (row_end <= row_off):
+        return None
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+# End bounds_window()
+
+
+def label_zones(zones, field, transform, shape, ids=None):
+    """Burn zones into an integer label grid.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones to burn in
+    * field : str, name of column to use as primary id
+    * transform : Affine, transform of the target grid
+    * shape : tuple[int, int], (rows, cols) of the target grid
+    * ids : pandas Index, zone ids to label against.
+            Derived from `zones` if not given.
+
+    Returns
+    =======
+    * Tuple[ndarray, Index] : label grid (0 = no zone, i + 1 = zone `ids[i]`)
+                              and the zone ids
+    """
+    if ids is None:
+        codes, ids = pd.factorize(zones[field])
+    else:
+        codes = ids.get_indexer(zones[field])
+    shapes = [(geom, code + 1)
+              for geom, code in zip(zones.geometry, codes)
+              if (geom is not None) and (not geom.is_empty)]
+
+    if len(shapes) == 0:
+        return np.zeros(shape, dtype='int32'), ids
+
+    labels = features.rasterize(shapes, out_shape=shape, transform=transform,
+                                fill=0, dtype='int32')
+
+    return labels, ids
+# End label_zones()
+
+
+def _grouped_percentile(values, starts, counts, q):
+    """Linearly interpolated percentile of each sorted segment.
+
+    Matches `np.percentile(..., interpolation='linear')`.
+    """
+    pos = (counts - 1) * (q / 100.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts - 1)
+    frac = pos - lo
+
+    v_lo = values[starts + lo]
+    v_hi = values[starts + hi]
+
+    return v_lo + (v_hi - v_lo) * frac
+# End _grouped_percentile()
+
+
+def grouped_stats(values, labels, n_zones, stats, preprocess=None):
+    """Calculate statistics for every zone in a single vectorised pass.
+
+    Parameters
+    ==========
+    * values : ndarray, valid pixel values (1D)
+    * labels : ndarray, zone index (0 to n_zones - 1) of each value
+    * n_zones : int, number of zones
+    * stats : List[str], of statistics to calculate.
+              Numpy compatible method names only, plus 'range'.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+                   ('SD', 2) : Filter values outside of 2 standard deviations
+                   ('PC', 80) : Filter values above 80th percentile
+
+    Returns
+    =======
+    * dict[str, ndarray] : statistic name to per-zone values, always
+                           includes 'count'
+    """
+    values = np.asarray(values, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+
+    needs_sort = any(NAN_ALIASES.get(s, s) not in GROUPED_STATS or
+                     NAN_ALIASES.get(s, s) == 'median' for s in stats)
+    needs_sort = needs_sort or (preprocess is not None and preprocess[0] == 'PC')
+
+    if needs_sort:
+        # Sort by zone, then by value within each zone
+        order = np.lexsort((values, labels))
+    else:
+        order = np.argsort(labels, kind='stable')
+    values = values[order]
+    labels = labels[order]
+
+    # Apply preprocess if necessary
+    if preprocess:
+        kind, value = preprocess
+        counts = np.bincount(labels, minlength=n_zones)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if kind == 'SD':
+                avg = np.bincount(labels, values, n_zones) / counts
+                sq_dev = (values - avg[labels]) ** 2
+                sd = np.sqrt(np.bincount(labels, sq_dev, n_zones) / counts)
+                min_thres = values >= (avg - (sd * value))[labels]
+                max_thres = values <= (avg + (sd * value))[labels]
+                keep = min_thres & max_thres
+            elif kind == 'PC':
+                starts, zone_idx = segments(labels)
+                p_threshold = np.full(n_zones, np.nan)
+                p_threshold[zone_idx] = _grouped_percentile(values, starts,
+                                                            counts[zone_idx],
+                                                            value)
+                keep = values <= p_threshold[labels]
+            else:
+                keep = np.ones(values.shape, dtype=bool)
+        # End with
+        values = values[keep]
+        labels = labels[keep]
+    # End if
+
+    counts = np.bincount(labels, minlength=n_zones)
+    starts, zone_idx = segments(labels)
+
+    cache = {}
+
+    def _sum():
+        if 'sum' not in cache:
+            cache['sum'] = np.bincount(labels, values, n_zones)
+        return cache['sum']
+
+    def _mean():
+        if 'mean' not in cache:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cache['mean'] = _sum() / counts
+        return cache['mean']
+
+    def _reduce(ufunc):
+        if ufunc.__name__ not in cache:
+            res = np.full(n_zones, np.nan)
+            if values.size > 0:
+                res[zone_idx] = ufunc.reduceat(values, starts)
+            cache[ufunc.__name__] = res
+        return cache[ufunc.__name__]
+
+    def _var():
+        if 'var' not in cache:
+            sq_dev = (values - _mean()[labels]) ** 2
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cache['var'] = np.bincount(labels, sq_dev, n_zones) / counts
+        return cache['var']
+
+    def _median():
+        if 'median' not in cache:
+            res = np.full(n_zones, np.nan)
+            res[zone_idx] = _grouped_percentile(values, starts,
+                                                counts[zone_idx], 50)
+            cache['median'] = res
+        return cache['median']
+
+    grouped = {
+        'count': lambda: counts,
+        'sum': _sum,
+        'mean': _mean,
+        'min': lambda: _reduce(np.minimum),
+        'amin': lambda: _reduce(np.minimum),
+        'max': lambda: _reduce(np.maximum),
+        'amax': lambda: _reduce(np.maximum),
+        'var': _var,
+        'std': lambda: np.sqrt(_var()),
+        'median': _median,
+        'range': lambda: _reduce(np.maximum) - _reduce(np.minimum),
+        'ptp': lambda: _reduce(np.maximum) - _reduce(np.minimum),
+    }
+
+    results = {}
+    for func in stats:
+        name = NAN_ALIASES.get(func, func)
+        if name in grouped:
+            results[func] = grouped[name]()
+            continue
+
+        # Fall back to calling the numpy function on each sorted segment
+        np_func = getattr(np, func)
+        res = np.full(n_zones, np.nan)
+        for idx, seg in zip(zone_idx, np.split(values, starts[1:])):
+            res[idx] = np_func(seg)
+        results[func] = res
+    # End for
+
+    results['count'] = counts
+
+    return results
+# End grouped_stats()
+
+
+def _spread_bits(n):
+    """Interleave zeros between the lower 16 bits of each integer."""
+    n = n & 0xFFFF
+    n = (n | (n << 8)) & 0x00FF00FF
+    n = (n | (n << 4)) & 0x0F0F0F0F
+    n = (n | (n << 2)) & 0x33333333
+    n = (n | (n << 1)) & 0x55555555
+
+    return n
+# End _spread_bits()
+
+
+def chunk_zones(zones, field, n_chunks):
+    """Split zones into spatially coherent chunks of similar size.
+
+    Zones are ordered along a Z-order (Morton) curve through their centres,
+    so each chunk covers a compact area of the raster. Features sharing the
+    same `field` value are always kept in the same chunk.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones to split
+    * field : str, name of column to use as primary id
+    * n_chunks : int, maximum number of chunks
+
+    Returns
+    =======
+    * List[GeoPandas DataFrame]
+    """
+    bounds = zones.geometry.bounds
+    groups = pd.DataFrame({
+        field: zones[field].values,
+        'x': ((bounds['minx'] + bounds['maxx']) / 2).values,
+        'y': ((bounds['miny'] + bounds['maxy']) / 2).values,
+        'area': ((bounds['maxx'] - bounds['minx']) *
+                 (bounds['maxy'] - bounds['miny'])).values,
+    }).groupby(field, sort=False).agg({'x': 'mean', 'y': 'mean', 'area': 'sum'})
+
+    minx, miny, maxx, maxy = zones.total_bounds
+    scale = 0xFFFF / max(maxx - minx, maxy - miny, 1e-12)
+    qx = ((groups['x'].values - minx) * scale).astype(np.int64)
+    qy = ((groups['y'].values - miny) * scale).astype(np.int64)
+    order = np.argsort(_spread_bits(qx) | (_spread_bits(qy) << 1), kind='stable')
+
+    # Balance chunks by bounding box area, a proxy for the pixels to read
+    weight = np.cumsum(groups['area'].values[order])
+    weight = weight / max(weight[-1], 1e-12)
+    chunk_idx = np.minimum((weight * n_chunks).astype(np.int64), n_chunks - 1)
+    chunk_of = pd.Series(chunk_idx, index=groups.index[order])
+
+    zone_chunk = chunk_of.loc[zones[field]].values
+
+    return [zones[zone_chunk == i] for i in np.unique(zone_chunk)]
+# End chunk_zones()
+
+
+def valid_pixels(data, labels, nodata=None, ignore=None):
+    """Boolean mask of pixels that belong to a zone and hold usable data.
+
+    Parameters
+    ==========
+    * data : ndarray, raster values
+    * labels : ndarray, label grid of the same shape as `data`
+    * nodata : float, raster nodata value
+    * ignore : List[float], of values to ignore.
+
+    Returns
+    =======
+    * ndarray of bool
+    """
+    return valid_mask(data, nodata, ignore, within=labels > 0)
+# End valid_pixels()
+
+
+def to_result_set(res, ids, stats):
+    """Convert per-zone statistic arrays into a `mp_calc_stats` style result set.
+
+    Parameters
+    ==========
+    * res : dict[str, ndarray], statistic name to per-zone values.
+            Has to include 'count', and 'range' if requested.
+    * ids : pandas Index, zone ids
+    * stats : List[str], of statistics that were requested.
+
+    Returns
+    =======
+    * dict[Any, dict] : zone id to dict of statistic results
+    """
+    run_range = 'range' in stats
+    stats = [s for s in stats if s not in ('count', 'range')]
+
+    result_set = {}
+    for i in np.flatnonzero(res['count'] > 0):
+        zone_res = {func: float(res[func][i]) for func in stats}
+        zone_res['count'] = int(res['count'][i])
+
+        if run_range:
+            zone_res['range'] = float(res['range'][i])
+
+        result_set[ids[i]] = zone_res
+    # End for
+
+    return result_set
+# End to_result_set()
+
+
+def zone_pixels(zones, field, ds, window, cache=None):
+    """Flat indices of the pixels within each zone.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster defining the grid
+    * window : rasterio Window, area of the raster to label
+    * cache : ZonePixelCache, reuse the pixels of each zone from an earlier
+              raster on the same grid instead of rasterizing again
+
+    Returns
+    =======
+    * Tuple[Index, ndarray, ndarray] : zone ids, flat pixel indices into the
+                                       window and the zone index (0 to
+                                       len(ids) - 1) of each pixel
+    """
+    shape = (int(window.height), int(window.width))
+    transform = ds.window_transform(window)
+
+    if cache is None:
+        labels, ids = label_zones(zones, field, transform, shape)
+        labels = labels.ravel()
+        pixels = np.flatnonzero(labels)
+
+        return ids, pixels, labels[pixels] - 1
+    # End if
+
+    key = cache.key(zones[field].values, field, ds, window)
+    entry = cache.load(key)
+    if entry is None:
+        labels, ids = label_zones(zones, field, transform, shape)
+        entry = cache.save(key, labels, ids)
+
+    ids, pixels, offsets = entry
+
+    return ids, pixels, np.repeat(np.arange(len(ids)), np.diff(offsets))
+# End zone_pixels()
+
+
+def stack_calc_stats(zones, field, datasets, stats, ignore=None, preprocess=None,
+                     cache=None):
+    """Calculate given statistics for all zones on co-registered rasters.
+
+    Zones are labelled once and the same window is read from every raster,
+    filling a (zones x rasters x statistics) cube.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the rasters
+    * field : str, name of column to use as primary id.
+    * datasets : List[rasterio raster object], rasters sharing the same grid
+                 (first band is used)
+    * stats : List[str], of statistics to calculate.
+    * ignore : List[float], of values to ignore.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+    * cache : ZonePixelCache, see `zone_pixels()`
+
+    Returns
+    =======
+    * Tuple[Index, ndarray, List[str]] : zone ids, statistic cube and the
+                                         statistic name of each cube layer
+    """
+    calc = [s for s in stats if s not in ('count', 'range')] + ['count', 'range']
+    win = zone_window(zones, datasets[0])
+    if win is None:
+        return pd.Index([]), np.empty((0, len(datasets), len(calc))), calc
+
+    with profiling.stage('rasterize'):
+        ids, pixels, labels = zone_pixels(zones, field, datasets[0], win, cache)
+
+    cube = np.full((len(ids), len(datasets), len(calc)), np.nan)
+    for j, ds in enumerate(datasets):
+        with profiling.stage('read_raster'):
+            data = ds.read(1, window=win)
+        profiling.add('read_raster', data.nbytes, data.size)
+
+        with profiling.stage('stats'):
+            values = data.ravel()[pixels]
+            valid = valid_pixels(values, labels + 1, ds.nodata, ignore)
+
+            res = grouped_stats(values[valid], labels[valid], len(ids), calc, preprocess)
+        profiling.add('stats', pixels=values.size)
+
+        for k, func in enumerate(calc):
+            cube[:, j, k] = res[func]
+    # End for
+
+    return ids, cube, calc
+# End stack_calc_stats()
+
+
+def cube_result_sets(ids, cube, calc, stats):
+    """Split a statistic cube into one result set per raster.
+
+    Parameters
+    ==========
+    * ids : Index, zone ids
+    * cube : ndarray, (zones x rasters x statistics) as from `stack_calc_stats()`
+    * calc : List[str], statistic name of each cube layer
+    * stats : List[str], of statistics that were requested.
+
+    Returns
+    =======
+    * List[dict[Any, dict]] : zone id to dict of statistic results, per raster
+    """
+    return [to_result_set({func: cube[:, j, k] for k, func in enumerate(calc)},
+                          ids, stats)
+            for j in range(cube.shape[1])]
+# End cube_result_sets()
+
+
+def label_calc_stats(zones, field, ds, stats, ignore=None, preprocess=None,
+                     cache=None):
+    """Calculate given statistics for all zones using a label grid.
+
+    Produces the same result set as calling `hazardstat.mp_calc_stats`
+    for each zone.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster data (first band is used)
+    * stats : List[str], of statistics to calculate.
+    * ignore : List[float], of values to ignore.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+    * cache : ZonePixelCache, see `zone_pixels()`
+
+    Returns
+    =======
+    * dict[Any, dict] : zone id to dict of statistic results
+    """
+    ids, cube, calc = stack_calc_stats(zones, field, [ds], stats, ignore,
+                                       preprocess, cache)
+
+    return cube_result_sets(ids, cube, calc, stats)[0]
+# End label_calc_stats()
+
+
+def stream_windows(ds, max_mem=512, bounds_window=None):
+    """Block-aligned raster windows that fit within a memory budget.
+
+    Neighbouring blocks are grouped into full-width strips where possible,
+    otherwise into runs of blocks along a single block row.
+
+    Parameters
+    ==========
+    * ds : rasterio raster object, raster data
+    * max_mem : float, memory budget in MB for a single window
+    * bounds_window : rasterio Window, only yield windows overlapping this area
+
+    Returns
+    =======
+    * Generator of rasterio Window
+    """
+    block_h, block_w = ds.block_shapes[0]
+    itemsize = np.dtype(ds.dtypes[0]).itemsize
+    max_pixels = max(int(max_mem * 1024 ** 2) // (itemsize + STREAM_BYTES_PER_PIXEL), 1)
+
+    if bounds_window is None:
+        bounds_window = Window(0, 0, ds.width, ds.height)
+
+    # Align area of interest to the block grid
+    col_start = (int(bounds_window.col_off) // block_w) * block_w
+    row_start = (int(bounds_window.row_off) // block_h) * block_h
+    col_stop = min(int(bounds_window.col_off + bounds_window.width), ds.width)
+    row_stop = min(int(bounds_window.row_off + bounds_window.height), ds.height)
+
+    strip_w = col_stop - col_start
+    if strip_w * block_h <= max_pixels:
+        step_h = max(max_pixels // (strip_w * block_h), 1) * block_h
+        step_w = strip_w
+    else:
+        step_h = block_h
+        step_w = max(max_pixels // (block_h * block_w), 1) * block_w
+
+    for row in range(row_start, row_stop, step_h):
+        height = min(step_h, row_stop - row)
+        for col in range(col_start, col_stop, step_w):
+            width = min(step_w, col_stop - col)
+            yield Window(col, row, width, height)
+        # End for
+    # End for
+# End stream_windows()
+
+
+def _stream_pass(zones, field, ds, ids, windows, accumulators, ignore=None,
+                 lower=None, upper=None):
+    """Update accumulators with the pixels of all zones, one window at a time.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster data (first band is used)
+    * ids : pandas Index, zone ids
+    * windows : List[Window], raster windows to read
+    * accumulators : List, of `ZoneMoments` or `QuantileSketch` to update
+    * ignore : List[float], of values to ignore.
+    * lower : ndarray, per-zone lower bound of values to keep (inclusive)
+    * upper : ndarray, per-zone upper bound of values to keep (inclusive)
+    """
+    sindex = zones.sindex
+    for block in windows:
+        transform = ds.window_transform(block)
+        block_geom = box(*ds.window_bounds(block))
+
+        # Only burn in the zones overlapping this block
+        in_block = zones.iloc[sindex.query(block_geom)]
+        if len(in_block) == 0:
+            continue
+
+        shape = (int(block.height), int(block.width))
+        with profiling.stage('rasterize'):
+            labels, _ = label_zones(in_block, field, transform, shape, ids)
+        if not labels.any():
+            continue
+
+        with profiling.stage('read_raster'):
+            data = ds.read(1, window=block)
+        profiling.add('read_raster', data.nbytes, data.size)
+
+        with profiling.stage('stats'):
+            valid = valid_pixels(data, labels, ds.nodata, ignore)
+            values = data[valid].astype(np.float64)
+            labels = labels[valid] - 1
+
+            if lower is not None:
+                keep = values >= lower[labels]
+                values, labels = values[keep], labels[keep]
+            if upper is not None:
+                keep = values <= upper[labels]
+                values, labels = values[keep], labels[keep]
+
+            for acc in accumulators:
+                acc.update(values, labels)
+        # End with
+        profiling.add('stats', pixels=values.size)
+    # End for
+# End _stream_pass()
+
+
+def stream_calc_stats(zones, field, ds, stats, ignore=None, preprocess=None,
+                      max_mem=512, alpha=0.005):
+    """Calculate given statistics for all zones, streaming over raster blocks.
+
+    Peak memory is bounded by `max_mem` rather than the raster size.
+    Preprocessing is done in two passes over the raster: the first collects
+    the per-zone mean and standard deviation ('SD') or a quantile sketch
+    ('PC'), the second calculates statistics from the values kept.
+
+    Medians and 'PC' thresholds are estimated within a relative error of
+    `alpha` (see `accumulators.QuantileSketch`), all other statistics are exact.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster data (first band is used)
+    * stats : List[str], of statistics to calculate, see `STREAM_STATS`.
+    * ignore : List[float], of values to ignore.
+    * preprocess : tuple[str, float], kind of preprocess with associated threshold value.
+                   ('SD', 2) : Filter values outside of 2 standard deviations
+                   ('PC', 80) : Filter values above 80th percentile
+    * max_mem : float, memory budget in MB for each raster window read
+    * alpha : float, relative error bound of the quantile sketch
+
+    Returns
+    =======
+    * dict[Any, dict] : zone id to dict of statistic results
+    """
+    unsupported = [s for s in stats if NAN_ALIASES.get(s, s) not in STREAM_STATS]
+    if unsupported:
+        raise ValueError("Statistics not supported when streaming: {}".format(unsupported))
+
+    win = zone_window(zones, ds)
+    if win is None:
+        return {}
+
+    ids = pd.Index(pd.unique(zones[field]))
+    windows = list(stream_windows(ds, max_mem, win))
+
+    lower = upper = None
+    if preprocess:
+        kind, value = preprocess
+        if kind == 'SD':
+            first = ZoneMoments(len(ids))
+            _stream_pass(zones, field, ds, ids, windows, [first], ignore)
+            res = first.result()
+            lower = res['mean'] - (res['std'] * value)
+            upper = res['mean'] + (res['std'] * value)
+        elif kind == 'PC':
+            first = QuantileSketch(len(ids), alpha)
+            _stream_pass(zones, field, ds, ids, windows, [first], ignore)
+            upper = first.quantile(value)
+        # End if
+    # End if
+
+    moments = ZoneMoments(len(ids))
+    accumulators = [moments]
+
+    run_median = any(NAN_ALIASES.get(s, s) == 'median' for s in stats)
+    if run_median:
+        sketch = QuantileSketch(len(ids), alpha)
+        accumulators.append(sketch)
+
+    _stream_pass(zones, field, ds, ids, windows, accumulators, ignore,
+                 lower, upper)
+
+    res = moments.result()
+    if run_median:
+        res['median'] = sketch.quantile(50)
+
+    calc = {}
+    for func in stats:
+        name = NAN_ALIASES.get(func, func)
+        calc[func] = res[MOMENT_ALIASES.get(name, name)]
+    calc['count'] = res['count']
+    calc['range'] = res['range']
+
+    return to_result_set(calc, ids, stats)
+# End stream_calc_stats()
+
+
+def stream_moments(zones, field, ds, ignore=None, max_mem=512):
+    """Mergeable per-zone moments, streaming over raster blocks.
+
+    Moments of zones can be merged into those of larger units afterwards
+    (see `ZoneMoments.grouped`) without reading the raster again.
+
+    Parameters
+    ==========
+    * zones : GeoPandas DataFrame, zones overlaying the raster
+    * field : str, name of column to use as primary id.
+    * ds : rasterio raster object, raster data (first band is used)
+    * ignore : List[float], of values to ignore.
+    * max_mem : float, memory budget in MB for each raster window read
+
+    Returns
+    =======
+    * Tuple[pandas Index, ZoneMoments] : zone ids, and their moments
+                                         (in the same order)
+    """
+    ids = pd.Index(pd.unique(zones[field]))
+    moments = ZoneMoments(len(ids))
+
+    win = zone_window(zones, ds)
+    if win is not None:
+        windows = list(stream_windows(ds, max_mem, win))
+        _stream_pass(zones, field, ds, ids, windows, [moments], ignore)
+
+    return ids, moments
+# End stream_moments()
@@ -27,10 +27,33 @@ Requires python 3.6 and the following libraries (conda-forge):
 - rasterio
 - rasterstats
 Make sure all layers are in crs wgs84 and rasters are single band.
-The rasterstats analysis is based on the raster resolution.
+The rasterstats analysis is based on the raster resolution. It reads only the
+raster window of each ADM unit, through an LRU cache of raster blocks bounded
+by --max-mem, so memory scales with the largest unit rather than the raster.
+The "stream" engine walks the raster in block-aligned windows (shared with
+HazardStats).
+When several ADM levels are checked, the finest level is computed once per
+raster and coarser levels are merged from it using the ADMx_CODE attributes
+(for count, sum, mean, min, max, std and range), so checking ADM0, ADM1 and
+ADM2 costs about the same as checking one level. This roll-up is used unless
+an engine is chosen with --engine or it is turned off with --no-rollup.
+
+For a quick look before a full run use `--approx LEVEL`: statistics are
+computed from the rasters reduced by 2^LEVEL on each axis (overviews, built
+once and cached), with the fraction of pixels sampled and the standard error
+of the mean added for each ADM unit.
+
+    python sanity_check.py --approx 3
+    python sanity_check.py --hazards ../data/hazards --shapefiles ../data/g2015_2014_0_upd270117 --adms ADM0 ADM1
+
+Results of all rasters are written once at the end, to a workbook with one
+sheet per raster and/or (`--format parquet` or `both`) to a single long
+Parquet table with one row per raster and ADM unit.
 
 """
+import argparse
 import os
+import sys
 import pathlib
 from glob import glob
 from datetime import datetime
@@ -39,20 +62,348 @@ import itertools as itools
 import numpy as np
 import pandas as pd
 import geopandas as gp
-from openpyxl import load_workbook
+import shapely
 
 import rasterio
+from rasterio.windows import Window
 from rasterstats import zonal_stats
 
-try:
-    # Optional package for progress bar
-    from tqdm import tqdm
-except ImportError:
-    pass
+# Zonal statistics engines are shared with HazardStats
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'HazardStats'))
+from block_cache import BlockCache
+from masking import valid_mask
+from overviews import OverviewCache, sampling_error
+from simplify import ZoneSimplifier
+from zonal import bounds_window, stream_calc_stats, stream_moments
+
+
+# Statistics that can be derived from mergeable per-zone moments, so that
+# coarser ADM levels are rolled up from the finest one
+ROLLUP_STATS = ('count', 'sum', 'mean', 'min', 'max', 'std', 'range')
+
+# Units of the rasterstats engine whose windows start in the same tile of
+# GROUP_BLOCKS x GROUP_BLOCKS cached raster blocks share one zonal_stats call
+GROUP_BLOCKS = 4
+
+
+parser = argparse.ArgumentParser(description='Sanity check of hazard layers')
+parser.add_argument('--shapefiles', type=str,
+                    default="../data/g2015_2014_0_upd270117",
+                    help='Directory of the ADM shapefiles (default: ../data/g2015_2014_0_upd270117)')
+parser.add_argument('--hazards', type=str,
+                    default="../data/hazards",
+                    help='Directory of the hazard rasters, all .tif files are checked (default: ../data/hazards)')
+parser.add_argument('--stats', type=str, nargs='+',
+                    default=["max", "min", "mean", "range", "count"],
+                    help='Statistics to calculate (default: max min mean range count)')
+parser.add_argument('--adms', type=str, nargs='+',
+                    default=["ADM0"],
+                    help='ADM levels to check (default: ADM0)')
+parser.add_argument('--engine', type=str,
+                    default=None, choices=['rasterstats', 'stream'],
+                    help='"rasterstats" reads the window of each ADM unit through a block cache, "stream" '
+                         'labels all units block by block, for every ADM level (default: rasterstats, '
+                         'or the roll-up when several ADM levels are checked)')
+parser.add_argument('--rollup', dest='rollup', action='store_true', default=None,
+                    help='Compute the finest ADM level once per raster and merge coarser levels from it '
+                         '(count, sum, mean, min, max, std and range only). Default when several ADM levels '
+                         'are checked and no --engine is given')
+parser.add_argument('--no-rollup', dest='rollup', action='store_false',
+                    help='Compute every ADM level with the engine')
+parser.add_argument('--max-mem', type=float,
+                    default=512,
+                    help='Memory budget in MB for each raster window read by the stream engine, '
+                         'and for the raster block cache of the rasterstats engine (default: 512)')
+parser.add_argument('--simplify', type=float,
+                    default=None,
+                    help='Simplify ADM boundaries to this fraction of the raster pixel size, e.g. 0.5 '
+                         '(default: no simplification)')
+parser.add_argument('--format', type=str,
+                    default='xlsx', choices=['xlsx', 'parquet', 'both'],
+                    help='Output a workbook with one sheet per raster (xlsx), a single long table (parquet) '
+                         'or both (default: xlsx)')
+parser.add_argument('--approx', type=int,
+                    default=None, metavar='LEVEL',
+                    help='Quick approximate check on rasters reduced by 2^LEVEL on each axis (raster overviews), '
+                         'reporting the fraction of pixels sampled and the standard error of the mean per ADM unit '
+                         '(default: full resolution)')
+parser.add_argument('--approx-cache', type=str,
+                    default=None,
+                    help='Directory to keep the reduced rasters of --approx in (default: system temp directory)')
+
+
+def stream_adm_stats(shp_data, rst, adm, stats_of_interest, max_mem=512):
+    """Zonal statistics for all ADM units, streaming over raster blocks.
+
+    Areas with the same ADM code are counted together, so no dissolve is needed.
+
+    Parameters
+    ==========
+    * shp_data : GeoPandas DataFrame, indexed by ADM code
+    * rst : str, path to raster file
+    * adm : str, ADM level to check ("ADM0", "ADM1", ...)
+    * stats_of_interest : str, listing statistical functions of interest
+                          `zonal_stats()` compatible
+    * max_mem : float, memory budget in MB for each raster window read
+
+    Returns
+    ==========
+    * DataFrame indexed by ADM code
+    """
+    adm_code = "{}_CODE".format(adm)
+    adm_name = "{}_NAME".format(adm)
+    stat_list = stats_of_interest.split()
+
+    with rasterio.open(rst) as src:
+        result_set = stream_calc_stats(shp_data.reset_index(), adm_code, src,
+                                       stat_list, max_mem=max_mem)
+    # End with
+
+    info_cols = [adm_name]
+    if int(adm.strip('ADM')) > 0:
+        info_cols.append('ADM0_CODE')
+
+    info = shp_data.loc[~shp_data.index.duplicated(), info_cols]
+    stats = pd.DataFrame.from_dict(result_set, orient='index')
+    df = info.join(stats.reindex(columns=stat_list))
+    df['Comment/Error'] = ""
+    df.index.name = adm_code
+
+    return df
+# End stream_adm_stats()
+
+
+def batch_adm_stats(shp_data, blocks, adm, stats_of_interest):
+    """Zonal statistics for all ADM units of a layer.
+
+    Areas sharing an ADM code are dissolved together in one grouped
+    operation. Units are then grouped by the tile of raster blocks their
+    window starts in (see `GROUP_BLOCKS`), and each group is computed with a
+    single `zonal_stats()` call on the window covering all of its units.
+    Windows are read through a cache of raster blocks, so the full band is
+    never held in memory. Results are assembled column-wise.
+
+    Parameters
+    ==========
+    * shp_data : GeoPandas DataFrame, indexed by ADM code
+    * blocks : BlockCache, of the raster band
+    * adm : str, ADM level to check ("ADM0", "ADM1", ...)
+    * stats_of_interest : str, listing statistical functions of interest
+                          `zonal_stats()` compatible
+
+    Returns
+    ==========
+    * DataFrame indexed by ADM code
+    """
+    adm_code = "{}_CODE".format(adm)
+    adm_name = "{}_NAME".format(adm)
+
+    info_cols = [adm_name]
+    if int(adm.strip('ADM')) > 0:
+        info_cols.append('ADM0_CODE')
+
+    # Combine (dissolve) areas with the same ADM code together
+    first = ~shp_data.index.duplicated()
+    geoms = shp_data.geometry[first]
+    multi = shp_data.index.duplicated(keep=False)
+    if multi.any():
+        dissolved = shp_data.loc[multi, ['geometry']].dissolve(level=0).geometry
+        geoms = geoms.where(~geoms.index.isin(dissolved.index),
+                            dissolved.reindex(geoms.index))
+    # End if
+
+    ds = blocks.ds
+    stat_list = stats_of_interest.split()
+    tile_h = blocks.block_h * GROUP_BLOCKS
+    tile_w = blocks.block_w * GROUP_BLOCKS
+
+    # Units outside of the raster have no data
+    empty = dict.fromkeys(stat_list)
+    if 'count' in empty:
+        empty['count'] = 0
+    stats = [empty] * len(geoms)
+
+    windows = [bounds_window(bounds, ds) for bounds in shapely.bounds(geoms.values)]
+    groups = {}
+    for i, window in enumerate(windows):
+        if window is None:
+            continue
+
+        # Units larger than a tile are computed on their own
+        tile = (window.row_off // tile_h, window.col_off // tile_w)
+        large = (window.height > tile_h) or (window.width > tile_w)
+        groups.setdefault(tile + (i if large else -1,), []).append(i)
+    # End for
+
+    # Tiles in raster order, so neighbouring groups share cached blocks
+    for key in sorted(groups):
+        members = groups[key]
+        row_off = min(windows[i].row_off for i in members)
+        col_off = min(windows[i].col_off for i in members)
+        row_end = max(windows[i].row_off + windows[i].height for i in members)
+        col_end = max(windows[i].col_off + windows[i].width for i in members)
+        window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+        data = blocks.read(window)
+        data = np.ma.masked_array(data, mask=~valid_mask(data, ds.nodata))
+        group_stats = zonal_stats(geoms.values[members], data,
+                                  affine=ds.window_transform(window),
+                                  stats=stat_list, nodata=ds.nodata)
+        for i, res in zip(members, group_stats):
+            stats[i] = res
+    # End for
+
+    df = shp_data.loc[first, info_cols].join(pd.DataFrame(stats, index=geoms.index))
+    df['Comment/Error'] = ""
+    df.index.name = adm_code
+
+    return df
+# End batch_adm_stats()
+
+
+def write_workbook(output_fn, sheets):
+    """Write all sheets to a new workbook in a single session.
+
+    Rows are streamed out with the openpyxl write-only mode: comments in the
+    first rows, the table (with its ADM code index) from the third row.
+
+    Parameters
+    ==========
+    * output_fn : str, path to the Excel file to write
+    * sheets : list[dict], with sheet (name), data (DataFrame or None when
+               the raster could not be processed) and comment (list of lines)
+    """
+    from openpyxl import Workbook
+
+    book = Workbook(write_only=True)
+    used = set()
+    for entry in sheets:
+        name, i = entry['sheet'], 1
+        while name in used:
+            name = "{}_{}".format(entry['sheet'][:28], i)
+            i += 1
+        # End while
+        used.add(name)
+
+        ws = book.create_sheet(name)
+        comment = entry['comment'] + [None] * (2 - len(entry['comment']))
+        for line in comment:
+            ws.append([line])
+
+        df = entry['data']
+        if df is None:
+            continue
+
+        ws.append([df.index.name] + list(map(str, df.columns)))
+        for idx, row in zip(df.index, df.itertuples(index=False, name=None)):
+            # NaN cells are left empty
+            ws.append([None if pd.isna(v) else v for v in (idx,) + row])
+        # End for
+    # End for
+
+    book.save(output_fn)
+# End write_workbook()
+
+
+def long_table(sheets):
+    """Stack the results of all rasters and ADM levels into a single table.
+
+    Parameters
+    ==========
+    * sheets : list[dict], as given to `write_workbook`, with the shapefile,
+               raster and adm of each result
+
+    Returns
+    ==========
+    * DataFrame with columns shapefile, raster, adm_level, adm_code, adm_name,
+      ADM0_CODE and the statistics
+    """
+    frames = []
+    for entry in sheets:
+        df = entry['data']
+        if df is None:
+            continue
+
+        adm = entry['adm']
+        df = df.rename(columns={"{}_NAME".format(adm): 'adm_name'})
+        df = df.rename_axis('adm_code').reset_index()
+        if 'ADM0_CODE' not in df.columns:
+            df.insert(2, 'ADM0_CODE', df['adm_code'])
+
+        df.insert(0, 'adm_level', adm)
+        df.insert(0, 'raster', entry['raster'])
+        df.insert(0, 'shapefile', entry['shapefile'])
+        frames.append(df)
+    # End for
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['shapefile', 'raster', 'adm_level', 'adm_code'])
+
+    table = pd.concat(frames, ignore_index=True)
+    for col in ('shapefile', 'raster', 'adm_level'):
+        table[col] = table[col].astype('category')
+
+    return table
+# End long_table()
+
+
+def finest_adm(adms):
+    """Finest of the given ADM levels (e.g. "ADM2" of ADM0, ADM1 and ADM2)."""
+    return max(adms, key=lambda adm: int(adm.strip('ADM')))
+# End finest_adm()
+
+
+def rollup_adm_stats(shp_data, ids, moments, finest, adm, stat_list):
+    """Statistics of an ADM level, merged from the moments of a finer level.
+
+    Every unit of the finer level is assigned to its parent unit using the
+    ADM code attributes of the shapefile, so the raster is not read again and
+    no boundaries are dissolved. Units without data are kept, with a count of
+    zero and no statistics.
+
+    Parameters
+    ==========
+    * shp_data : GeoPandas DataFrame, ADM units with their codes and names
+    * ids : pandas Index, codes of the finest ADM units, in the order of `moments`
+    * moments : ZoneMoments, of the finest ADM units
+    * finest : str, ADM level of `ids` ("ADM2", ...)
+    * adm : str, ADM level to report, `finest` or coarser ("ADM0", "ADM1", ...)
+    * stat_list : list[str], statistics to report, see `ROLLUP_STATS`
+
+    Returns
+    ==========
+    * DataFrame indexed by ADM code
+    """
+    adm_code = "{}_CODE".format(adm)
+    adm_name = "{}_NAME".format(adm)
+    finest_code = "{}_CODE".format(finest)
+
+    info_cols = [adm_name]
+    if int(adm.strip('ADM')) > 0:
+        info_cols.append('ADM0_CODE')
+
+    info = shp_data.drop_duplicates(adm_code).set_index(adm_code)[info_cols]
+
+    # Parent unit of each finest unit
+    parents = shp_data.drop_duplicates(finest_code).set_index(finest_code, drop=False)[adm_code]
+    groups = info.index.get_indexer(parents.reindex(ids))
+
+    res = moments.grouped(groups, len(info)).result()
+    stats = pd.DataFrame({stat: res[stat] for stat in stat_list}, index=info.index)
+
+    df = info.join(stats)
+    df['Comment/Error'] = ""
+    df.index.name = adm_code
+
+    return df
+# End rollup_adm_stats()
 
 
 def extract_stats(shp_files, rst_files, adms_to_check,
-                  stats_of_interest, output_fn):
+                  stats_of_interest, output_fn, engine=None,
+                  max_mem=512, simplify=None, run_date=None, approx=None,
+                  approx_dir=None, output_format='xlsx', rollup=None):
     """Extract statistics from rasters using shapefiles.
 
     Parameters
@@ -62,6 +413,32 @@ def extract_stats(shp_files, rst_files, adms_to_check,
     * adms_to_check : list[str], ADM levels to check (["ADM0", "ADM1", ...])
     * stats_of_interest : str, listing statistical functions of interest
                           `zonal_stats()` compatible
+    * engine : str, 'rasterstats' to read the window of each ADM unit
+               through a cache of raster blocks, or 'stream' to walk the raster in block-aligned windows
+               (supports count, sum, mean, min, max, std and range).
+               None (default) for 'rasterstats'. Not used for the ADM levels
+               that are rolled up, and an explicit engine turns the roll-up
+               off unless `rollup` is True.
+    * max_mem : float, memory budget in MB for each raster window read
+                by the 'stream' engine, and for the cache of raster blocks
+                of the 'rasterstats' engine (which reads the window of each
+                ADM unit, not the full band)
+    * simplify : float, simplify ADM boundaries to this fraction of the raster
+                 pixel size before computing statistics (None to disable)
+    * run_date : str, date of run noted in each sheet (defaults to now)
+    * approx : int, compute approximate statistics from the rasters reduced to
+               this overview level, adding the fraction of pixels sampled
+               (approx_frac) and the standard error of the mean (approx_se)
+               for every ADM unit. None for full resolution.
+    * approx_dir : str, directory to cache reduced rasters in
+    * output_format : str, 'xlsx' for a workbook with one sheet per raster
+                      (and ADM level), 'parquet' for a single long table
+                      next to it (same name, .parquet), or 'both'
+    * rollup : bool, stream the finest ADM level once per raster and merge
+               coarser levels from it instead of using `engine`. Requires all
+               statistics to be in `ROLLUP_STATS`. None (default) to roll up
+               when several ADM levels are checked, all statistics allow it
+               and no `engine` is given.
 
     Returns
     ==========
@@ -70,164 +447,194 @@ def extract_stats(shp_files, rst_files, adms_to_check,
     Outputs
     ==========
     * Excel File : `sanity_check_[datetime of run].xlsx`
+    * Parquet File : `sanity_check_[datetime of run].parquet`
     """
+    if run_date is None:
+        run_date = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+    stat_list = stats_of_interest.split()
+    calc_stats = stats_of_interest
+    overviews = None
+    if approx is not None:
+        overviews = OverviewCache(approx, approx_dir)
+
+        # Error estimates need the pixel count and standard deviation
+        calc_stats = " ".join(stat_list + [s for s in ('count', 'std')
+                                           if s not in stat_list])
+    # End if
+
+    # An explicitly chosen engine is used for every ADM level,
+    # unless the roll-up is asked for as well
+    if (rollup is None) and (engine is not None):
+        rollup = False
+    if engine is None:
+        engine = 'rasterstats'
+
+    # Coarser ADM levels are merged from the finest one when possible
+    mergeable = all(stat in ROLLUP_STATS for stat in calc_stats.split())
+    if rollup is None:
+        rollup = (len(adms_to_check) > 1) and mergeable
+    elif rollup and not mergeable:
+        raise ValueError("ADM levels can only be rolled up for the statistics {}, got: {}"
+                         .format(" ".join(ROLLUP_STATS), calc_stats))
+    # End if
+    finest = finest_adm(adms_to_check)
+
     # combination of all the three items. * expands the list of inputs
     all_combinations = itools.product(*[shp_files, rst_files, adms_to_check])
     # creates empty dictionaries
+    sheets = []
     shp_cache = {}
     rst_cache = {}
+    moments_cache = {}
+    simplifiers = {}
     for shp, rst, adm in all_combinations:
         # Gets raster file name
-        sheet_name = os.path.basename(rst)
+        rst_name = os.path.basename(rst)
         shp_name = os.path.basename(shp)
 
-        print("Processing", shp_name, sheet_name, adm)
+        # One sheet per raster, and per ADM level if more than one is checked
+        sheet_name = rst_name
+        if len(adms_to_check) > 1:
+            sheet_name = "{}_{}".format(adm, rst_name)[:31]
+
+        print("Processing", shp_name, rst_name, adm)
 
-        # Get number from ADM level string
-        adm_code_val = int(adm.strip('ADM'))
         adm_code = "{}_CODE".format(adm)
-        adm_name = "{}_NAME".format(adm)
 
         # Keep shp data in memory until done with it
         if shp in shp_cache:
-            shp_data = shp_cache[shp]
+            shp_layer = shp_cache[shp]
         else:
             shp_cache = {}  # clear shapefile cache
-            shp_data = gp.read_file(shp).set_index(adm_code)
-            
+            shp_layer = gp.read_file(shp)
+
             # Both vector and raster files have to have matching CRS
             with rasterio.open(rst) as src:
-                shp_crs = shp_data.crs['init']
-                rst_crs = src.crs.to_string().split("=")[1]
+                shp_crs = str(shp_layer.crs.to_epsg()) if shp_layer.crs else ''
+                rst_crs = str(src.crs.to_epsg()) if src.crs else ''
 
                 crs_no_match = shp_crs != rst_crs
                 rst_not_wgs84 = "4326" not in rst_crs
                 shp_not_wgs84 = "4326" not in shp_crs
                 if crs_no_match or rst_not_wgs84 or shp_not_wgs84:
-                    # CRS do not match so write out error to
-                    # xlsx file and then continue
-                    with pd.ExcelWriter(output_fn, engine='openpyxl')\
-                            as writer:
-                        df = pd.DataFrame()
-                        df.to_excel(writer, sheet_name, startrow=2)
-                        del df
-
-                        cmt = "Could not process {} with {}, incorrect CRS."\
-                              .format(sheet_name, shp_name)
-                        issue = "Issues:"
-                        if crs_no_match:
-                            issue += " Shapefile and raster have differing CRS."
-                        if shp_not_wgs84:
-                            issue += " Shapefile is not in WGS84."
-                        if rst_not_wgs84:
-                            issue += " Raster is not in WGS84."
-                        worksheet = writer.sheets[sheet_name]
-                        worksheet.cell(row=1, column=1).value = cmt
-                        worksheet.cell(row=2, column=1).value = issue
+                    # CRS do not match so note the error
+                    # in an empty sheet and then continue
+                    cmt = "Could not process {} with {}, incorrect CRS."\
+                          .format(rst_name, shp_name)
+                    issue = "Issues:"
+                    if crs_no_match:
+                        issue += " Shapefile and raster have differing CRS."
+                    if shp_not_wgs84:
+                        issue += " Shapefile is not in WGS84."
+                    if rst_not_wgs84:
+                        issue += " Raster is not in WGS84."
+
+                    sheets.append({'sheet': sheet_name, 'data': None,
+                                   'comment': [cmt, issue], 'shapefile': shp_name,
+                                   'raster': rst_name, 'adm': adm})
                     continue
                 # End if
 
 # sort adm zones by ascending area size
-            shp_data['area'] = shp_data.geometry.area
-            shp_data = shp_data.sort_values('area')
-            shp_cache[shp] = shp_data
-
-# keep raster in memory until we are done with it
-        if rst in rst_cache:
-            rst_data = rst_cache[rst]
-            nodata = rst_cache['nodata']
-            transform = rst_cache['transform']
+            shp_layer['area'] = shp_layer.geometry.area
+            shp_layer = shp_layer.sort_values('area')
+            shp_cache[shp] = shp_layer
+        # End if
+
+        # Approximate statistics are computed from a reduced copy
+        rst_path = rst
+        if overviews is not None:
+            rst_path = overviews.path(rst)
+
+        # Simplified boundaries are cached per raster resolution
+        zones = shp_layer
+        if simplify is not None:
+            if shp not in simplifiers:
+                simplifiers = {shp: ZoneSimplifier(shp_layer, simplify)}
+
+            with rasterio.open(rst_path) as src:
+                zones = simplifiers[shp].for_raster(src)
+        # End if
+
+        shp_data = shp_layer.set_index(adm_code)
+
+        if rollup:
+            # The finest ADM level is computed once per raster,
+            # coarser levels are merged from it
+            if (shp, rst_path) not in moments_cache:
+                moments_cache = {}  # clear moments cache
+                with rasterio.open(rst_path) as src:
+                    moments_cache[(shp, rst_path)] = stream_moments(
+                        zones, "{}_CODE".format(finest), src, max_mem=max_mem)
+            # End if
+
+            ids, moments = moments_cache[(shp, rst_path)]
+            df = rollup_adm_stats(shp_layer, ids, moments, finest, adm,
+                                  calc_stats.split())
+        elif engine == 'stream':
+            df = stream_adm_stats(zones.set_index(adm_code), rst_path, adm,
+                                  calc_stats, max_mem)
         else:
-            rst_cache = {}  # clear raster cache
+            # keep raster open, and its cached blocks, until we are done with it
+            if rst_path not in rst_cache:
+                for blocks in rst_cache.values():
+                    blocks.ds.close()
+                rst_cache = {rst_path: BlockCache(rasterio.open(rst_path), max_mem)}
+            # End if
+
+            df = batch_adm_stats(zones.set_index(adm_code), rst_cache[rst_path],
+                                 adm, calc_stats)
+        # End if
+
+        comment = "# Extracted from {} using {} on {}"\
+                  .format(rst_name,
+                          shp_name,
+                          run_date)
+
+        if overviews is not None:
             with rasterio.open(rst) as src:
-                nodata = src.nodatavals
-                transform = src.transform
-                rst_data = src.read(1)
-                rst_data = np.ma.masked_array(rst_data, mask=(rst_data == nodata))
-                rst_cache[rst] = {
-                    'data': rst_data,
-                    'transform': src.transform,
-                    'nodata': nodata
-                }
-            # End with
+                pixel_area = abs(src.res[0] * src.res[1])
+
+            zone_areas = shp_data['area'].groupby(level=0).sum()
+            frac, se = sampling_error(df['count'].fillna(0).astype(float),
+                                      df['std'].astype(float),
+                                      zone_areas.reindex(df.index).fillna(0),
+                                      pixel_area)
+            df = df.drop(columns=[s for s in ('count', 'std') if s not in stat_list])
+            df.insert(len(df.columns) - 1, 'approx_frac', frac)
+            df.insert(len(df.columns) - 1, 'approx_se', se)
+
+            comment += " (approximate: overview level {}, about 1/{} of pixels)"\
+                       .format(approx, 4 ** approx)
         # End if
 
-        # shows progress
-        try:
-            _loop = tqdm(shp_data.index.unique())
-        except NameError:
-            _loop = shp_data.index.unique()
-        for _admcode in _loop:
-            # Using shp_data.loc[adm_code, :] results in recursion error
-            # when converting to JSON, so have to explicitly subset DF
-            sel = shp_data.loc[shp_data.index == _admcode, :]
-            
-            # Combine (dissolve) areas with the same ADM code together
-            if len(sel.index) > 1:
-                sel = sel.dissolve(adm_code)
-
-            curr_adm_name = sel.at[_admcode, adm_name]
-
-            try:
-                # Set msg for progress bar if available
-                _loop.set_description(curr_adm_name)
-            except AttributeError:
-                pass
-
-            #creates dictionary of statistics for each individual adm unit
-            stats = zonal_stats(sel, rst_data,
-                                affine=transform,
-                                stats=stats_of_interest,
-                                nodata=nodata)
-            stats = stats[0]
-            stats_for_raster = {adm_name: curr_adm_name}
-
-            # checks for smaller administrative units than ADM0 and list them
-            if adm_code_val > 0:
-                stats_for_raster['ADM0_CODE'] = shp_data.at[_admcode,
-                                                            'ADM0_CODE']
-
-            stats_for_raster.update(stats)
-            stats_for_raster.update({'Comment/Error': ""})
-
-            # Add new row to dataframe, or create dataframe
-            # if it does not exist
-            try:
-                df.loc[_admcode] = stats_for_raster
-            except NameError:
-                df = pd.DataFrame(columns=[col for col in stats_for_raster],
-                                  index=shp_data.index.unique())
-                df.index.name = adm_code
-
-                df.loc[_admcode] = stats_for_raster
-            # End with
-        # End adm loop
-
-        # Write out dataframe to excel file
-        try:
-            book = load_workbook(output_fn)
-        except FileNotFoundError:
-            book = None
-
-        # Write out data to excel file
-        with pd.ExcelWriter(output_fn, engine='openpyxl') as writer:
-            if book:
-                writer.book = book
-
-            df.to_excel(writer, sheet_name, startrow=2)
-            comment = "# Extracted from {} using {} on {}"\
-                      .format(sheet_name,
-                              shp_name,
-                              run_date)
-            worksheet = writer.sheets[sheet_name]
-            worksheet.cell(row=1, column=1).value = comment
+        # Results are kept until all rasters are done, then written once
+        sheets.append({'sheet': sheet_name, 'data': df, 'comment': [comment],
+                       'shapefile': shp_name, 'raster': rst_name, 'adm': adm})
     # End combination loop
+
+    for blocks in rst_cache.values():
+        blocks.ds.close()
+
+    output_fn = str(output_fn)
+    if output_format in ('xlsx', 'both'):
+        write_workbook(output_fn, sheets)
+    if output_format in ('parquet', 'both'):
+        parquet_fn = os.path.splitext(output_fn)[0] + '.parquet'
+        long_table(sheets).to_parquet(parquet_fn, index=False)
+        print("Long table written to", parquet_fn)
+    # End if
 # End main()
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+
     run_date = datetime.now().strftime("%Y-%m-%d_%H%M%S")
     output_fn = "sanity_check_{}.xlsx".format(run_date)
+    if args.approx is not None:
+        output_fn = "sanity_check_{}_approx{}.xlsx".format(run_date, args.approx)
 
     # openpyxl has trouble with relative paths
     # convert to absolute path to avoid this issue
@@ -235,22 +642,17 @@ if __name__ == '__main__':
     abs_output = abs_output.absolute().resolve()
     print("Outputting data to", abs_output)
 
-    # Shapefile for stats zones
-    shp_file_pth = "../data/g2015_2014_0_upd270117"
-
-    # More than one raster is stored in hazards. It gets the list of tif files.
-    hazpath = "../data/hazards"
-
     # Get geotiff and shapefiles
-    haz_rasters = glob(hazpath + "/*.tif")
-    shp_files = glob(shp_file_pth + "/*.shp")
+    # More than one raster is stored in hazards. It gets the list of tif files.
+    haz_rasters = glob(args.hazards + "/*.tif")
+    shp_files = glob(args.shapefiles + "/*.shp")
 
     assert len(shp_files) > 0, "No shapefiles found!"
     assert len(haz_rasters) > 0, "No rasters found!"
 
-    # select statistics of interest and administrative units
-    stats_of_interest = "max min mean range count"
-    adms_to_check = ["ADM0"]
-
-    extract_stats(shp_files, haz_rasters, adms_to_check,
-                  stats_of_interest, abs_output)
+    extract_stats(shp_files, haz_rasters, args.adms,
+                  " ".join(args.stats), abs_output, args.engine,
+                  max_mem=args.max_mem, simplify=args.simplify,
+                  run_date=run_date, approx=args.approx,
+                  approx_dir=args.approx_cache, output_format=args.format,
+                  rollup=args.rollup)
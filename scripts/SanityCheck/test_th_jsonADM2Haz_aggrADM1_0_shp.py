@@ -12,57 +12,31 @@ June 2018 updates include ADM1 and ADM0 names into the files, for easier transla
 """
 
 # -*- coding: utf-8 -*-
-from sys import argv
+import argparse
+import os
+import sys
 import pandas as pd
-# from osgeo import ogr  # commented as it is not currently in use
-
-
-script, csv_file = argv
-
-# %% Function definitions for Pandas & admin 1 level hazard level evaluation
-
-
-def haz_adm(row):
-    if row['hazard_level'] == 'VLO':
-        return 1
-    if row['hazard_level'] == 'LOW':
-        return 2
-    if row['hazard_level'] == 'MED':
-        return 3
-    if row['hazard_level'] == 'HIG':
-        return 4
-    return 0
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Extract_TH_api'))
+from th_fetch import BASE_URL, HAZARDS, hazard_url, read_hazards
+from th_lookup import load_lookup
+from th_tables import ADM0_COLS, ADM1_COLS, hazard_levels, max_levels, write_wide_tables
+# from osgeo import ogr  # commented as it is not currently in use
 
-def change_adm(row):
-    if row['hazard_level'] == 1:
-        return 'VLO'
-    if row['hazard_level'] == 2:
-        return 'LOW'
-    if row['hazard_level'] == 3:
-        return 'MED'
-    if row['hazard_level'] == 4:
-        return 'HIG'
 
+parser = argparse.ArgumentParser(description='Pull ADM2 hazard levels from ThinkHazard! and join them to the ADM codes')
+parser.add_argument('csv_file', help='Output name, prefixed with the hazard type for each CSV')
+parser.add_argument('--wide', action='store_true',
+                    help='Write one Parquet table per ADM level (ADMIN2/1/0_<csv_file name>.parquet), '
+                         'with a column per hazard type, instead of CSVs per hazard')
+parser.add_argument('--base-url', default=BASE_URL,
+                    help='Url of the admindiv_hazardsets folder (e.g. a local test server)')
+args = parser.parse_args()
+csv_file = args.csv_file
 
 #%% Set up JSON import
 input_text = []
-input_links = []
-input_options = ['ALL', 'CF', 'CY', 'DG', 'EH',
-                 'EQ', 'FL', 'LS', 'TS', 'UF', 'VA', 'WF']
-baseURL = 'http://www.thinkhazard.org/en/admindiv_hazardsets'
-options = {'CF': (baseURL + '/CF.json'),
-           'CY': (baseURL + '/CY.json'),
-           'DG': (baseURL + '/DG.json'),
-           'EH': (baseURL + '/EH.json'),
-           'EQ': (baseURL + '/EQ.json'),
-           'FL': (baseURL + '/FL.json'),
-           'LS': (baseURL + '/LS.json'),
-           'TS': (baseURL + '/TS.json'),
-           'UF': (baseURL + '/UF.json'),
-           'VA': (baseURL + '/VA.json'),
-           'WF': (baseURL + '/WF.json')
-           }
+input_options = ['ALL'] + HAZARDS
 
 print('''The following section will ask what hazards to pull information for. Selections should be separated as an entry for each.
       Options include: ALL, CF, CY, DG, EH, EQ, FL, LS, TS, UF, VA, WF''')
@@ -71,8 +45,7 @@ while 1:
     if input_file == '':
         break
     elif input_file.upper() == 'ALL':
-        input_text.extend(['CF', 'CY', 'DG', 'EH', 'EQ',
-                           'FL', 'LS', 'TS', 'UF', 'VA', 'WF'])
+        input_text.extend(HAZARDS)
         print('Current selection: ', input_text)
     elif input_file.upper() in input_options:
         input_text.append(input_file.upper())
@@ -80,23 +53,33 @@ while 1:
     else:
         print('Selection not valid. Please choose from possible options: ALL, CF, CY, DG, EH, EQ, FL, LS, TS, UF, VA, WF')
 
-for i in input_text:
-    if i in options[i]:
-        input_links.append(options[i])
+# Drop repeated selections, keeping the order
+input_text = list(dict.fromkeys(input_text))
+input_links = [hazard_url(i, args.base_url) for i in input_text]
 
 print("Parsing the following links:",  input_links, "\n")
 
+# Download all selected hazards at once (unchanged files are read from the cache)
+hazard_data = read_hazards(input_text, base_url=args.base_url)
+
 # %% ADDED JUNE 2018 SF: Load WB ADM2 boundary data, for lookup of ADMcodes (CO)
 lookup_csv = 'THgaul_ADM2_attrib.csv'
-lookup = pd.read_csv(lookup_csv, encoding='utf-8', delimiter=';')
+# Parsed once and cached, until the CSV changes
+adm_lookup = load_lookup(lookup_csv)
+lookup = adm_lookup.table()
+
+if args.wide:
+    # All hazards in one table per ADM level, joined to the lookup at once
+    for fn in write_wide_tables(adm_lookup, hazard_data, csv_file):
+        print("Table {} complete.".format(fn))
+    sys.exit()
 
 # %% Create CSV(s) to write to, write row headers, write JSONS
-for i in input_links:
-    csv_num = i.split("/")[-1]
-    csv_num = csv_num.split(".")[0]
+adm2_frames = []
+for csv_num in input_text:
     csv_name = csv_num + "_" + csv_file
     print("Parsing ", csv_name)
-    df1 = pd.read_json(i)
+    df1 = hazard_data[csv_num]
 
     # ADDED JUNE 2018 -
     # rename column headers in exported file, to those of WB ADM files.
@@ -115,48 +98,40 @@ for i in input_links:
     print(("CSV {} complete.\n".format(csv_name)))
     print(df)
 
-    # *** Admin 1 aggregation output
-    # converts value using lookup
-    df['haz_val'] = df.apply(lambda row: haz_adm(row), axis=1)
-
-    # group by adm1 code and export to csv
-    df_lvl1 = df.groupby(['ADM1_CODE', 'ADM1_NAME', 'ADM0_CODE', 'ADM0_NAME'])[
-        'haz_val'].max()
-    pandas_name = 'ADMIN1_' + csv_name + '.csv'
-    df_lvl1.to_csv(pandas_name, encoding='utf-8', header=None)
-
-    df_fix1 = pd.read_csv(pandas_name, header=None, encoding='utf-8')
-    df_fix1.columns = ['ADM1_CODE', 'ADM1_NAME',
-                       'ADM0_CODE', 'ADM0_NAME', 'hazard_level']
-    df_fix1['hazard_level'] = df_fix1.apply(
-        lambda row: change_adm(row), axis=1)
-    # df_fix1.columns = ['ADM1_CODE', 'ADM0_CODE', 'hazard_level']
-    df_fix1.to_csv(pandas_name, encoding='utf-8', index=False)
-    print('Admin 1 unit hazard levels for ', csv_name, " created.")
-
-    # *** Admin 0 aggregation output
-    df_lvl0 = df.groupby(['ADM0_CODE', 'ADM0_NAME'])['haz_val'].max()
-    pandas_name = 'ADMIN0_' + csv_name + '.csv'
-    df_lvl0.to_csv(pandas_name, encoding='utf-8')
-
-    df_fix0 = pd.read_csv(pandas_name, header=None, encoding='utf-8')
-    df_fix0.columns = ['ADM0_CODE', 'ADM0_NAME', 'hazard_level']
-    df_fix0['hazard_level'] = df_fix0.apply(
-        lambda row: change_adm(row), axis=1)
-    df_fix0.to_csv(pandas_name, encoding='utf-8', index=False)
-    print('Admin 0 unit hazard levels for ', csv_name, " created.\n")
-
-    #  *** JOIN ADM0 CSV to shapefile
-    # joinshpPth =
-    # joinshpADM0 = os.join(joinshpPth+)
-    # joincsv0 = 'ADMIN0_' + csv_name
-    # joinshpADM1 = os.join(joinshpPth+'g2015_2014_1_upd270117.shp')
-    # joincsv1 = 'ADMIN1_' + csv_name
-    # LATEST UPDATE: removed variables FROM SQL
-
-    # COMMENTED BELOW OUT
-    # ogr2ogr -sql
-    # 'SELECT inshp.*, joincsv.* FROM inshp LEFT JOIN \'ADMIN0_CY_test_good.csv\'.joincsv ON  inshp.ADM0_CODE = joincsv.ADM0_CODE'
-    # outputADM0.shp / Users / stufraser / OneDrive / GIS DataBase / AdminBoundaries / FAO_GAUL / GAULinThinkHazard / g2015_2014_012_THupdated / upd270117 / g2015_2014_0_upd270117.shp
-
-    # ogr2ogr -sql "select joinshpADM1.*, joincsv1.hazard_level from joinshpADM1 left join joincsv1 on joincsv1.ADM1_CODE = joinshpADM1.ADM1_CODE" outputADM1.shp joinshpADM1
+    # Ordered categorical (VLO < LOW < MED < HIG), so group maxima are vectorised
+    adm2_frames.append(df.assign(hazard=csv_num,
+                                 hazard_level=hazard_levels(df['hazard_level'])))
+
+# %% Admin 1 and Admin 0 aggregation outputs, for all hazards in one grouped pass
+if adm2_frames:
+    all_adm2 = pd.concat(adm2_frames, ignore_index=True)
+else:
+    all_adm2 = pd.DataFrame(columns=['hazard'] + ADM1_COLS + ['hazard_level'])
+
+for adm_level, adm_cols in [(1, ADM1_COLS), (0, ADM0_COLS)]:
+    adm_levels = max_levels(all_adm2, ['hazard'] + adm_cols)
+    by_hazard = dict(list(adm_levels.groupby('hazard', sort=False)))
+
+    for csv_num in input_text:
+        csv_name = csv_num + "_" + csv_file
+        pandas_name = 'ADMIN{}_'.format(adm_level) + csv_name + '.csv'
+        adm_df = by_hazard.get(csv_num, adm_levels.iloc[:0])
+        adm_df.drop(columns='hazard').to_csv(pandas_name, encoding='utf-8', index=False)
+        print('Admin {} unit hazard levels for '.format(adm_level), csv_name, " created.")
+    # End for
+# End for
+
+#  *** JOIN ADM0 CSV to shapefile
+# joinshpPth =
+# joinshpADM0 = os.join(joinshpPth+)
+# joincsv0 = 'ADMIN0_' + csv_name
+# joinshpADM1 = os.join(joinshpPth+'g2015_2014_1_upd270117.shp')
+# joincsv1 = 'ADMIN1_' + csv_name
+# LATEST UPDATE: removed variables FROM SQL
+
+# COMMENTED BELOW OUT
+# ogr2ogr -sql
+# 'SELECT inshp.*, joincsv.* FROM inshp LEFT JOIN \'ADMIN0_CY_test_good.csv\'.joincsv ON  inshp.ADM0_CODE = joincsv.ADM0_CODE'
+# outputADM0.shp / Users / stufraser / OneDrive / GIS DataBase / AdminBoundaries / FAO_GAUL / GAULinThinkHazard / g2015_2014_012_THupdated / upd270117 / g2015_2014_0_upd270117.shp
+
+# ogr2ogr -sql "select joinshpADM1.*, joincsv1.hazard_level from joinshpADM1 left join joincsv1 on joincsv1.ADM1_CODE = joinshpADM1.ADM1_CODE" outputADM1.shp joinshpADM1
@@ -0,0 +1,256 @@
+"""
+Benchmark the zonal statistics paths on synthetic data.
+
+For every combination of raster size and number of zones, synthetic data is
+generated (see `synthetic.py`) and each target is timed in a fresh process,
+so that the peak resident memory reported is that of the target alone:
+
+- hazardstat-mask, hazardstat-label, hazardstat-stream : `hazardstat.extract_stats`
+- sanity_check : `sanity_check.extract_stats` (ADM0 level)
+- netcdf : `netcdf_interaction.apply_operation` (reads the GeoTIFF directly,
+           any raster readable by rasterio works the same way as NetCDF)
+
+Throughput (pixels/s and zones/s) and peak RSS are written to JSON. When a
+baseline JSON from an earlier run is given, cases slower than the baseline
+by more than the tolerance are reported and the exit code is 1.
+
+USAGE
+    python run_bench.py --sizes 1000x500 4000x2000 --zones 100 1000 --output bench.json
+    python run_bench.py --sizes 1000x500 4000x2000 --zones 100 1000 --baseline bench.json
+"""
+import argparse
+import itertools as itools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.join(HERE, '..')
+
+sys.path.append(os.path.join(SCRIPTS, 'HazardStats'))
+from profiling import peak_rss_mb
+
+TARGETS = ['hazardstat-mask', 'hazardstat-label', 'hazardstat-stream',
+           'sanity_check', 'netcdf']
+
+
+def size_opt(value):
+    """Convert CLI input of WIDTHxHEIGHT into a tuple of ints"""
+    try:
+        width, height = map(int, value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected WIDTHxHEIGHT, got {}".format(value))
+
+    return width, height
+# End size_opt()
+
+
+parser = argparse.ArgumentParser(description='Zonal statistics benchmarks')
+parser.add_argument('--sizes', type=size_opt, nargs='+', default=[(1000, 500)],
+                    help='Raster sizes as WIDTHxHEIGHT (default: 1000x500)')
+parser.add_argument('--zones', type=int, nargs='+', default=[100],
+                    help='Numbers of zones (default: 100)')
+parser.add_argument('--vertices', type=int, default=200,
+                    help='Approximate number of vertices per zone (default: 200)')
+parser.add_argument('--dtype', type=str, default='float32',
+                    help='Raster data type (default: float32)')
+parser.add_argument('--nodata-frac', type=float, default=0.05,
+                    help='Fraction of nodata pixels (default: 0.05)')
+parser.add_argument('--striped', action='store_true',
+                    help='Use striped instead of tiled GeoTIFFs')
+parser.add_argument('--targets', type=str, nargs='+', default=TARGETS, choices=TARGETS,
+                    help='Code paths to time (default: all)')
+parser.add_argument('--repeat', type=int, default=1,
+                    help='Runs per case, the fastest is kept (default: 1)')
+parser.add_argument('--workdir', type=str, default=None,
+                    help='Directory for synthetic data (default: temporary directory)')
+parser.add_argument('--output', type=str, default=None,
+                    help='Write measurements to this JSON file')
+parser.add_argument('--baseline', type=str, default=None,
+                    help='JSON file of an earlier run to compare against')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='Allowed slowdown relative to the baseline (default: 0.25, i.e. 25%%)')
+parser.add_argument('--worker', type=str, default=None,
+                    help=argparse.SUPPRESS)
+
+
+def run_target(target, rst_fn, shp_fn, workdir):
+    """Run a single target on the given data (in the current process)."""
+    if target.startswith('hazardstat'):
+        sys.path.append(os.path.join(SCRIPTS, 'HazardStats'))
+        from hazardstat import extract_stats
+
+        engine = target.split('-')[1]
+        extract_stats([shp_fn], [rst_fn], 'OBJECTID', ['max', 'min', 'mean'],
+                      engine=engine)
+    elif target == 'sanity_check':
+        sys.path.append(os.path.join(SCRIPTS, 'SanityCheck'))
+        from sanity_check import extract_stats
+
+        output_fn = os.path.join(workdir, 'sanity_check_bench.xlsx')
+        if os.path.exists(output_fn):
+            os.remove(output_fn)
+        extract_stats([shp_fn], [rst_fn], ['ADM0'], "max min mean count", output_fn)
+    elif target == 'netcdf':
+        sys.path.append(os.path.join(SCRIPTS, 'zonalstats-netcdf'))
+        from netcdf_interaction import apply_operation
+
+        apply_operation(rst_fn, shp_fn, feature_identifier='ADM2_NAME',
+                        op='nanmean', output_result=False)
+    else:
+        raise ValueError("Unknown target: {}".format(target))
+    # End if
+# End run_target()
+
+
+def worker(spec):
+    """Entry point of the benchmark process: time a target, print the result as JSON."""
+    spec = json.loads(spec)
+
+    start = time.perf_counter()
+    run_target(spec['target'], spec['rst_fn'], spec['shp_fn'], spec['workdir'])
+    elapsed = time.perf_counter() - start
+
+    # Targets print progress, the result is the last line
+    print()
+    print(json.dumps({'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}))
+# End worker()
+
+
+def time_target(target, rst_fn, shp_fn, workdir):
+    """Time a target in a fresh process.
+
+    Returns
+    =======
+    * dict, with seconds and peak_rss_mb, or error
+    """
+    spec = json.dumps({'target': target, 'rst_fn': rst_fn, 'shp_fn': shp_fn,
+                       'workdir': workdir})
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', spec],
+                          cwd=workdir, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1]}
+
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+# End time_target()
+
+
+def case_key(case):
+    return "{target}|{width}x{height}|{zones}".format(**case)
+# End case_key()
+
+
+def run_cases(args, workdir):
+    """Generate data and time all targets for every size/zone combination."""
+    cases = []
+    for (width, height), n_zones in itools.product(args.sizes, args.zones):
+        rst_fn = os.path.join(workdir, 'hazard_{}x{}.tif'.format(width, height))
+        if not os.path.exists(rst_fn):
+            synthetic.make_raster(rst_fn, width, height, args.dtype, args.nodata_frac,
+                                  tiled=not args.striped)
+
+        shp_fn = os.path.join(workdir, 'zones_{}x{}_{}.shp'.format(width, height, n_zones))
+        if not os.path.exists(shp_fn):
+            synthetic.make_zones(shp_fn, n_zones, synthetic.raster_bounds(width, height),
+                                 args.vertices)
+
+        for target in args.targets:
+            runs = [time_target(target, rst_fn, shp_fn, workdir)
+                    for _ in range(args.repeat)]
+            ok = [run for run in runs if 'error' not in run]
+
+            case = {'target': target, 'width': width, 'height': height,
+                    'zones': n_zones}
+            if len(ok) == 0:
+                case['error'] = runs[0]['error']
+            else:
+                best = min(ok, key=lambda run: run['seconds'])
+                case.update(best)
+                case['pixels_per_s'] = width * height / best['seconds']
+                case['zones_per_s'] = n_zones / best['seconds']
+            # End if
+
+            print(json.dumps(case))
+            cases.append(case)
+        # End for
+    # End for
+
+    return cases
+# End run_cases()
+
+
+def compare(cases, baseline, tolerance):
+    """Cases slower than the baseline by more than the tolerance.
+
+    Returns
+    =======
+    * List[dict], with target, size, zones, seconds, baseline seconds and ratio
+    """
+    previous = {case_key(case): case for case in baseline['cases']
+                if 'seconds' in case}
+
+    regressions = []
+    for case in cases:
+        before = previous.get(case_key(case))
+        if (before is None) or ('seconds' not in case):
+            continue
+
+        ratio = case['seconds'] / before['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append({'case': case_key(case), 'seconds': case['seconds'],
+                                'baseline_seconds': before['seconds'], 'ratio': ratio})
+    # End for
+
+    return regressions
+# End compare()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker)
+        sys.exit(0)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        cases = run_cases(args, os.path.abspath(args.workdir))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            cases = run_cases(args, workdir)
+    # End if
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'vertices': args.vertices,
+        'dtype': args.dtype,
+        'nodata_frac': args.nodata_frac,
+        'tiled': not args.striped,
+        'cases': cases,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+        regressions = compare(cases, baseline, args.tolerance)
+        for reg in regressions:
+            print("REGRESSION {case}: {seconds:.2f}s vs {baseline_seconds:.2f}s "
+                  "({ratio:.2f}x)".format(**reg))
+
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+    # End if
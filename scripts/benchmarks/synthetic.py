@@ -0,0 +1,181 @@
+"""
+Synthetic hazard rasters and admin boundaries for benchmarking.
+
+- `make_raster` : GeoTIFF of configurable size, dtype, nodata density and
+                  tiling, written strip by strip so large rasters can be
+                  generated with little memory.
+- `make_zones` : Voronoi admin polygons of configurable count and
+                 complexity (vertices per zone). Zones form a coverage of
+                 the raster extent and carry GAUL-style ADM0/ADM1/ADM2 code
+                 and name fields, grouped into spatially contiguous units.
+
+USAGE
+    python synthetic.py --width 4000 --height 2000 --zones 1000 --outdir C:\\temp\\bench
+"""
+import argparse
+import os
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+
+parser = argparse.ArgumentParser(description='Generate synthetic benchmark data')
+parser.add_argument('--outdir', type=str, required=True,
+                    help='Directory to write hazard.tif and zones.shp to')
+parser.add_argument('--width', type=int, default=2000,
+                    help='Raster width in pixels (default: 2000)')
+parser.add_argument('--height', type=int, default=1000,
+                    help='Raster height in pixels (default: 1000)')
+parser.add_argument('--dtype', type=str, default='float32',
+                    help='Raster data type (default: float32)')
+parser.add_argument('--nodata-frac', type=float, default=0.05,
+                    help='Fraction of nodata pixels (default: 0.05)')
+parser.add_argument('--striped', action='store_true',
+                    help='Write a striped instead of a tiled GeoTIFF')
+parser.add_argument('--zones', type=int, default=500,
+                    help='Number of zones (default: 500)')
+parser.add_argument('--vertices', type=int, default=200,
+                    help='Approximate number of vertices per zone (default: 200)')
+
+# Lower left corner and pixel size of the synthetic grid (WGS84)
+ORIGIN = (0.0, 0.0)
+PIXEL_SIZE = 0.01
+CRS = 'EPSG:4326'
+
+
+def raster_bounds(width, height, pixel_size=PIXEL_SIZE):
+    """Bounds (minx, miny, maxx, maxy) of a synthetic raster."""
+    minx, miny = ORIGIN
+
+    return (minx, miny, minx + width * pixel_size, miny + height * pixel_size)
+# End raster_bounds()
+
+
+def make_raster(path, width, height, dtype='float32', nodata_frac=0.05,
+                tiled=True, blocksize=256, seed=0, pixel_size=PIXEL_SIZE):
+    """Write a synthetic hazard raster.
+
+    Values follow a gamma distribution (scaled to the dtype range for integer
+    types), with a fraction of pixels set to nodata and a few to zero.
+
+    Parameters
+    ==========
+    * path : str, output GeoTIFF path
+    * width, height : int, raster size in pixels
+    * dtype : str, numpy/GDAL data type
+    * nodata_frac : float, fraction of pixels set to nodata
+    * tiled : bool, write a tiled GeoTIFF, striped otherwise
+    * blocksize : int, tile size (tiled) or rows per write
+    * seed : int, random seed
+    * pixel_size : float, pixel size in degrees
+
+    Returns
+    =======
+    * str, path
+    """
+    rng = np.random.default_rng(seed)
+    is_int = np.issubdtype(np.dtype(dtype), np.integer)
+    nodata = np.iinfo(dtype).max if is_int else -9999.0
+
+    minx, miny, maxx, maxy = raster_bounds(width, height, pixel_size)
+    profile = dict(driver='GTiff', width=width, height=height, count=1,
+                   dtype=dtype, crs=CRS, nodata=nodata,
+                   transform=from_origin(minx, maxy, pixel_size, pixel_size))
+    if tiled:
+        profile.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row in range(0, height, blocksize):
+            rows = min(blocksize, height - row)
+            data = rng.gamma(2.0, 3.0, (rows, width))
+            if is_int:
+                data = np.clip(data * 10, 0, np.iinfo(dtype).max - 1)
+            data = data.astype(dtype)
+
+            data[rng.random((rows, width)) < 0.02] = 0
+            data[rng.random((rows, width)) < nodata_frac] = nodata
+
+            window = Window(0, row, width, rows)
+            dst.write(data, 1, window=window)
+        # End for
+    # End with
+
+    return path
+# End make_raster()
+
+
+def make_zones(path, n_zones, bounds, vertices=200, seed=1, adm1_size=10,
+               adm0_size=100):
+    """Write synthetic Voronoi admin polygons covering the given bounds.
+
+    Parameters
+    ==========
+    * path : str, output shapefile path
+    * n_zones : int, number of ADM2 zones
+    * bounds : tuple[float], (minx, miny, maxx, maxy) to cover
+    * vertices : int, approximate number of vertices per zone
+    * seed : int, random seed
+    * adm1_size : int, number of ADM2 zones per ADM1 unit
+    * adm0_size : int, number of ADM2 zones per ADM0 unit
+
+    Returns
+    =======
+    * GeoPandas DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    extent = shapely.box(*bounds)
+
+    xy = np.c_[rng.uniform(minx, maxx, n_zones), rng.uniform(miny, maxy, n_zones)]
+
+    # Number zones along horizontal bands so that consecutive zones are
+    # neighbours and ADM1/ADM0 units are (mostly) contiguous
+    n_bands = max(int(np.sqrt(n_zones / 4)), 1)
+    band = np.floor((xy[:, 1] - miny) / (maxy - miny) * n_bands)
+    snake = np.where(band % 2 == 0, xy[:, 0], -xy[:, 0])
+    xy = xy[np.lexsort((snake, band))]
+
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(xy),
+                                                       extend_to=extent))
+    # Voronoi cells are not returned in input order
+    order = shapely.STRtree(cells).query(shapely.points(xy), predicate='within')
+    cells = shapely.intersection(cells[order[1][np.argsort(order[0])]], extent)
+
+    # Densify boundaries to the requested complexity. Shared edges are
+    # split identically, so zones still form a coverage.
+    perimeter = shapely.length(cells)
+    cells = shapely.segmentize(cells, np.maximum(perimeter / vertices, 1e-9))
+
+    idx = np.arange(n_zones)
+    adm2 = idx + 1
+    adm1 = idx // adm1_size + 1
+    adm0 = idx // adm0_size + 1
+    zones = gpd.GeoDataFrame({
+        'OBJECTID': adm2,
+        'ADM2_CODE': adm2,
+        'ADM2_NAME': ['ADM2_{}'.format(i) for i in adm2],
+        'ADM1_CODE': adm1,
+        'ADM1_NAME': ['ADM1_{}'.format(i) for i in adm1],
+        'ADM0_CODE': adm0,
+        'ADM0_NAME': ['ADM0_{}'.format(i) for i in adm0],
+    }, geometry=cells, crs=CRS)
+
+    zones.to_file(path)
+
+    return zones
+# End make_zones()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+
+    make_raster(os.path.join(args.outdir, 'hazard.tif'), args.width, args.height,
+                args.dtype, args.nodata_frac, tiled=not args.striped)
+    make_zones(os.path.join(args.outdir, 'zones.shp'), args.zones,
+               raster_bounds(args.width, args.height), args.vertices)
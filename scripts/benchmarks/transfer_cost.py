@@ -0,0 +1,146 @@
+"""
+Measure the cost of handing HazardStats results from worker processes to the parent.
+
+Compares the old result channel, where every worker wrote its merged
+GeoDataFrame (geometry included) into a `multiprocess` Manager DictProxy,
+with workers returning compact per-zone record arrays and the parent doing
+the single geometry merge.
+
+USAGE
+    python transfer_cost.py --zones 20000 --vertices 200 --rasters 4
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.geometry
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'HazardStats'))
+from hazardstat import stat_records
+
+
+parser = argparse.ArgumentParser(description='Result transfer cost')
+parser.add_argument('--zones', type=int, default=20000,
+                    help='Number of zones (default: 20000)')
+parser.add_argument('--vertices', type=int, default=200,
+                    help='Vertices per zone polygon (default: 200)')
+parser.add_argument('--rasters', type=int, default=4,
+                    help='Number of rasters, i.e. results handed over (default: 4)')
+parser.add_argument('--output', type=str, default=None,
+                    help='Write measurements to this JSON file')
+
+
+def synthetic_results(n_zones, n_vertices, field='OBJECTID', seed=0):
+    """Zone polygons and a matching `mp_calc_stats` style result set."""
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+
+    geoms = []
+    for i in range(n_zones):
+        radius = rng.uniform(0.5, 1.0, n_vertices)
+        x = (i % 200) * 2 + radius * np.cos(angles)
+        y = (i // 200) * 2 + radius * np.sin(angles)
+        geoms.append(shapely.geometry.Polygon(np.c_[x, y]))
+    # End for
+
+    shp = gpd.GeoDataFrame({field: np.arange(n_zones)}, geometry=geoms)
+    result_set = {i: {'max': rng.random(), 'min': rng.random(), 'mean': rng.random(),
+                      'sum': rng.random(), 'count': int(rng.integers(1, 1000)),
+                      'range': rng.random()}
+                  for i in range(n_zones)}
+
+    return shp, result_set
+# End synthetic_results()
+
+
+def measure_manager(results):
+    """Time writing results into a Manager DictProxy and reading them back."""
+    import multiprocess as mp
+
+    with mp.Manager() as manager:
+        d = manager.dict()
+        start = time.perf_counter()
+        for key, value in results.items():
+            d[key] = value
+        collected = dict(d)
+        elapsed = time.perf_counter() - start
+    # End with
+
+    return elapsed, collected
+# End measure_manager()
+
+
+def measure_pickle(results):
+    """Bytes and time of a pickle round trip, as done for pool return values."""
+    start = time.perf_counter()
+    payload = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(payload)
+    elapsed = time.perf_counter() - start
+
+    return len(payload), elapsed
+# End measure_pickle()
+
+
+def main(n_zones, n_vertices, n_rasters, field='OBJECTID'):
+    shp, result_set = synthetic_results(n_zones, n_vertices, field)
+
+    # Before: each worker merges geometries and hands over the GeoDataFrame
+    stat_df = pd.DataFrame.from_dict(result_set, orient='index')
+    stat_df[field] = stat_df.index
+    merged = shp.merge(stat_df, on=field)
+    before = {('zones.shp', 'rst_{}.tif'.format(i)): (merged, 'sheet', '')
+              for i in range(n_rasters)}
+
+    # After: workers hand over record arrays, the parent merges once
+    records = stat_records(result_set, field)
+    after = {('zones.shp', 'rst_{}.tif'.format(i)): (records, 'sheet', '')
+             for i in range(n_rasters)}
+
+    before_bytes, before_pickle = measure_pickle(before)
+    after_bytes, after_pickle = measure_pickle(after)
+
+    try:
+        before_manager, _ = measure_manager(before)
+    except ImportError:
+        before_manager = None
+
+    start = time.perf_counter()
+    for recs, _, _ in after.values():
+        shp.merge(pd.DataFrame.from_records(recs), on=field)
+    after_merge = time.perf_counter() - start
+
+    report = {
+        'zones': n_zones,
+        'vertices': n_vertices,
+        'rasters': n_rasters,
+        'before': {
+            'bytes': before_bytes,
+            'pickle_roundtrip_s': before_pickle,
+            'manager_roundtrip_s': before_manager,
+        },
+        'after': {
+            'bytes': after_bytes,
+            'pickle_roundtrip_s': after_pickle,
+            'parent_merge_s': after_merge,
+        },
+    }
+
+    return report
+# End main()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    report = main(args.zones, args.vertices, args.rasters)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
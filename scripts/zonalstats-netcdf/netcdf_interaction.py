@@ -1,4 +1,5 @@
 import os
+import sys
 
 import rasterio
 from rasterio.mask import mask
@@ -8,6 +9,10 @@ import fiona
 
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'HazardStats'))
+from masking import valid_values
+
 
 def apply_operation(src_nc, src_shape, feature_identifier='NOME_REG',
                     op="nanmean", output_result=True, verbose=False):
@@ -34,6 +39,7 @@ def apply_operation(src_nc, src_shape, feature_identifier='NOME_REG',
             with rasterio.open(src_nc) as nc_data:
                 img, transform = mask(nc_data, [region[1]], nodata=np.nan)
                 meta = nc_data.meta.copy()
+                nodata = nc_data.nodata
             # End with
 
             bands, height, width = img.shape
@@ -47,7 +53,8 @@ def apply_operation(src_nc, src_shape, feature_identifier='NOME_REG',
 
             res[region[0]] = res.get(region[0], {})
 
-            res[region[0]][op] = operation(img)
+            # Exclude raster nodata and the NaN fill outside the region
+            res[region[0]][op] = operation(valid_values(img, nodata))
             res[region[0]]['raster'] = img
 
             # rasterio.plot.show(out_image[0])
@@ -57,7 +64,7 @@ def apply_operation(src_nc, src_shape, feature_identifier='NOME_REG',
     region_means = pd.DataFrame()
     region_means.index.name = 'region'
 
-    for region, vars in res.iteritems():
+    for region, vars in res.items():
         region_means.loc[region, op] = res[region][op]
 
     if output_result:
@@ -67,7 +74,7 @@ def apply_operation(src_nc, src_shape, feature_identifier='NOME_REG',
 # End apply_operation()
 
 
-if __name__ is '__main__':
+if __name__ == '__main__':
     """
     Example of how to use the apply_operation function.
     """